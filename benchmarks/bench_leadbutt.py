@@ -0,0 +1,198 @@
+# -*- coding: UTF-8 -*-
+"""
+Benchmark leadbutt and plumbum end to end against a local fake AWS.
+
+Each size runs in its own process so peak memory isn't polluted by earlier
+runs, while the fake CloudWatch/EC2 endpoint runs in this process.
+
+Usage:
+  python benchmarks/bench_leadbutt.py [options]
+
+Examples:
+  python benchmarks/bench_leadbutt.py --sizes 100,1000 --workers 20
+  python benchmarks/bench_leadbutt.py --latency 0.05 --throttle-rate 0.02 --adaptive
+  python benchmarks/bench_leadbutt.py --latency 0.05 --engine asyncio --workers 500
+  python benchmarks/bench_leadbutt.py --plumbum --sizes 100,10000
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import io
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import yaml  # noqa: E402
+
+import fake_aws  # noqa: E402
+
+
+class CountingWriter(object):
+    """A sink that only counts what gets written to it."""
+    def __init__(self):
+        self.lines = 0
+
+    def write(self, line):
+        self.lines += 1
+
+    def flush(self):
+        pass
+
+
+def peak_memory_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+
+
+def make_config(path, size):
+    """Write a config with `size` metrics that look like what plumbum makes."""
+    metrics = [{
+        'Namespace': 'AWS/ELB',
+        'MetricName': 'RequestCount',
+        'Statistics': ['Sum'],
+        'Unit': 'Count',
+        'Dimensions': {'LoadBalancerName': 'elb-{0}'.format(i)},
+        'Options': {
+            'Formatter': 'cloudwatch.%(Namespace)s.elb-{0}.%(MetricName)s.%(statistic)s.%(Unit)s'
+                         .format(i),
+        },
+    } for i in range(size)]
+    with open(path, 'w') as fp:
+        yaml.safe_dump({'Metrics': metrics}, fp)
+
+
+def run_leadbutt(args):
+    """Child process: run leadbutt once and print the results as JSON."""
+    import leadbutt
+
+    out = CountingWriter()
+    started = time.time()
+    with fake_aws.patch_boto(args.port):
+        leadbutt.leadbutt(
+            args.config, {'Period': 1, 'Count': 5},
+            interval=0,
+            max_interval=1000,
+            workers=args.workers,
+            rate=args.rate,
+            adaptive=args.adaptive,
+            engine=args.engine,
+            out=out,
+        )
+    elapsed = time.time() - started
+    print(json.dumps({
+        'seconds': elapsed,
+        'lines': out.lines,
+        'peak_mb': peak_memory_mb(),
+    }))
+
+
+def run_plumbum(args):
+    """Child process: run plumbum once against `args.size` instances and print JSON."""
+    import plumbum
+
+    template = os.path.join(ROOT, 'sample_templates', 'ec2.yml.j2')
+    sys.argv = ['plumbum', template, 'ec2']
+    stdout = sys.stdout
+    sys.stdout = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+    started = time.time()
+    try:
+        with fake_aws.patch_boto(args.port):
+            plumbum.main()
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    elapsed = time.time() - started
+    print(json.dumps({
+        'seconds': elapsed,
+        'lines': output.count('\n'),
+        'peak_mb': peak_memory_mb(),
+    }))
+
+
+def child_args(args, size, config):
+    child = [sys.executable, os.path.abspath(__file__), '--child', '--port', str(args.port),
+             '--size', str(size), '--workers', str(args.workers)]
+    if config:
+        child.extend(['--config', config])
+    if args.plumbum:
+        child.append('--plumbum')
+    if args.rate:
+        child.extend(['--rate', str(args.rate)])
+    if args.adaptive:
+        child.append('--adaptive')
+    child.extend(['--engine', args.engine])
+    return child
+
+
+def sweep(args):
+    fake = fake_aws.FakeAWS(
+        latency=args.latency, throttle_rate=args.throttle_rate, datapoints=args.datapoints,
+        seed=0).start()
+    args.port = fake.port
+    tmpdir = tempfile.mkdtemp()
+    print('{0:>8} {1:>9} {2:>10} {3:>10} {4:>12} {5:>9}'.format(
+        'plumbum' if args.plumbum else 'metrics', 'seconds', 'api calls', 'lines',
+        'lines/sec', 'peak MB'))
+    try:
+        for size in args.sizes:
+            config = None
+            if args.plumbum:
+                fake.instances = size
+            else:
+                config = os.path.join(tmpdir, 'config-{0}.yaml'.format(size))
+                make_config(config, size)
+            fake.reset()
+            output = subprocess.check_output(child_args(args, size, config))
+            result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+            calls = sum(fake.calls.values())
+            print('{0:>8} {1:>9.2f} {2:>10} {3:>10} {4:>12.0f} {5:>9.1f}'.format(
+                size, result['seconds'], calls, result['lines'],
+                result['lines'] / result['seconds'], result['peak_mb']))
+    finally:
+        fake.stop()
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark leadbutt against a fake AWS')
+    parser.add_argument('--sizes', default='100,1000,10000,50000',
+                        type=lambda x: [int(size) for size in x.split(',')],
+                        help='config sizes (or instance counts with --plumbum) to sweep')
+    parser.add_argument('--workers', type=int, default=20)
+    parser.add_argument('--rate', type=float, help='leadbutt --rate')
+    parser.add_argument('--adaptive', action='store_true', help='leadbutt --adaptive')
+    parser.add_argument('--engine', default='statistics', help='leadbutt --engine')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds the fake AWS waits before each response')
+    parser.add_argument('--throttle-rate', type=float, default=0,
+                        help='fraction of requests the fake AWS throttles')
+    parser.add_argument('--datapoints', type=int, default=5,
+                        help='datapoints in each GetMetricStatistics response')
+    parser.add_argument('--plumbum', action='store_true',
+                        help='benchmark plumbum discovery and rendering instead')
+    # used to run a single size in a child process
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--config', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if not args.child:
+        sweep(args)
+    elif args.plumbum:
+        run_plumbum(args)
+    else:
+        run_leadbutt(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# -*- coding: UTF-8 -*-
+"""
+Benchmark how fast leadbutt can turn results into Graphite lines.
+
+Compares the original `output_results` (kept here as `legacy_output_results`)
+against the compiled output path, both writing to /dev/null.
+
+Usage:
+  python benchmarks/bench_output.py [metrics] [points]
+"""
+from __future__ import print_function, unicode_literals
+
+from calendar import timegm
+import datetime
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import leadbutt  # noqa: E402
+
+
+def legacy_output_results(results, metric, options, out):
+    """`output_results` as it was before it was compiled."""
+    formatter = options['Formatter']
+    context = metric.copy()
+    try:
+        context['dimension'] = list(metric['Dimensions'].values())[0]
+    except AttributeError:
+        context['dimension'] = ''
+    for result in results:
+        stat_keys = metric['Statistics']
+        if not isinstance(stat_keys, list):
+            stat_keys = [stat_keys]
+        for statistic in stat_keys:
+            context['statistic'] = statistic
+            context['Unit'] = result['Unit']
+            metric_name = (formatter % context).replace('/', '.').lower()
+            line = '{0} {1} {2}\n'.format(
+                metric_name,
+                result[statistic],
+                timegm(result['Timestamp'].timetuple()),
+            )
+            out.write(line)
+
+
+def make_workload(n_metrics, n_points):
+    now = datetime.datetime.utcnow().replace(second=0, microsecond=0)
+    results = [{
+        'Timestamp': now - datetime.timedelta(minutes=i),
+        'Unit': 'Count',
+        'Sum': 1337.0 + i,
+        'Maximum': 9001.0 + i,
+    } for i in range(n_points)]
+    workload = []
+    for i in range(n_metrics):
+        metric = {
+            'Namespace': 'AWS/ELB',
+            'MetricName': 'RequestCount',
+            'Statistics': ['Sum', 'Maximum'],
+            'Unit': 'Count',
+            'Dimensions': {'LoadBalancerName': 'elb-{0}'.format(i)},
+        }
+        workload.append((results, metric, leadbutt.get_options(None, None, None)))
+    return workload
+
+
+def bench(label, func, workload, out, lines):
+    start = time.time()
+    for results, metric, options in workload:
+        func(results, metric, options, out)
+    out.flush()
+    elapsed = time.time() - start
+    print('{0:>10}: {1:>10.0f} lines/sec ({2:.3f}s)'.format(label, lines / elapsed, elapsed))
+    return elapsed
+
+
+def main():
+    n_metrics = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_points = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    workload = make_workload(n_metrics, n_points)
+    lines = n_metrics * n_points * 2
+    print('{0} metrics x {1} points x 2 statistics = {2} lines'.format(
+        n_metrics, n_points, lines))
+
+    # line buffered, like sys.stdout on a terminal
+    with io.open(os.devnull, 'w', buffering=1) as out:
+        before = bench('legacy', legacy_output_results, workload, out, lines)
+    with io.open(os.devnull, 'w', buffering=leadbutt.OUTPUT_BUFFER_SIZE) as out:
+        after = bench('compiled', leadbutt.output_results, workload, out, lines)
+    print('{0:.1f}x faster'.format(before / after))
+
+
+if __name__ == '__main__':
+    main()
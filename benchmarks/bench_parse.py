@@ -0,0 +1,88 @@
+# -*- coding: UTF-8 -*-
+"""
+Benchmark parsing GetMetricStatistics responses.
+
+Compares boto's SAX parser and `Datapoint`s (what leadbutt used to get back
+from `get_metric_statistics`) against `leadbutt.parse_statistics`, on the
+same responses from `fake_aws`. Reports datapoints parsed per second, and how
+much memory the parsed results take up (Python 3 only).
+
+Usage:
+  python benchmarks/bench_parse.py [responses] [points]
+"""
+from __future__ import print_function, unicode_literals
+
+import os
+import sys
+import time
+import xml.sax
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from boto.ec2.cloudwatch.datapoint import Datapoint  # noqa: E402
+from boto.handler import XmlHandler  # noqa: E402
+from boto.resultset import ResultSet  # noqa: E402
+
+import fake_aws  # noqa: E402
+import leadbutt  # noqa: E402
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def boto_parse(body):
+    """What boto's `get_metric_statistics` does with a response."""
+    results = ResultSet([('member', Datapoint)])
+    xml.sax.parseString(body, XmlHandler(results, None))
+    return results
+
+
+def make_bodies(n_responses, n_points):
+    fake = fake_aws.FakeAWS(datapoints=n_points)
+    body = fake.action_GetMetricStatistics({
+        'Period': '60',
+        'EndTime': '2015-01-31T12:00:00',
+        'Statistics.member.1': 'Sum',
+        'Statistics.member.2': 'Maximum',
+        'Unit': 'Count',
+    }).encode('utf-8')
+    # separate copies, like separate responses
+    return [bytes(bytearray(body)) for __ in range(n_responses)]
+
+
+def bench(label, parse, bodies, datapoints):
+    start = time.time()
+    for body in bodies:
+        for result in parse(body):
+            # every result gets its timestamp turned into seconds when it's formatted
+            leadbutt.to_epoch(result['Timestamp'])
+    elapsed = time.time() - start
+
+    memory = ''
+    if tracemalloc is not None:
+        tracemalloc.start()
+        kept = [parse(body) for body in bodies]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del kept[:]
+        memory = ' {0:>8.1f} MB'.format(size / 1024.0 / 1024)
+    print('{0:>8}: {1:>10.0f} datapoints/sec ({2:.3f}s){3}'.format(
+        label, datapoints / elapsed, elapsed, memory))
+    return elapsed
+
+
+def main():
+    n_responses = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_points = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    bodies = make_bodies(n_responses, n_points)
+    datapoints = n_responses * n_points
+    print('{0} responses x {1} datapoints x 2 statistics'.format(n_responses, n_points))
+    before = bench('boto', boto_parse, bodies, datapoints)
+    after = bench('lean', leadbutt.parse_statistics, bodies, datapoints)
+    print('{0:.1f}x faster'.format(before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# -*- coding: UTF-8 -*-
+"""
+Benchmark how long leadbutt and plumbum take to start up.
+
+Every cron run of leadbutt pays this before it makes a single request. Each
+command runs several times in a fresh interpreter, and the time over a bare
+`python -c pass` is compared to a budget.
+
+Usage:
+  python benchmarks/bench_startup.py [--runs N]
+
+Exits with 1 if anything is over budget.
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# seconds on top of starting Python itself
+BUDGETS = [
+    ('leadbutt --version', [os.path.join(ROOT, 'leadbutt.py'), '--version'], 0.1),
+    ('plumbum --version', [os.path.join(ROOT, 'plumbum.py'), '--version'], 0.1),
+]
+
+
+def run_time(args, runs):
+    """Get the fastest of `runs` runs of `args` with Python, in seconds."""
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for __ in range(runs):
+            started = time.time()
+            subprocess.check_call([sys.executable] + args, stdout=devnull, cwd=ROOT)
+            times.append(time.time() - started)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark leadbutt and plumbum startup')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    # compile everything once, so the runs don't include it
+    subprocess.check_call([sys.executable, '-m', 'compileall', '-q', ROOT])
+    baseline = run_time(['-c', 'pass'], args.runs)
+    print('{0:<20} {1:>9} {2:>9} {3:>9}'.format('command', 'seconds', 'overhead', 'budget'))
+    print('{0:<20} {1:>9.3f}'.format('python', baseline))
+    over = False
+    for name, command, budget in BUDGETS:
+        seconds = run_time(command, args.runs)
+        overhead = seconds - baseline
+        over = over or overhead > budget
+        print('{0:<20} {1:>9.3f} {2:>9.3f} {3:>9.3f}{4}'.format(
+            name, seconds, overhead, budget, '  OVER BUDGET' if overhead > budget else ''))
+    sys.exit(1 if over else 0)
+
+
+if __name__ == '__main__':
+    main()
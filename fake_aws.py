@@ -0,0 +1,277 @@
+# -*- coding: UTF-8 -*-
+"""
+A local stand-in for the bits of the CloudWatch and EC2 APIs that leadbutt and
+plumbum use, for benchmarks and tests. Nothing here talks to AWS.
+
+    fake = FakeAWS(latency=0.02, throttle_rate=0.01, instances=1000).start()
+    with patch_boto(fake.port):
+        leadbutt.leadbutt('config.yaml', {'Period': 1, 'Count': 5})
+    print(fake.calls)
+    fake.stop()
+
+Every response is made up, but shaped the way boto expects. Signatures are
+not checked.
+"""
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+import datetime
+import random
+import threading
+import time
+
+import boto.ec2
+import boto.ec2.cloudwatch
+from boto.regioninfo import RegionInfo
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl, urlparse
+
+
+CLOUDWATCH_XMLNS = 'http://monitoring.amazonaws.com/doc/2010-08-01/'
+EC2_XMLNS = 'http://ec2.amazonaws.com/doc/2014-10-01/'
+
+
+def parse_time(value):
+    """Parse the ISO 8601 timestamps boto sends."""
+    value = value.rstrip('Z').split('.')[0]
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+
+def format_time(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def get_members(params, label):
+    """Get the values of a boto list param, like `Statistics.member.N`, in order."""
+    members = []
+    i = 1
+    while '{0}.{1}'.format(label, i) in params:
+        members.append(params['{0}.{1}'.format(label, i)])
+        i += 1
+    return members
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+    # keep-alive, so boto can reuse connections like it does with AWS
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.fake.lock:
+            self.server.fake.connections += 1
+
+    def do_GET(self):
+        self.handle_action(dict(parse_qsl(urlparse(self.path).query)))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        params = dict(parse_qsl(urlparse(self.path).query))
+        params.update(parse_qsl(self.rfile.read(length).decode('utf-8')))
+        self.handle_action(params)
+
+    def handle_action(self, params):
+        status, body = self.server.fake.respond(params)
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeAWS(object):
+    """
+    A threaded HTTP server that answers CloudWatch and EC2 query API requests.
+
+    latency        seconds to wait before answering each request
+    throttle_rate  fraction of requests to answer with a Throttling error
+    datapoints     datapoints in each GetMetricStatistics response, and for each
+                   GetMetricData query
+    instances      number of EC2 instances DescribeInstances returns, and the
+                   number of InstanceIds ListMetrics has for any metric
+    page_size      most results ListMetrics and GetMetricData return before a
+                   NextToken
+
+    `calls` counts requests by Action, including throttled ones, and
+    `connections` counts the connections they came in on.
+    """
+    def __init__(self, latency=0, throttle_rate=0, datapoints=5, instances=0, page_size=500,
+                 seed=None):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.datapoints = datapoints
+        self.instances = instances
+        self.page_size = page_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.connections = 0
+        self.server = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self, port=0):
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.fake = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}
+            self.connections = 0
+
+    def respond(self, params):
+        """Get the (status, body) for a request."""
+        action = params.get('Action')
+        with self.lock:
+            self.calls[action] = self.calls.get(action, 0) + 1
+            throttled = self.random.random() < self.throttle_rate
+        if self.latency:
+            time.sleep(self.latency)
+        handler = getattr(self, 'action_' + (action or ''), None)
+        if handler is None:
+            return 400, self.error('InvalidAction', 'Unsupported action: {0}'.format(action))
+        if throttled:
+            return 400, self.error('Throttling', 'Rate exceeded')
+        return 200, handler(params)
+
+    def error(self, code, message):
+        return (
+            '<ErrorResponse xmlns="{0}"><Error><Type>Sender</Type><Code>{1}</Code>'
+            '<Message>{2}</Message></Error><RequestId>fake</RequestId></ErrorResponse>'
+        ).format(CLOUDWATCH_XMLNS, code, message)
+
+    def action_GetMetricStatistics(self, params):
+        period = int(params['Period'])
+        end_time = parse_time(params['EndTime'])
+        # line the newest datapoint up with the end of a period, like CloudWatch
+        newest = end_time - datetime.timedelta(
+            seconds=(end_time - datetime.datetime(1970, 1, 1)).total_seconds() % period)
+        statistics = get_members(params, 'Statistics.member')
+        unit = params.get('Unit', 'Count')
+        members = []
+        for i in range(self.datapoints):
+            timestamp = newest - datetime.timedelta(seconds=period * (i + 1))
+            values = ''.join(
+                '<{0}>{1}</{0}>'.format(statistic, float(i + j))
+                for j, statistic in enumerate(statistics))
+            members.append('<member><Timestamp>{0}</Timestamp>{1}<Unit>{2}</Unit></member>'.format(
+                format_time(timestamp), values, unit))
+        return (
+            '<GetMetricStatisticsResponse xmlns="{0}"><GetMetricStatisticsResult>'
+            '<Datapoints>{1}</Datapoints><Label>{2}</Label></GetMetricStatisticsResult>'
+            '<ResponseMetadata><RequestId>fake</RequestId></ResponseMetadata>'
+            '</GetMetricStatisticsResponse>'
+        ).format(CLOUDWATCH_XMLNS, ''.join(members), params.get('MetricName'))
+
+    def action_GetMetricData(self, params):
+        end_time = parse_time(params['EndTime'])
+        queries = []
+        i = 1
+        while 'MetricDataQueries.member.{0}.Id'.format(i) in params:
+            prefix = 'MetricDataQueries.member.{0}.'.format(i)
+            queries.append((params[prefix + 'Id'], int(params[prefix + 'MetricStat.Period'])))
+            i += 1
+        start = int(params.get('NextToken', 0))
+        end = min(start + self.page_size, len(queries))
+        members = []
+        for query_id, period in queries[start:end]:
+            newest = end_time - datetime.timedelta(
+                seconds=(end_time - datetime.datetime(1970, 1, 1)).total_seconds() % period)
+            # oldest first, like ScanBy=TimestampAscending
+            timestamps = [newest - datetime.timedelta(seconds=period * (j + 1))
+                          for j in reversed(range(self.datapoints))]
+            members.append(
+                '<member><Id>{0}</Id><Label>{0}</Label><StatusCode>Complete</StatusCode>'
+                '<Timestamps>{1}</Timestamps><Values>{2}</Values></member>'.format(
+                    query_id,
+                    ''.join('<member>{0}</member>'.format(format_time(x)) for x in timestamps),
+                    ''.join('<member>{0}</member>'.format(float(j))
+                            for j in reversed(range(self.datapoints)))))
+        next_token = '<NextToken>{0}</NextToken>'.format(end) if end < len(queries) else ''
+        return (
+            '<GetMetricDataResponse xmlns="{0}"><GetMetricDataResult>'
+            '<MetricDataResults>{1}</MetricDataResults>{2}<Messages/></GetMetricDataResult>'
+            '<ResponseMetadata><RequestId>fake</RequestId></ResponseMetadata>'
+            '</GetMetricDataResponse>'
+        ).format(CLOUDWATCH_XMLNS, ''.join(members), next_token)
+
+    def action_ListMetrics(self, params):
+        start = int(params.get('NextToken', 0))
+        end = min(start + self.page_size, self.instances)
+        members = ''.join(
+            '<member><Dimensions><member><Name>InstanceId</Name><Value>i-{0:08x}</Value>'
+            '</member></Dimensions><MetricName>{1}</MetricName><Namespace>{2}</Namespace>'
+            '</member>'.format(
+                i, params.get('MetricName', 'CPUUtilization'), params.get('Namespace', 'AWS/EC2'))
+            for i in range(start, end))
+        next_token = '<NextToken>{0}</NextToken>'.format(end) if end < self.instances else ''
+        return (
+            '<ListMetricsResponse xmlns="{0}"><ListMetricsResult><Metrics>{1}</Metrics>{2}'
+            '</ListMetricsResult><ResponseMetadata><RequestId>fake</RequestId>'
+            '</ResponseMetadata></ListMetricsResponse>'
+        ).format(CLOUDWATCH_XMLNS, members, next_token)
+
+    def action_DescribeInstances(self, params):
+        items = []
+        for i in range(self.instances):
+            items.append(
+                '<item><instanceId>i-{0:08x}</instanceId><imageId>ami-fake</imageId>'
+                '<instanceState><code>16</code><name>running</name></instanceState>'
+                '<instanceType>m3.medium</instanceType>'
+                '<privateIpAddress>10.{1}.{2}.{3}</privateIpAddress>'
+                '<tagSet><item><key>Name</key><value>fake-{0}</value></item></tagSet>'
+                '</item>'.format(i, i >> 16 & 255, i >> 8 & 255, i & 255))
+        return (
+            '<DescribeInstancesResponse xmlns="{0}"><requestId>fake</requestId>'
+            '<reservationSet><item><reservationId>r-fake</reservationId><ownerId>0</ownerId>'
+            '<groupSet/><instancesSet>{1}</instancesSet></item></reservationSet>'
+            '</DescribeInstancesResponse>'
+        ).format(EC2_XMLNS, ''.join(items))
+
+
+@contextmanager
+def patch_boto(port):
+    """Point boto's CloudWatch and EC2 `connect_to_region` at a `FakeAWS` on `port`."""
+    def connect(cls):
+        def connect_to_region(region_name, **kwargs):
+            kwargs.pop('debug', None)
+            return cls(
+                region=RegionInfo(name=region_name, endpoint='127.0.0.1'),
+                port=port,
+                is_secure=False,
+                aws_access_key_id='fake',
+                aws_secret_access_key='fake',
+            )
+        return connect_to_region
+
+    originals = (boto.ec2.cloudwatch.connect_to_region, boto.ec2.connect_to_region)
+    boto.ec2.cloudwatch.connect_to_region = connect(boto.ec2.cloudwatch.CloudWatchConnection)
+    boto.ec2.connect_to_region = connect(boto.ec2.EC2Connection)
+    try:
+        yield
+    finally:
+        boto.ec2.cloudwatch.connect_to_region, boto.ec2.connect_to_region = originals
@@ -8,24 +8,76 @@ Options:
   -c FILE --config-file=FILE  Path to a YAML configuration file [default: config.yaml].
   -i INTERVAL                 Interval, in ms, to wait between metric requests. Doubles as the backoff multiplier. [default: 50]
   -m MAX_INTERVAL             The maximum interval time to back off to, in ms [default: 4000]
-  -p INT --period INT         Period length, in minutes [default: 1]
-  -n INT                      Number of data points to try to get [default: 5]
+  -p INT --period INT         Period length, in minutes, for every metric. Defaults to each metric's
+                              Period, or 1
+  -n INT                      Number of data points to try to get, for every metric. Defaults to
+                              each metric's Count, or 5
+  -w INT --workers INT        Number of metric requests to make concurrently [default: 1]
+  -r RATE --rate RATE         Maximum metric requests per second across all workers. Replaces the
+                              INTERVAL sleep; defaults to 1000 / INTERVAL when using workers
+  --adaptive                  Start at RATE and adjust it up and down based on CloudWatch throttling
+  --max-rate RATE             The most requests per second --adaptive will ramp up to
+  --graphite HOST:PORT        Send metrics straight to a Graphite carbon daemon instead of stdout
+  --pickle                    Use carbon's pickle protocol with --graphite (port defaults to 2004)
+  --spool DIR                 With --graphite, save lines in DIR when Graphite is down and send them
+                              once it's back
+  --spool-size MB             The most space --spool can use before dropping the oldest lines
+                              [default: 100]
+  --state FILE                Remember the newest datapoint sent for each series in FILE and only
+                              fetch newer ones on the next run
+  --plan-cache DIR            Cache the parsed config in DIR, and reuse it until the config changes
+  --stats-prefix PREFIX       Also output leadbutt's own performance metrics under PREFIX
+  --daemon                    Keep running, fetching each metric once every Period. Send SIGHUP to
+                              reload the config
+  --delay SECONDS             With --daemon, how long after each period ends to wait for CloudWatch
+                              to publish it [default: 60]
+  --from DATE                 Backfill every metric from DATE (UTC, like 2015-01-31 or
+                              2015-01-31T12:00) instead of fetching the last few periods
+  --to DATE                   Where to stop a --from backfill. Defaults to now
+  --checkpoint FILE           Remember how far a --from backfill got in FILE, and carry on from
+                              there if it's run again
+  --metric-index FILE         Cache the ListMetrics results used to fill in "*" dimensions in FILE
+  --metric-index-ttl SECONDS  How long to use --metric-index results before listing them again
+                              [default: 3600]
+  --shard K/N                 Only fetch the Kth of N slices of the config, so N hosts can split
+                              it up
+  --processes N               Split the config between N local processes [default: 1]
+  --engine ENGINE             How to fetch metrics: "statistics" makes a GetMetricStatistics call
+                              for each one, "metric-data" fetches up to 500 series with each
+                              GetMetricData call, and "asyncio" makes GetMetricStatistics calls
+                              from one thread, with --workers in flight (Python 3.5+)
+                              [default: statistics]
   -v                          Verbose
   --version                   Show version.
 """
 from __future__ import unicode_literals
 
-from calendar import timegm
+from collections import deque, OrderedDict
 import datetime
+import hashlib
+import io
+import json
+import math
 import os.path
+import pickle
+import re
+import signal
+import socket
+import struct
 import sys
+import threading
 import time
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 from docopt import docopt
-import boto.ec2.cloudwatch
-from retrying import retry
-import yaml
 
+# boto, PyYAML, retrying and multiprocessing are imported where they're used,
+# since together they're most of the time it takes to start up, and every
+# cron run (and `--version`) pays for it
 
 # emulate six.text_type based on https://docs.python.org/3/howto/pyporting.html#str-unicode
 if sys.version_info[0] >= 3:
@@ -40,6 +92,52 @@ __version__ = '0.11.0'
 
 DEFAULT_REGION = 'us-east-1'
 
+# forget series that have not had new datapoints in this long, in seconds
+STATE_TTL = 14 * 24 * 60 * 60
+
+# seconds to wait after a period ends for CloudWatch to publish its datapoint
+DEFAULT_DELAY = 60
+
+DEFAULT_RATE = 20  # requests per second, the same pace as the default 50ms interval
+
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+EPOCH = datetime.datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+# how many results can wait between each stage of fetching, formatting and writing
+PIPELINE_QUEUE_SIZE = 100
+
+# the most datapoints CloudWatch returns from one GetMetricStatistics call
+MAX_DATAPOINTS = 1440
+
+# the most queries CloudWatch takes in one GetMetricData call
+MAX_METRIC_DATA_QUERIES = 500
+
+# how to fetch metrics: a GetMetricStatistics call for each, many at once with
+# GetMetricData, or a GetMetricStatistics call for each from an asyncio event loop
+ENGINES = ('statistics', 'metric-data', 'asyncio')
+
+# how many empty responses in a row before a metric gets fetched less often
+EMPTY_THRESHOLD = 3
+
+# the longest, in seconds, to go without fetching a metric that keeps coming back empty
+MAX_EMPTY_BACKOFF = 60 * 60
+
+# how often, in seconds, a backfill saves its checkpoint
+CHECKPOINT_INTERVAL = 30
+
+# statistics that can be worked out for a long period from the ones for a shorter period
+ROLLUP_STATISTICS = ('Sum', 'Minimum', 'Maximum', 'SampleCount', 'Average')
+
+# a dimension value that matches every value CloudWatch has for that dimension
+WILDCARD = '*'
+
+# how long, in seconds, to use ListMetrics results before listing them again
+DEFAULT_INDEX_TTL = 60 * 60
+
+REQUIRED_METRIC_KEYS = ('Namespace', 'MetricName', 'Statistics', 'Dimensions')
+
 DEFAULT_OPTIONS = {
     'Period': 1,  # 1 minute
     'Count': 5,  # 5 periods
@@ -48,23 +146,32 @@ DEFAULT_OPTIONS = {
 }
 
 
-def get_config(config_file):
-    """Get configuration from a file."""
-    def load(fp):
-        try:
-            return yaml.safe_load(fp)
-        except yaml.YAMLError as e:
-            sys.stderr.write(text_type(e))
-            sys.exit(1)  # TODO document exit codes
+def parse_config(stream):
+    """Parse YAML configuration from a string or file, exiting if it's malformed."""
+    import yaml
+    # the C loader is much faster on big configs, but PyYAML can be built without it
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    try:
+        return yaml.load(stream, Loader=loader)
+    except yaml.YAMLError as e:
+        sys.stderr.write(text_type(e))
+        sys.exit(1)  # TODO document exit codes
 
-    if config_file == '-':
-        return load(sys.stdin)
-    if not os.path.exists(config_file):
+
+def check_config_file(config_file):
+    if config_file != '-' and not os.path.exists(config_file):
         sys.stderr.write('ERROR: Must either run next to config.yaml or'
             ' specify a config file.\n' + __doc__)
         sys.exit(2)
+
+
+def get_config(config_file):
+    """Get configuration from a file."""
+    check_config_file(config_file)
+    if config_file == '-':
+        return parse_config(sys.stdin)
     with open(config_file) as fp:
-        return load(fp)
+        return parse_config(fp)
 
 
 def get_options(config_options, local_options, cli_options):
@@ -87,59 +194,950 @@ def get_options(config_options, local_options, cli_options):
     return options
 
 
-def output_results(results, metric, options):
+def compile_formatter(metric, options):
     """
-    Output the results to stdout.
+    Build a function that turns results for `metric` into Graphite lines.
 
-    TODO: add AMPQ support for efficiency
+    Everything that doesn't change from one datapoint to the next is worked out
+    here once: the statistics list, the formatter context, and the sanitized
+    metric names, which only depend on the statistic and the result's unit.
     """
     formatter = options['Formatter']
+    statistics = get_statistics(metric)
     context = metric.copy()  # XXX might need to sanitize this
     try:
         context['dimension'] = list(metric['Dimensions'].values())[0]
     except AttributeError:
         context['dimension'] = ''
-    for result in results:
-        stat_keys = metric['Statistics']
-        if not isinstance(stat_keys, list):
-            stat_keys = [stat_keys]
-        for statistic in stat_keys:
-            context['statistic'] = statistic
-            # get and then sanitize metric name, first copy the unit name from the
-            # result to the context to keep the default format happy
-            context['Unit'] = result['Unit']
-            metric_name = (formatter % context).replace('/', '.').lower()
-            line = '{0} {1} {2}\n'.format(
-                metric_name,
-                result[statistic],
-                timegm(result['Timestamp'].timetuple()),
-            )
-            sys.stdout.write(line)
+    prefixes = {}
 
+    def get_prefix(statistic, unit):
+        context['statistic'] = statistic
+        # get and then sanitize metric name, first copy the unit name from the
+        # result to the context to keep the default format happy
+        context['Unit'] = unit
+        prefix = prefixes[statistic, unit] = (formatter % context).replace('/', '.').lower() + ' '
+        return prefix
 
-def leadbutt(config_file, cli_options, verbose=False, **kwargs):
+    def format_results(results):
+        lines = []
+        for result in results:
+            unit = result['Unit']
+            timestamp = to_epoch(result['Timestamp'])
+            for statistic in statistics:
+                prefix = prefixes.get((statistic, unit)) or get_prefix(statistic, unit)
+                lines.append('%s%s %d\n' % (prefix, result[statistic], timestamp))
+        return lines
+    return format_results
 
-    # This function is defined in here so that the decorator can take CLI options, passed in from main()
-    # we'll re-use the interval to sleep at the bottom of the loop that calls get_metric_statistics.
-    @retry(wait_exponential_multiplier=kwargs.get('interval', None),
-           wait_exponential_max=kwargs.get('max_interval', None),
-           # give up at the point the next cron of this script probably runs; Period is minutes; some_max_delay needs ms
-           stop_max_delay=cli_options['Count'] * cli_options['Period'] * 60 * 1000)
-    def get_metric_statistics(**kwargs):
+
+def write_lines(lines, out=None, stats=None):
+    """Write lines to `out`, which defaults to stdout."""
+    write = (out if out is not None else sys.stdout).write
+    started = time.time()
+    for line in lines:
+        write(line)
+    if stats is not None:
+        stats.add_time('write', time.time() - started)
+        stats.incr('datapoints', len(lines))
+
+
+def compile_output(metric, options):
+    """
+    Build a function that outputs results for `metric`.
+
+    The returned function takes the same `results`, `out` and `stats` as
+    `output_results`.
+    """
+    format_results = compile_formatter(metric, options)
+
+    def emit(results, out=None, stats=None):
+        started = time.time()
+        lines = format_results(results)
+        if stats is not None:
+            stats.add_time('format', time.time() - started)
+        write_lines(lines, out, stats)
+    return emit
+
+
+def output_results(results, metric, options, out=None, stats=None):
+    """
+    Output the results to `out`, which defaults to stdout.
+
+    TODO: add AMPQ support for efficiency
+    """
+    compile_output(metric, options)(results, out, stats)
+
+
+class Stats(object):
+    """
+    Thread-safe counters and timers for how leadbutt itself is doing.
+
+    Times are in seconds, and are added up across workers, so `fetch` can be
+    more than the wall clock time of a run that uses `--workers`.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = {}
+            self.times = {}
+            self.latencies = []
+            self.depths = {}
+
+    def incr(self, name, count=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def add_time(self, phase, seconds):
+        with self.lock:
+            self.times[phase] = self.times.get(phase, 0) + seconds
+
+    def record_depth(self, name, depth):
+        """Record how many items were waiting in a pipeline queue."""
+        with self.lock:
+            count, total, peak = self.depths.get(name, (0, 0, 0))
+            self.depths[name] = (count + 1, total + depth, max(peak, depth))
+
+    def record_call(self, latency):
+        """Record one successful API call."""
+        with self.lock:
+            self.latencies.append(latency)
+            self.times['fetch'] = self.times.get('fetch', 0) + latency
+
+    def output(self, prefix, out=None):
+        """Output everything so far as Graphite lines under `prefix`."""
+        now = time.time()
+        with self.lock:
+            values = [('duration', now - self.started)]
+            values.extend(('time.' + phase, seconds) for phase, seconds in self.times.items())
+            api_calls = self.counters.get('api_calls', 0)
+            values.extend([
+                ('api_calls', api_calls),
+                ('retries', api_calls - self.counters.get('requests', 0)),
+                ('throttles', self.counters.get('throttles', 0)),
+                ('empty_results', self.counters.get('empty_results', 0)),
+                ('skipped', self.counters.get('skipped', 0)),
+                ('datapoints', self.counters.get('datapoints', 0)),
+            ])
+            for name, (count, total, peak) in self.depths.items():
+                values.append(('queue.{0}.mean'.format(name), float(total) / count))
+                values.append(('queue.{0}.max'.format(name), peak))
+            latencies = sorted(self.latencies)
+        if latencies:
+            for percentile in (50, 90, 99):
+                # nearest rank
+                rank = max(0, int(math.ceil(percentile / 100.0 * len(latencies))) - 1)
+                values.append(('latency.p{0}'.format(percentile), latencies[rank]))
+            values.append(('latency.max', latencies[-1]))
+        write = (out if out is not None else sys.stdout).write
+        for name, value in sorted(values):
+            write('{0}.{1} {2} {3}\n'.format(prefix, name, value, int(now)))
+
+
+def get_stdout():
+    """
+    Get a stream for stdout with a large buffer.
+
+    Writing line by line to `sys.stdout` is slow, especially when it's a
+    terminal. Falls back to `sys.stdout` if it isn't a real file.
+    """
+    try:
+        fileno = sys.stdout.fileno()
+    except (AttributeError, ValueError, io.UnsupportedOperation):
+        return sys.stdout
+    return io.open(fileno, 'w', buffering=OUTPUT_BUFFER_SIZE, encoding='utf-8', closefd=False)
+
+
+class RateLimiter(object):
+    """
+    A thread-safe token bucket shared by every request in a run.
+
+    `acquire` reserves a token and sleeps until it is due, so any number of
+    workers calling it make at most `rate` requests per second on average, with
+    bursts of up to `burst` requests.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def reserve(self):
+        """Reserve a token without waiting, and get how many seconds until it's due."""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # tokens can go negative; each caller sleeps off its own debt
+            self.tokens -= 1
+            return -self.tokens / self.rate
+
+    def success(self, latency):
+        """Record a successful request that took `latency` seconds."""
+
+    def throttled(self):
+        """Record a request that CloudWatch throttled."""
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """
+    A `RateLimiter` that tunes its own rate with additive-increase/multiplicative-decrease.
+
+    Every throttled request cuts the shared rate by `decrease`, at most once per
+    `cooldown` seconds so a burst of throttles from in-flight requests counts as
+    one signal. Healthy requests grow the rate by about `increase` requests per
+    second every second, unless latency climbs past twice the best seen so far,
+    which means requests are starting to queue up.
+    """
+    def __init__(self, rate, min_rate=1.0, max_rate=None, increase=5.0, decrease=0.5,
+                 cooldown=1.0):
+        super(AdaptiveRateLimiter, self).__init__(rate)
+        self.min_rate = float(min_rate)
+        self.max_rate = max_rate
+        self.increase = float(increase)
+        self.decrease = float(decrease)
+        self.cooldown = cooldown
+        self.best_latency = None
+        self.last_decrease = 0
+        self.throttle_count = 0
+
+    def success(self, latency):
+        with self.lock:
+            if self.best_latency is None or latency < self.best_latency:
+                self.best_latency = latency
+            if latency > 2 * self.best_latency:
+                return
+            # each request is 1 / rate seconds of traffic
+            rate = self.rate + self.increase / self.rate
+            if self.max_rate is not None:
+                rate = min(rate, self.max_rate)
+            self.rate = rate
+
+    def throttled(self):
+        with self.lock:
+            self.throttle_count += 1
+            now = time.time()
+            if now - self.last_decrease < self.cooldown:
+                return
+            self.last_decrease = now
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+
+
+def is_throttle(exception):
+    """Is this exception CloudWatch telling us to slow down?"""
+    from boto.exception import BotoServerError
+
+    return (isinstance(exception, BotoServerError) and
+            exception.error_code in ('Throttling', 'RequestLimitExceeded'))
+
+
+def to_epoch(dt):
+    """
+    Convert a naive UTC datetime to seconds since the epoch.
+
+    Timestamps from `parse_statistics` are already in seconds, and are
+    returned as they are.
+    """
+    if not isinstance(dt, datetime.datetime):
+        return dt
+    # the same as calendar.timegm(dt.timetuple()), without building a struct_time
+    delta = dt - EPOCH
+    return delta.days * 86400 + delta.seconds
+
+
+def parse_timestamp(value):
+    """Parse a timestamp like 2015-01-31T12:00:00Z from CloudWatch into seconds since the epoch."""
+    days = datetime.date(int(value[0:4]), int(value[5:7]), int(value[8:10])).toordinal()
+    return ((days - EPOCH_ORDINAL) * 86400 + int(value[11:13]) * 3600 +
+            int(value[14:16]) * 60 + int(value[17:19]))
+
+
+DATAPOINTS_RE = re.compile(br'<Datapoints>(.*)</Datapoints>', re.S)
+# every field of a datapoint is a tag with text in it; <member> has tags instead
+FIELD_RE = re.compile(br'<(\w+)>([^<]*)</')
+
+
+def parse_statistics(body):
+    """
+    Parse a GetMetricStatistics response into results, straight from the bytes.
+
+    This skips boto's SAX parser, its `Datapoint` objects and their datetimes,
+    which take most of the time a run spends parsing. Each result is a dict
+    like boto's, except `Timestamp` is seconds since the epoch.
+    """
+    datapoints = DATAPOINTS_RE.search(body)
+    if datapoints is None:
+        return []
+    # the same few names, units and days come up over and over
+    names = {}
+    units = {}
+    days = {}
+    results = []
+    for datapoint in datapoints.group(1).split(b'</member>'):
+        result = {}
+        for name, value in FIELD_RE.findall(datapoint):
+            key = names.get(name)
+            if key is None:
+                key = names[name] = name.decode('utf-8')
+            if key == 'Timestamp':
+                day = days.get(value[:10])
+                if day is None:
+                    day = days[value[:10]] = parse_timestamp(value[:10] + b'T00:00:00')
+                result[key] = (day + int(value[11:13]) * 3600 + int(value[14:16]) * 60 +
+                               int(value[17:19]))
+            elif key == 'Unit':
+                unit = units.get(value)
+                if unit is None:
+                    unit = units[value] = value.decode('utf-8')
+                result[key] = unit
+            else:
+                result[key] = float(value)
+        if result:
+            results.append(result)
+    return results
+
+
+def get_statistics_params(connection, period, start_time, end_time, metric_name, namespace,
+                          statistics, dimensions=None, unit=None):
+    """Build the params for a GetMetricStatistics call the same way boto does."""
+    params = {
+        'Period': period,
+        'MetricName': metric_name,
+        'Namespace': namespace,
+        'StartTime': start_time.isoformat(),
+        'EndTime': end_time.isoformat(),
+    }
+    connection.build_list_params(params, statistics, 'Statistics.member.%d')
+    if dimensions:
+        connection.build_dimension_param(dimensions, params)
+    if unit:
+        params['Unit'] = unit
+    return params
+
+
+def get_metric_statistics(connection, **kwargs):
+    """
+    Call GetMetricStatistics, parsing the response with `parse_statistics`.
+
+    Takes the same keyword arguments as boto's `get_metric_statistics`, which
+    is called instead for anything that isn't a boto CloudWatch connection.
+    """
+    import boto.ec2.cloudwatch
+
+    if not isinstance(connection, boto.ec2.cloudwatch.CloudWatchConnection):
+        return connection.get_metric_statistics(**kwargs)
+    response = connection.make_request(
+        'GetMetricStatistics', get_statistics_params(connection, **kwargs))
+    body = response.read()
+    if response.status != 200:
+        raise connection.ResponseError(response.status, response.reason, body)
+    return parse_statistics(body)
+
+
+def parse_date(value):
+    """Parse a UTC date like 2015-01-31 or 2015-01-31T12:00 into an epoch timestamp."""
+    for date_format in ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return to_epoch(datetime.datetime.strptime(value, date_format))
+        except ValueError:
+            pass
+    sys.stderr.write('ERROR: Could not understand the date {0!r}\n'.format(value))
+    sys.exit(2)
+
+
+def write_json(path, data):
+    """Save `data` to `path` as JSON."""
+    # write then rename so a crash can't leave a truncated file behind; other
+    # processes may be writing the same file
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fp:
+        json.dump(data, fp)
+    os.rename(tmp_path, path)
+
+
+def series_key(metric, statistic, options):
+    """Get a string that identifies one series across runs."""
+    key = [
+        metric['Namespace'],
+        metric['MetricName'],
+        metric['Dimensions'],
+        statistic,
+        options['Period'],
+    ]
+    # only metrics outside the default region need it in their key
+    if options.get('Region'):
+        key.append(options['Region'])
+    return json.dumps(key, sort_keys=True)
+
+
+class State(object):
+    """
+    Bookkeeping that persists between runs in a JSON file.
+
+    `watermarks` maps each `series_key` to the epoch timestamp of the newest
+    datapoint sent for that series. `empty` maps each `request_key` that came
+    back empty last time to [empty responses in a row, epoch timestamp to skip
+    it until, epoch timestamp of the last response].
+    """
+    def __init__(self, path):
+        self.path = path
+        self.watermarks = {}
+        self.empty = {}
+        if os.path.exists(path):
+            with open(path) as fp:
+                data = json.load(fp)
+            self.watermarks = data.get('watermarks', {})
+            self.empty = data.get('empty', {})
+
+    def get_watermark(self, metric, options):
         """
-        A thin wrapper around boto.cloudwatch.connection.get_metric_statistics, for the
-        purpose of adding the @retry decorator
-        :param kwargs:
-        :return:
+        Get the newest timestamp already sent for every statistic of `metric`.
+
+        Returns None if any statistic has never been sent.
         """
-        connection = kwargs.pop('connection')
-        return connection.get_metric_statistics(**kwargs)
+        watermarks = [
+            self.watermarks.get(series_key(metric, statistic, options))
+            for statistic in get_statistics(metric)]
+        if None in watermarks:
+            return None
+        return min(watermarks)
 
-    config = get_config(config_file)
+    def update(self, metric, options, results):
+        """Move the watermarks for `metric` up to the newest of `results`."""
+        if not results:
+            return
+        newest = max(to_epoch(result['Timestamp']) for result in results)
+        for statistic in get_statistics(metric):
+            key = series_key(metric, statistic, options)
+            self.watermarks[key] = max(newest, self.watermarks.get(key, 0))
+
+    def should_skip(self, metric, options):
+        """Check if `metric` has come back empty enough times in a row to skip it this time."""
+        empty = self.empty.get(request_key(metric, options))
+        return empty is not None and time.time() < empty[1]
+
+    def record_fetch(self, metric, options, results):
+        """
+        Keep track of how many times in a row `metric` has come back empty.
+
+        After `EMPTY_THRESHOLD` empty responses in a row it's skipped for one
+        period, then three, then seven, and so on, up to `MAX_EMPTY_BACKOFF`
+        seconds between fetches. As soon as it has data, it's fetched normally.
+        """
+        key = request_key(metric, options)
+        if results:
+            self.empty.pop(key, None)
+            return
+        now = time.time()
+        count = self.empty.get(key, [0])[0] + 1
+        skip_until = 0
+        if count >= EMPTY_THRESHOLD:
+            period = options['Period'] * 60
+            backoff = min(period * 2 ** (count - EMPTY_THRESHOLD + 1), MAX_EMPTY_BACKOFF)
+            # half a period early, so a run that starts a little early isn't skipped too
+            skip_until = now + backoff - period / 2.0
+        self.empty[key] = [count, skip_until, now]
+
+    def save(self):
+        expired = time.time() - STATE_TTL
+        write_json(self.path, {
+            'watermarks': dict(
+                (key, value) for key, value in self.watermarks.items() if value > expired),
+            'empty': dict(
+                (key, value) for key, value in self.empty.items() if value[2] > expired),
+        })
+
+
+class Checkpoint(object):
+    """
+    How far a backfill got, saved in a JSON file so it can carry on from there.
+
+    `done` maps each `request_key` to the epoch timestamp its backfill has
+    reached. A checkpoint for a backfill that started somewhere else is ignored.
+    """
+    def __init__(self, path, start):
+        self.path = path
+        self.start = start
+        self.done = {}
+        if os.path.exists(path):
+            with open(path) as fp:
+                data = json.load(fp)
+            if data.get('from') == start:
+                self.done = data.get('done', {})
+
+    def save(self):
+        write_json(self.path, {'from': self.start, 'done': self.done})
+
+
+def list_dimensions(connection, namespace, metric_name):
+    """Get every set of dimensions CloudWatch has for a metric, following `NextToken`."""
+    dimension_sets = []
+    next_token = None
+    while True:
+        metrics = connection.list_metrics(
+            next_token=next_token, namespace=namespace, metric_name=metric_name)
+        for metric in metrics:
+            dimension_sets.append(dict(
+                (name, values[0]) for name, values in (metric.dimensions or {}).items()))
+        next_token = getattr(metrics, 'next_token', None)
+        if not next_token:
+            return dimension_sets
+
+
+class MetricIndex(object):
+    """
+    The dimensions each metric has, from ListMetrics, optionally saved in a JSON file.
+
+    `entries` maps each JSON [region, namespace, metric name] to when it was
+    listed and the list of dimension sets. Each entry is only listed again
+    once it's older than `ttl` seconds, so a refresh only lists what's stale.
+    """
+    def __init__(self, path=None, ttl=DEFAULT_INDEX_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}
+        self.changed = False
+        if path is not None and os.path.exists(path):
+            with open(path) as fp:
+                self.entries = json.load(fp).get('entries', {})
+
+    def get(self, regions, region, namespace, metric_name):
+        """
+        Get the dimension sets for a metric, listing them if they're missing or stale.
+
+        `regions` is the `RegionPool` to list them with.
+        """
+        key = json.dumps([
+            region or regions.config.get('Auth', {}).get('region', DEFAULT_REGION),
+            namespace,
+            metric_name,
+        ])
+        entry = self.entries.get(key)
+        if entry is None or time.time() - entry['time'] >= self.ttl:
+            connection, limiter = regions.get(region)
+            if limiter is not None:
+                limiter.acquire()
+            entry = self.entries[key] = {
+                'time': time.time(),
+                'dimensions': list_dimensions(connection, namespace, metric_name),
+            }
+            self.changed = True
+        return entry['dimensions']
+
+    def save(self):
+        if self.path is None or not self.changed:
+            return
+        expired = time.time() - STATE_TTL
+        write_json(self.path, {
+            'entries': dict(
+                (key, value) for key, value in self.entries.items() if value['time'] > expired),
+        })
+        self.changed = False
+
+
+def get_statistics(metric):
+    """Get the `Statistics` of a metric as a list."""
+    statistics = metric['Statistics']
+    if not isinstance(statistics, list):
+        statistics = [statistics]
+    return statistics
+
+
+def check_metric(metric):
+    """Exit with an error if a `Metrics` entry is missing something it needs."""
+    missing = [key for key in REQUIRED_METRIC_KEYS if key not in metric]
+    if missing:
+        sys.stderr.write('ERROR: Metric is missing {0}: {1!r}\n'.format(
+            ', '.join(missing), metric))
+        sys.exit(1)
+
+
+def get_metric_requests(config, cli_options):
+    """
+    Flatten `config['Metrics']` into one (metric, options) pair per API call.
+
+    `MetricName` can be a list, so each yielded metric is a copy of the config
+    entry with a single `MetricName` swapped in.
+    """
     config_options = config.get('Options')
+    for metric in config['Metrics']:
+        check_metric(metric)
+        options = get_options(
+            config_options, metric.get('Options'), cli_options)
+        metric_names = metric['MetricName']
+        if not isinstance(metric_names, list):
+            metric_names = [metric_names]
+        for metric_name in metric_names:
+            this_metric = metric.copy()
+            this_metric['MetricName'] = metric_name
+            yield this_metric, options
+
+
+class Spool(object):
+    """
+    An append-only queue on disk for lines that couldn't be sent.
+
+    Lines are appended to numbered segment files in the `path` directory. When
+    the segments add up to more than `max_bytes`, the oldest ones are deleted.
+    """
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, segment_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes or max(1, max_bytes // 10)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def segments(self):
+        """Get the paths of the segment files, oldest first."""
+        return [os.path.join(self.path, name) for name in sorted(os.listdir(self.path))
+                if name.endswith('.spool')]
+
+    def append(self, lines):
+        segments = self.segments()
+        if segments and os.path.getsize(segments[-1]) < self.segment_bytes:
+            segment = segments[-1]
+        else:
+            number = int(os.path.basename(segments[-1]).split('.')[0]) + 1 if segments else 0
+            segment = os.path.join(self.path, '{0:010d}.spool'.format(number))
+        with io.open(segment, 'a', encoding='utf-8') as fp:
+            fp.writelines(lines)
+        self.evict()
+
+    def evict(self):
+        """Delete the oldest segments until the spool fits in `max_bytes`."""
+        segments = self.segments()
+        total = sum(os.path.getsize(segment) for segment in segments)
+        # never delete the segment being written to
+        while total > self.max_bytes and len(segments) > 1:
+            oldest = segments.pop(0)
+            total -= os.path.getsize(oldest)
+            os.remove(oldest)
+
+    def replay(self, send, batch_size):
+        """Pass the spooled lines to `send` in batches, oldest first, deleting them as they go."""
+        for segment in self.segments():
+            with io.open(segment, encoding='utf-8') as fp:
+                lines = fp.readlines()
+            for i in range(0, len(lines), batch_size):
+                send(lines[i:i + batch_size])
+            os.remove(segment)
+
+
+class GraphiteSink(object):
+    """
+    A file-like sink that sends lines to carbon over one persistent TCP connection.
+
+    Lines are buffered and sent once `batch_size` lines are waiting or
+    `flush_interval` seconds have passed since the last send. If the connection
+    drops, the sink reconnects with exponential backoff and resends the whole
+    batch; Graphite overwrites duplicate datapoints, so nothing is lost.
+
+    If Graphite can't be reached at all and there's a `spool`, batches go to
+    the spool instead, and for `max_backoff` seconds after that, new batches
+    go straight to the spool. The spool is replayed, in batches of
+    `replay_batch_size` lines, as soon as a connection is made again.
+    """
+    def __init__(self, host, port, use_pickle=False, batch_size=1000, flush_interval=1.0,
+                 timeout=10, retries=5, backoff=0.5, max_backoff=30, spool=None,
+                 replay_batch_size=10000):
+        self.address = (host, port)
+        self.use_pickle = use_pickle
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.spool = spool
+        self.replay_batch_size = replay_batch_size
+        self.buffer = []
+        self.sock = None
+        self.last_flush = time.time()
+        self.down_until = 0
+
+    def write(self, line):
+        self.buffer.append(line)
+        if (len(self.buffer) >= self.batch_size or
+                time.time() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.time()
+        if not self.buffer:
+            return
+        if self.spool is not None and time.time() < self.down_until:
+            self.spool.append(self.buffer)
+        else:
+            try:
+                self.send(self.encode(self.buffer))
+            except (socket.error, socket.timeout):
+                if self.spool is None:
+                    raise
+                self.spool.append(self.buffer)
+                self.down_until = time.time() + self.max_backoff
+        self.buffer = []
+
+    def encode(self, lines):
+        """Encode lines for the plaintext or pickle protocol."""
+        if not self.use_pickle:
+            return ''.join(lines).encode('utf-8')
+        datapoints = []
+        for line in lines:
+            # the name can have spaces in it if a Formatter or dimension does
+            try:
+                name, value, timestamp = line.rsplit(None, 2)
+                datapoints.append((name, (int(timestamp), float(value))))
+            except ValueError:
+                sys.stderr.write(
+                    'WARNING: Skipping a line carbon can\'t read: {0!r}\n'.format(line))
+        # protocol 2 so carbon can unpickle it no matter which Python it runs
+        payload = pickle.dumps(datapoints, protocol=2)
+        return struct.pack('!L', len(payload)) + payload
+
+    def send(self, payload):
+        attempt = 0
+        while True:
+            try:
+                if self.sock is None:
+                    self.sock = socket.create_connection(self.address, self.timeout)
+                    if self.spool is not None:
+                        # catch up on what we missed before sending anything new
+                        self.spool.replay(
+                            lambda lines: self.sock.sendall(self.encode(lines)),
+                            self.replay_batch_size)
+                self.sock.sendall(payload)
+                return
+            except (socket.error, socket.timeout):
+                self.disconnect()
+                if attempt >= self.retries:
+                    raise
+                time.sleep(min(self.max_backoff, self.backoff * 2 ** attempt))
+                attempt += 1
+
+    def disconnect(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+    def close(self):
+        self.flush()
+        self.disconnect()
+
+
+def get_graphite_sink(address, use_pickle=False, spool=None):
+    """Get a `GraphiteSink` from a host[:port] string."""
+    host, __, port = address.rpartition(':')
+    if not host:
+        host, port = port, None
+    if not port:
+        port = 2004 if use_pickle else 2003
+    return GraphiteSink(host, int(port), use_pickle=use_pickle, spool=spool)
+
+
+def request_key(metric, options):
+    """Get a string that is the same for metrics that make identical API calls."""
+    return json.dumps([
+        metric['Namespace'],
+        metric['MetricName'],
+        metric['Dimensions'],
+        metric.get('Unit'),
+        options['Period'],
+        options['Count'],
+        options.get('Region'),
+    ], sort_keys=True)
+
+
+def coalesce_requests(metric_requests):
+    """
+    Merge metric requests that would make the same API call into one call.
+
+    Entries that only differ by `Statistics` or `Formatter` are fetched once,
+    asking for the union of their statistics.
+
+    Returns a list of (metric, options, consumers) where `metric` and `options`
+    describe the API call and `consumers` lists the original (metric, options)
+    pairs to output the results for.
+    """
+    planned = OrderedDict()
+    for metric, options in metric_requests:
+        key = request_key(metric, options)
+        if key not in planned:
+            planned[key] = (dict(metric, Statistics=[]), options, [])
+        request_metric, __, consumers = planned[key]
+        for statistic in get_statistics(metric):
+            if statistic not in request_metric['Statistics']:
+                request_metric['Statistics'].append(statistic)
+        consumers.append((metric, options))
+    return list(planned.values())
+
+
+def rollup_key(metric, options):
+    """Like `request_key`, but the same for requests that only differ by Period and Count."""
+    return json.dumps([
+        metric['Namespace'],
+        metric['MetricName'],
+        metric['Dimensions'],
+        metric.get('Unit'),
+        options.get('Region'),
+    ], sort_keys=True)
+
+
+def rollup_requests(requests):
+    """
+    Merge planned requests that only differ by `Period` into one request.
+
+    The merged request is for the shortest period, over a window long enough
+    for all of them, and consumers with longer periods get the results rolled
+    up to their period with `rollup`. Requests are left alone unless every
+    period is a multiple of the shortest, the longer ones only want
+    `ROLLUP_STATISTICS`, and the window fits in one request.
+    """
+    groups = OrderedDict()
+    for request in requests:
+        groups.setdefault(rollup_key(request[0], request[1]), []).append(request)
+    merged = []
+    for group in groups.values():
+        shortest = min(group, key=lambda x: x[1]['Period'])
+        period = shortest[1]['Period']
+        longest = max(options['Period'] for __, options, __ in group)
+        # an extra longest period, so the oldest of them isn't missing anything
+        window = max(options['Period'] * options['Count'] for __, options, __ in group) + longest
+        consumers = [consumer for request in group for consumer in request[2]]
+        statistics = []
+        for metric, options in consumers:
+            needed = get_statistics(metric)
+            if options['Period'] != period and 'Average' in needed:
+                needed = needed + ['Sum', 'SampleCount']
+            statistics.extend(x for x in needed if x not in statistics)
+        if (len(group) == 1 or window // period > MAX_DATAPOINTS or
+                any(options['Period'] % period for __, options, __ in group) or
+                any(statistic not in ROLLUP_STATISTICS
+                    for metric, options in consumers if options['Period'] != period
+                    for statistic in get_statistics(metric))):
+            merged.extend(group)
+            continue
+        merged.append((
+            dict(shortest[0], Statistics=statistics),
+            dict(shortest[1], Count=window // period),
+            consumers,
+        ))
+    return merged
+
+
+def rollup(results, period, statistics, start=None):
+    """
+    Combine `results` for a shorter period into results for `period` seconds.
+
+    Periods that began before the `start` epoch timestamp are left out, since
+    some of their datapoints weren't fetched.
+    """
+    buckets = OrderedDict()
+    for result in sorted(results, key=lambda x: x['Timestamp']):
+        timestamp = to_epoch(result['Timestamp'])
+        bucket = timestamp - timestamp % period
+        if start is not None and bucket < start:
+            continue
+        buckets.setdefault((bucket, result['Unit']), []).append(result)
+    rolled = []
+    for (bucket, unit), bucket_results in buckets.items():
+        result = {'Timestamp': datetime.datetime.utcfromtimestamp(bucket), 'Unit': unit}
+        for statistic in statistics:
+            if statistic == 'Minimum':
+                result[statistic] = min(x[statistic] for x in bucket_results)
+            elif statistic == 'Maximum':
+                result[statistic] = max(x[statistic] for x in bucket_results)
+            elif statistic == 'Average':
+                samples = sum(x['SampleCount'] for x in bucket_results)
+                total = sum(x['Sum'] for x in bucket_results)
+                result[statistic] = total / samples if samples else 0.0
+            else:
+                result[statistic] = sum(x[statistic] for x in bucket_results)
+        rolled.append(result)
+    return rolled
+
+
+def get_wildcards(metric):
+    """Get the names of the dimensions of `metric` that are wildcards."""
+    dimensions = metric['Dimensions']
+    if not isinstance(dimensions, dict):
+        return []
+    return [name for name, value in dimensions.items() if value == WILDCARD]
+
+
+def match_dimensions(pattern, dimensions):
+    """Check if a set of `dimensions` from ListMetrics fits the configured `pattern`."""
+    if set(pattern) != set(dimensions):
+        return False
+    for name, value in pattern.items():
+        if value == WILDCARD:
+            continue
+        if dimensions[name] not in (value if isinstance(value, list) else [value]):
+            return False
+    return True
+
+
+def expand_wildcards(requests, regions, index):
+    """
+    Replace each request with wildcard dimensions with one request per match.
+
+    A request matches a set of dimensions CloudWatch has for the same metric
+    in `index` if it has the same dimension names, and the same value for
+    every dimension that isn't a wildcard.
+    """
+    expanded = []
+    for metric, options, consumers in requests:
+        if not get_wildcards(metric):
+            expanded.append((metric, options, consumers))
+            continue
+        dimension_sets = index.get(
+            regions, options.get('Region'), metric['Namespace'], metric['MetricName'])
+        for dimensions in dimension_sets:
+            if match_dimensions(metric['Dimensions'], dimensions):
+                expanded.append((
+                    dict(metric, Dimensions=dimensions),
+                    options,
+                    [(dict(consumer, Dimensions=dimensions), consumer_options)
+                     for consumer, consumer_options in consumers],
+                ))
+    return expanded
+
+
+def get_rate_limiter(**kwargs):
+    """Get the rate limiter for the CLI options, or None to sleep INTERVAL between requests."""
+    interval = kwargs.get('interval', 0)
+    workers = kwargs.get('workers', 1)
+    rate = kwargs.get('rate')
+    adaptive = kwargs.get('adaptive', False)
+    if rate is None and (workers > 1 or adaptive) and interval:
+        rate = 1000.0 / interval
+    if adaptive:
+        return AdaptiveRateLimiter(rate or DEFAULT_RATE, max_rate=kwargs.get('max_rate'))
+    if rate:
+        return RateLimiter(rate)
+    return None
+
+
+def connect(config, verbose=False, region=None):
+    """Connect to CloudWatch using the `Auth` section of the config."""
+    import boto.ec2.cloudwatch
+
     auth_options = config.get('Auth', {})
 
-    region = auth_options.get('region', DEFAULT_REGION)
+    if region is None:
+        region = auth_options.get('region', DEFAULT_REGION)
     connect_args = {
         'debug': 2 if verbose else 0,
     }
@@ -147,55 +1145,1033 @@ def leadbutt(config_file, cli_options, verbose=False, **kwargs):
         connect_args['aws_access_key_id'] = auth_options['aws_access_key_id']
     if 'aws_secret_access_key' in auth_options:
         connect_args['aws_secret_access_key'] = auth_options['aws_secret_access_key']
-    conn = boto.ec2.cloudwatch.connect_to_region(region, **connect_args)
-    for metric in config['Metrics']:
-        options = get_options(
-            config_options, metric.get('Options'), cli_options)
-        period_local = options['Period'] * 60
-        count_local = options['Count']
-        end_time = datetime.datetime.utcnow()
+    return boto.ec2.cloudwatch.connect_to_region(region, **connect_args)
+
+
+class RegionPool(object):
+    """
+    CloudWatch connections and rate limiters, one of each per region.
+
+    `None` is the region from `Auth`, which is connected to right away. Other
+    regions are connected to the first time they're used, and reused after that.
+    Every region gets its own rate limit.
+    """
+    def __init__(self, config, verbose=False, **kwargs):
+        self.config = config
+        self.verbose = verbose
+        self.kwargs = kwargs
+        self.connections = OrderedDict()
+        self.limiters = {}
+        self.lock = threading.Lock()
+        self.get()
+
+    def get(self, region=None):
+        """Get the (connection, limiter) for a region."""
+        with self.lock:
+            if region not in self.connections:
+                started = time.time()
+                self.connections[region] = connect(self.config, self.verbose, region)
+                if self.kwargs.get('stats') is not None:
+                    self.kwargs['stats'].add_time('connect', time.time() - started)
+                self.limiters[region] = get_rate_limiter(**self.kwargs)
+            return self.connections[region], self.limiters[region]
+
+
+def interleave(groups):
+    """Round-robin the items from several lists into one list."""
+    items = []
+    for i in range(max(len(group) for group in groups) if groups else 0):
+        items.extend(group[i] for group in groups if i < len(group))
+    return items
+
+
+class PipelineError(object):
+    """Carries an exception from a pipeline stage to the thread reading its output."""
+    def __init__(self, exception):
+        self.exception = exception
+
+
+PIPELINE_DONE = object()
+
+
+def pipeline(items, fetch, transform, workers=1, queue_size=PIPELINE_QUEUE_SIZE, stats=None):
+    """
+    Run `fetch` then `transform` on `items`, yielding the results in order.
+
+    Each stage runs on its own threads and hands off to the next through a
+    bounded queue: `workers` threads run `fetch`, one thread runs `transform`,
+    and whoever iterates over this generator is the last stage. When a stage
+    falls behind, the queue in front of it fills up and the stages before it
+    wait, so nothing piles up in memory.
+
+    Exceptions from any stage are raised from the generator. If `stats` is
+    given, each queue's depth is recorded every time something is put on it.
+    """
+    import multiprocessing
+    from multiprocessing.pool import ThreadPool
+
+    fetched = queue.Queue(queue_size)
+    transformed = queue.Queue(queue_size)
+    stopped = threading.Event()
+    pool = ThreadPool(workers)
+
+    def put(name, q, item):
+        # keep checking if the consumer went away, instead of blocking forever
+        while not stopped.is_set():
+            try:
+                q.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            if stats is not None:
+                stats.record_depth(name, q.qsize())
+            return
+
+    def get(q):
+        while not stopped.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return PIPELINE_DONE
+
+    def wait(result):
+        while not stopped.is_set():
+            try:
+                return result.get(0.1)
+            except multiprocessing.TimeoutError:
+                continue
+        return PIPELINE_DONE
+
+    def fetch_stage():
+        try:
+            # keep enough requests in flight to keep every worker busy, in order
+            pending = deque()
+            for item in items:
+                pending.append(pool.apply_async(fetch, (item,)))
+                if len(pending) >= max(queue_size, 2 * workers):
+                    put('fetched', fetched, wait(pending.popleft()))
+            while pending:
+                put('fetched', fetched, wait(pending.popleft()))
+            put('fetched', fetched, PIPELINE_DONE)
+        except Exception as e:
+            put('fetched', fetched, PipelineError(e))
+
+    def transform_stage():
+        while not stopped.is_set():
+            item = get(fetched)
+            if item is not PIPELINE_DONE and not isinstance(item, PipelineError):
+                try:
+                    item = transform(item)
+                except Exception as e:
+                    item = PipelineError(e)
+            put('transformed', transformed, item)
+            if item is PIPELINE_DONE or isinstance(item, PipelineError):
+                return
+
+    threads = [threading.Thread(target=fetch_stage), threading.Thread(target=transform_stage)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        while True:
+            item = transformed.get()
+            if item is PIPELINE_DONE:
+                break
+            if isinstance(item, PipelineError):
+                raise item.exception
+            yield item
+    finally:
+        stopped.set()
+        pool.terminate()
+
+
+def get_caller(cli_options, **kwargs):
+    """
+    Build a function that makes one API call, with retries, rate limiting and stats.
+
+    The function takes (func, limiter, **params), and returns `func(**params)`
+    once `limiter` lets it through.
+    """
+    from retrying import retry
+
+    stats = kwargs.get('stats')
+
+    # This function is defined in here so that the decorator can take CLI options, passed in from main()
+    # we'll re-use the interval to sleep at the bottom of the loop that calls get_metric_statistics.
+    @retry(wait_exponential_multiplier=kwargs.get('interval', None),
+           wait_exponential_max=kwargs.get('max_interval', None),
+           # give up at the point the next cron of this script probably runs; Period is minutes; some_max_delay needs ms
+           stop_max_delay=cli_options.get('Count', DEFAULT_OPTIONS['Count']) *
+           cli_options.get('Period', DEFAULT_OPTIONS['Period']) * 60 * 1000)
+    def call(func, limiter, **params):
+        if limiter is not None:
+            limiter.acquire()
+        if stats is not None:
+            stats.incr('api_calls')
+        started = time.time()
+        try:
+            results = func(**params)
+        except Exception as e:
+            if is_throttle(e):
+                if limiter is not None:
+                    limiter.throttled()
+                if stats is not None:
+                    stats.incr('throttles')
+            raise
+        latency = time.time() - started
+        if limiter is not None:
+            limiter.success(latency)
+        if stats is not None:
+            stats.record_call(latency)
+        return results
+    return call
+
+
+def get_fetcher(regions, cli_options, **kwargs):
+    """
+    Build a function that fetches one metric between two times.
+
+    The function takes (metric, options, start_time, end_time) and returns the
+    results from GetMetricStatistics, with retries, rate limiting and stats.
+    """
+    interval = kwargs.get('interval', 0)
+    stats = kwargs.get('stats')
+    call = get_caller(cli_options, **kwargs)
+
+    def fetch(metric, options, start_time, end_time):
+        conn, limiter = regions.get(options.get('Region'))
+        if stats is not None:
+            stats.incr('requests')
+        results = call(
+            get_metric_statistics,
+            limiter,
+            connection=conn,
+            period=options['Period'] * 60,
+            start_time=start_time,
+            end_time=end_time,
+            metric_name=metric['MetricName'],
+            namespace=metric['Namespace'],
+            statistics=metric['Statistics'],
+            dimensions=metric['Dimensions'],
+            # if 'Unit 'is in the config, request only that; else get all units
+            unit=metric.get('Unit'),
+        )
+        if stats is not None and not results:
+            stats.incr('empty_results')
+        if limiter is None:
+            time.sleep(interval / 1000.0)
+        return results
+    return fetch
+
+
+def can_batch(metric):
+    """
+    Check if `metric` can be fetched with GetMetricData.
+
+    GetMetricData doesn't say what unit its results are in, so only metrics
+    with a `Unit` can be, and it needs one value for each dimension.
+    """
+    dimensions = metric['Dimensions']
+    return bool(metric.get('Unit')) and isinstance(dimensions, dict) and all(
+        isinstance(value, (text_type, str)) for value in dimensions.values())
+
+
+def get_batches(requests, size=MAX_METRIC_DATA_QUERIES):
+    """
+    Group planned requests into GetMetricData calls of up to `size` queries.
+
+    Each statistic of a request is one query, and every query in a call is
+    for the same region and the same length of time. Returns a list of
+    (requests, options), where `options` are the first request's options.
+    """
+    groups = OrderedDict()
+    for request in requests:
+        metric, options, __ = request
+        queries = len(get_statistics(metric))
+        batches = groups.setdefault(
+            (options.get('Region'), options['Period'] * options['Count']), [])
+        if not batches or batches[-1][1] + queries > size:
+            batches.append(([], 0))
+        batch, batch_size = batches[-1]
+        batch.append(request)
+        batches[-1] = (batch, batch_size + queries)
+    return [(batch, batch[0][1]) for batches in groups.values() for batch, __ in batches]
+
+
+def get_metric_data(connection, queries, start_time, end_time, next_token=None):
+    """
+    Make one GetMetricData call, which boto 2 doesn't have a method for.
+
+    `queries` is a list of (id, metric, statistic, period), with the period in
+    seconds. Returns ({id: [(timestamp, value), ...]}, next_token), with
+    timestamps in seconds since the epoch.
+    """
+    from xml.etree import ElementTree
+
+    params = {
+        'StartTime': start_time.isoformat(),
+        'EndTime': end_time.isoformat(),
+        'ScanBy': 'TimestampAscending',
+    }
+    if next_token:
+        params['NextToken'] = next_token
+    for i, (query_id, metric, statistic, period) in enumerate(queries, 1):
+        prefix = 'MetricDataQueries.member.{0}.'.format(i)
+        params[prefix + 'Id'] = query_id
+        params[prefix + 'MetricStat.Metric.Namespace'] = metric['Namespace']
+        params[prefix + 'MetricStat.Metric.MetricName'] = metric['MetricName']
+        for j, (name, value) in enumerate(sorted(metric['Dimensions'].items()), 1):
+            dimension = '{0}MetricStat.Metric.Dimensions.member.{1}.'.format(prefix, j)
+            params[dimension + 'Name'] = name
+            params[dimension + 'Value'] = value
+        params[prefix + 'MetricStat.Period'] = period
+        params[prefix + 'MetricStat.Stat'] = statistic
+        params[prefix + 'MetricStat.Unit'] = metric['Unit']
+    response = connection.make_request('GetMetricData', params, verb='POST')
+    body = response.read()
+    if response.status != 200:
+        raise connection.ResponseError(response.status, response.reason, body)
+    root = ElementTree.fromstring(body)
+    xmlns = root.tag[:root.tag.index('}') + 1] if root.tag.startswith('{') else ''
+    result = root.find(xmlns + 'GetMetricDataResult')
+    data = {}
+    for member in result.find(xmlns + 'MetricDataResults').findall(xmlns + 'member'):
+        timestamps = [parse_timestamp(x.text) for x in member.find(xmlns + 'Timestamps')]
+        values = [float(x.text) for x in member.find(xmlns + 'Values')]
+        data.setdefault(member.findtext(xmlns + 'Id'), []).extend(zip(timestamps, values))
+    return data, result.findtext(xmlns + 'NextToken')
+
+
+def get_batch_fetcher(regions, cli_options, **kwargs):
+    """
+    Build a function that fetches many metrics at once with GetMetricData.
+
+    The function takes (requests, start_time, end_time) for requests from one
+    of `get_batches`, and returns a list with the results for each request,
+    shaped like GetMetricStatistics results, following every `NextToken`.
+    """
+    interval = kwargs.get('interval', 0)
+    stats = kwargs.get('stats')
+    call = get_caller(cli_options, **kwargs)
+
+    def fetch(requests, start_time, end_time):
+        conn, limiter = regions.get(requests[0][1].get('Region'))
+        queries = []
+        for i, (metric, options, __) in enumerate(requests):
+            for j, statistic in enumerate(get_statistics(metric)):
+                queries.append(('q{0}_{1}'.format(i, j), metric, statistic, options['Period'] * 60))
+        data = {}
+        next_token = None
+        while True:
+            # each page is one call, so retries still come out as api_calls - requests
+            if stats is not None:
+                stats.incr('requests')
+            page, next_token = call(
+                get_metric_data, limiter, connection=conn, queries=queries,
+                start_time=start_time, end_time=end_time, next_token=next_token)
+            for query_id, values in page.items():
+                data.setdefault(query_id, []).extend(values)
+            if limiter is None:
+                time.sleep(interval / 1000.0)
+            if not next_token:
+                break
+
+        fetched = []
+        for i, (metric, options, __) in enumerate(requests):
+            statistics = get_statistics(metric)
+            by_time = OrderedDict()
+            for j, statistic in enumerate(statistics):
+                for timestamp, value in data.get('q{0}_{1}'.format(i, j), []):
+                    by_time.setdefault(timestamp, {})[statistic] = value
+            # like GetMetricStatistics, only times with every statistic
+            results = [
+                dict(values, Timestamp=timestamp, Unit=metric['Unit'])
+                for timestamp, values in sorted(by_time.items())
+                if len(values) == len(statistics)]
+            if stats is not None and not results:
+                stats.incr('empty_results')
+            fetched.append(results)
+        return fetched
+    return fetch
+
+
+def get_workers(requests, workers):
+    """
+    Get the order to fetch `requests` in, and how many workers to use.
+
+    If the requests span several regions, each region gets its own `workers`
+    and the regions are mixed together so they're fetched in parallel.
+    `requests` is a list of items whose second element is the options.
+    """
+    by_region = OrderedDict()
+    for request in requests:
+        by_region.setdefault(request[1].get('Region'), []).append(request)
+    if len(by_region) > 1:
+        # mix the regions together so each region's workers always have work
+        return interleave(list(by_region.values())), workers * len(by_region)
+    return requests, workers
+
+
+def format_for_consumers(results, request, start=None, stats=None, end=None, state=None):
+    """
+    Format `results` for each consumer of a planned request.
+
+    Consumers with a longer `Period` than the request get the results rolled up
+    to their period first, leaving out any that began before `start`. If the
+    request was rolled up, the rest only get their own `Count` periods before
+    the `end` epoch timestamp, and nothing older than their `state` watermark.
+    Returns a list of (metric, options, results, lines).
+    """
+    started = time.time()
+    __, request_options, consumers = request
+    formatted = []
+    for metric, options in consumers:
+        consumer_results = results
+        if options['Period'] != request_options['Period']:
+            consumer_results = rollup(
+                results, options['Period'] * 60, get_statistics(metric), start)
+        elif end is not None and options['Count'] < request_options['Count']:
+            oldest = end - options['Period'] * 60 * options['Count']
+            watermark = state.get_watermark(metric, options) if state is not None else None
+            if watermark is not None:
+                oldest = max(oldest, watermark)
+            consumer_results = [x for x in results if to_epoch(x['Timestamp']) >= oldest]
+        formatted.append((metric, options, consumer_results,
+                          compile_formatter(metric, options)(consumer_results)))
+    if stats is not None:
+        stats.add_time('format', time.time() - started)
+    return formatted
+
+
+def fetch_requests(regions, requests, cli_options, **kwargs):
+    """
+    Fetch planned `requests` and output the results for each of their consumers.
+
+    `regions` is the `RegionPool` to get connections from. With the
+    `metric-data` `engine`, requests that `can_batch` are fetched many at a
+    time with GetMetricData. With the `asyncio` engine, requests are made
+    from an event loop by `leadbutt_aio` instead of from worker threads.
+    """
+    out = kwargs.get('out')
+    state = kwargs.get('state')
+    stats = kwargs.get('stats')
+    fetch_metric = get_fetcher(regions, cli_options, **kwargs)
+
+    def get_window(request, end_time):
+        """Get (start_time, watermark) to fetch a request from, or None to skip it."""
+        metric, options, consumers = request
         start_time = end_time - datetime.timedelta(
-            seconds=period_local * count_local)
-        # if 'Unit 'is in the config, request only that; else get all units
-        unit = metric.get('Unit')
-        metric_names = metric['MetricName']
-        if not isinstance(metric_names, list):
-            metric_names = [metric_names]
-        for metric_name in metric_names:
-            # we need a copy of the metric dict with the MetricName swapped out
-            this_metric = metric.copy()
-            this_metric['MetricName'] = metric_name
-            results = get_metric_statistics(
-                connection=conn,
-                period=period_local,
-                start_time=start_time,
-                end_time=end_time,
-                metric_name=metric_name,
-                namespace=metric['Namespace'],
-                statistics=metric['Statistics'],
-                dimensions=metric['Dimensions'],
-                unit=unit
-            )
-            output_results(results, this_metric, options)
-            time.sleep(kwargs.get('interval', 0) / 1000.0)
+            seconds=options['Period'] * 60 * options['Count'])
+        if state is not None and state.should_skip(metric, options):
+            if stats is not None:
+                stats.incr('skipped')
+            return None
+        watermark = None
+        # rolled up periods need every datapoint in them, so always get the whole window
+        if state is not None and all(x[1]['Period'] == options['Period'] for x in consumers):
+            watermark = state.get_watermark(metric, options)
+        if watermark is not None:
+            # start at the newest datapoint we already sent, since it may have been
+            # a period that was still filling in; if that's outside the window,
+            # there was a gap so fetch the whole window
+            start_time = max(start_time, datetime.datetime.utcfromtimestamp(watermark))
+            if start_time >= end_time:
+                return None
+        return start_time, watermark
+
+    def finish(request, results, start_time, end_time, watermark):
+        if state is not None:
+            state.record_fetch(request[0], request[1], results)
+        if watermark is not None:
+            results = [x for x in results if to_epoch(x['Timestamp']) >= watermark]
+        return results, request, to_epoch(start_time), to_epoch(end_time)
+
+    def fetch_one(request):
+        end_time = datetime.datetime.utcnow()
+        window = get_window(request, end_time)
+        if window is None:
+            return [([], request, None, None)]
+        results = fetch_metric(request[0], request[1], window[0], end_time)
+        return [finish(request, results, window[0], end_time, window[1])]
+
+    def fetch_batch(batch):
+        end_time = datetime.datetime.utcnow()
+        windows = [(request, get_window(request, end_time)) for request in batch[0]]
+        wanted = [(request, window) for request, window in windows if window is not None]
+        if not wanted:
+            return [([], request, None, None) for request in batch[0]]
+        # one window for the whole call; `finish` trims it back to each watermark
+        results = iter(fetch_metrics(
+            [request for request, __ in wanted],
+            min(window[0] for __, window in wanted), end_time))
+        return [
+            ([], request, None, None) if window is None else finish(
+                request, next(results), window[0], end_time, window[1])
+            for request, window in windows]
+
+    def fetch(item):
+        # batches are (requests, options), and requests are (metric, options, consumers)
+        if isinstance(item[0], list):
+            return fetch_batch(item)
+        return fetch_one(item)
+
+    def fetch_async(requests):
+        import leadbutt_aio
+
+        end_time = datetime.datetime.utcnow()
+        windows = [(request, get_window(request, end_time)) for request in requests]
+        results = leadbutt_aio.fetch_all(regions, cli_options, [
+            (request[0], request[1], window[0], end_time)
+            for request, window in windows if window is not None], **kwargs)
+        for request, window in windows:
+            if window is None:
+                yield [([], request, None, None)]
+            else:
+                yield [finish(request, next(results), window[0], end_time, window[1])]
+
+    def format_fetched(fetched):
+        return [
+            formatted
+            for results, request, start, end in fetched
+            for formatted in format_for_consumers(results, request, start, stats, end, state)]
+
+    engine = kwargs.get('engine')
+    if engine == 'asyncio':
+        # results come back in order, so output matches a serial run
+        all_formatted = (format_fetched(fetched) for fetched in fetch_async(requests))
+    else:
+        items = requests
+        if engine == 'metric-data':
+            fetch_metrics = get_batch_fetcher(regions, cli_options, **kwargs)
+            items = [request for request in requests if not can_batch(request[0])]
+            items.extend(get_batches([request for request in requests if can_batch(request[0])]))
+        items, workers = get_workers(items, kwargs.get('workers', 1))
+        all_formatted = pipeline(items, fetch, format_fetched, workers,
+                                 kwargs.get('queue_size', PIPELINE_QUEUE_SIZE), stats)
+    for formatted in all_formatted:
+        for metric, options, results, lines in formatted:
+            write_lines(lines, out, stats)
+            if state is not None:
+                state.update(metric, options, results)
+
+
+def report_rate(regions):
+    """Tell the user what rate each `AdaptiveRateLimiter` settled on."""
+    for region, limiter in sorted(regions.limiters.items(), key=lambda x: x[0] or ''):
+        if isinstance(limiter, AdaptiveRateLimiter):
+            sys.stderr.write(
+                '{0}Settled on {1:.1f} requests/sec after {2} throttled requests\n'.format(
+                    '{0}: '.format(region) if region else '', limiter.rate, limiter.throttle_count))
+
+
+def without_metrics(config):
+    return dict((key, value) for key, value in config.items() if key != 'Metrics')
+
+
+def get_plan(config_file, cli_options, cache_dir=None):
+    """
+    Get the config and the planned requests for it.
+
+    Parsing a big config and merging the options for every metric takes a
+    while, so if `cache_dir` is set, the plan is saved there and reused until
+    the contents of the config (or the CLI options) change.
+
+    Returns (config, requests), where `config` has everything except `Metrics`.
+    """
+    if cache_dir is None:
+        config = get_config(config_file)
+        requests = rollup_requests(coalesce_requests(get_metric_requests(config, cli_options)))
+        return without_metrics(config), requests
+
+    check_config_file(config_file)
+    if config_file == '-':
+        data = sys.stdin.read()
+    else:
+        with open(config_file, 'rb') as fp:
+            data = fp.read()
+    if isinstance(data, text_type):
+        data = data.encode('utf-8')
+    key = hashlib.sha1(data)
+    key.update(json.dumps([cli_options, __version__, sys.version_info[0]]).encode('utf-8'))
+    key = key.hexdigest()
+    # one cache file per config file, so old plans get replaced instead of piling up
+    name = 'stdin' if config_file == '-' else os.path.abspath(config_file)
+    path = os.path.join(
+        cache_dir, hashlib.sha1(name.encode('utf-8')).hexdigest() + '.plan')
+
+    try:
+        with open(path, 'rb') as fp:
+            cached = pickle.load(fp)
+        if cached['key'] == key:
+            return cached['config'], cached['requests']
+    except Exception:
+        # missing, corrupt, or from another version of Python
+        pass
+
+    config = parse_config(data)
+    requests = rollup_requests(coalesce_requests(get_metric_requests(config, cli_options)))
+    config = without_metrics(config)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # other processes may be writing the same plan
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as fp:
+        pickle.dump({'key': key, 'config': config, 'requests': requests}, fp,
+                    pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, path)
+    return config, requests
+
+
+def parse_shard(value):
+    """Parse a --shard like 2/4 into (2, 4). Shards are counted from 1."""
+    try:
+        shard, shards = [int(x) for x in value.split('/')]
+    except ValueError:
+        shard = shards = 0
+    if not 1 <= shard <= shards:
+        sys.stderr.write('ERROR: --shard must look like K/N, with K from 1 to N, not {0!r}\n'
+                         .format(value))
+        sys.exit(2)
+    return shard, shards
+
+
+def get_shard(metric, options, shards):
+    """
+    Get which of `shards` shards a request belongs to, from 1 to `shards`.
+
+    The shard only depends on what series the request is for, so every host
+    and process agrees on it without talking to each other.
+    """
+    key = json.dumps([
+        metric['Namespace'],
+        metric['MetricName'],
+        metric['Dimensions'],
+        metric.get('Unit'),
+        options.get('Region'),
+    ], sort_keys=True)
+    return int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:8], 16) % shards + 1
+
+
+def shard_path(path, shard):
+    """Get the state or checkpoint file for a shard, so shards can share a directory."""
+    if path is None or shard is None:
+        return path
+    return '{0}.{1}'.format(path, shard[0])
+
+
+def select_requests(requests, regions, **kwargs):
+    """
+    Get the requests this process should make.
+
+    Wildcard dimensions are filled in from the `index` (a `MetricIndex`), then
+    only the requests in this process's `shard` are kept, if it has one.
+    """
+    if any(get_wildcards(request[0]) for request in requests):
+        index = kwargs.get('index') or MetricIndex()
+        started = time.time()
+        requests = expand_wildcards(requests, regions, index)
+        index.save()
+        if kwargs.get('stats') is not None:
+            kwargs['stats'].add_time('discover', time.time() - started)
+    shard = kwargs.get('shard')
+    if shard is not None:
+        requests = [
+            request for request in requests
+            if get_shard(request[0], request[1], shard[1]) == shard[0]]
+    return requests
+
+
+def output_stats(**kwargs):
+    """Output leadbutt's own stats, if they were asked for."""
+    stats = kwargs.get('stats')
+    if stats is not None and kwargs.get('stats_prefix'):
+        stats.output(kwargs['stats_prefix'], kwargs.get('out'))
+
+
+def leadbutt(config_file, cli_options, verbose=False, **kwargs):
+    stats = kwargs.get('stats')
+    started = time.time()
+    config, requests = get_plan(config_file, cli_options, kwargs.get('plan_cache'))
+    if stats is not None:
+        stats.add_time('config', time.time() - started)
+    regions = RegionPool(config, verbose, **kwargs)
+    requests = select_requests(requests, regions, **kwargs)
+    fetch_requests(regions, requests, cli_options, **kwargs)
+    report_rate(regions)
+    output_stats(**kwargs)
+
+
+def get_chunks(requests, start, end, checkpoint=None):
+    """
+    Split the time between `start` and `end` into chunks small enough for one request.
+
+    Yields (metric, options, consumers, chunk_start, chunk_end) for each chunk
+    of each request, oldest first, skipping what `checkpoint` says is done.
+    """
+    for metric, options, consumers in requests:
+        period = options['Period'] * 60
+        # line the chunks up with the periods so they don't overlap, and with the
+        # longest period that gets rolled up so none of those get split
+        longest = max(x[1]['Period'] for x in consumers) * 60 if consumers else period
+        size = period * MAX_DATAPOINTS // longest * longest
+        chunk_end = end - end % period
+        chunk_start = start - start % longest
+        if checkpoint is not None:
+            chunk_start = max(chunk_start, checkpoint.done.get(request_key(metric, options), 0))
+        while chunk_start < chunk_end:
+            yield (metric, options, consumers, chunk_start, min(chunk_start + size, chunk_end))
+            chunk_start += size
+
+
+def backfill(config_file, cli_options, verbose=False, **kwargs):
+    """
+    Fetch every metric between the `start` and `end` epoch timestamps.
+
+    Each metric's time range is split into chunks that fit in one request, and
+    the chunks are fetched concurrently. Each series is still output oldest
+    first. If `checkpoint` is set, it's saved every `CHECKPOINT_INTERVAL`
+    seconds, and chunks it says are done are skipped.
+    """
+    out = kwargs.get('out')
+    state = kwargs.get('state')
+    stats = kwargs.get('stats')
+    checkpoint = kwargs.get('checkpoint')
+    started = time.time()
+    config, requests = get_plan(config_file, cli_options, kwargs.get('plan_cache'))
+    if stats is not None:
+        stats.add_time('config', time.time() - started)
+    regions = RegionPool(config, verbose, **kwargs)
+    requests = select_requests(requests, regions, **kwargs)
+    fetch_metric = get_fetcher(regions, cli_options, **kwargs)
+
+    def fetch(chunk):
+        metric, options, consumers, chunk_start, chunk_end = chunk
+        results = fetch_metric(
+            metric, options,
+            datetime.datetime.utcfromtimestamp(chunk_start),
+            datetime.datetime.utcfromtimestamp(chunk_end))
+        return sorted(results, key=lambda x: x['Timestamp']), chunk
+
+    def format_chunk(fetched):
+        results, chunk = fetched
+        return chunk, format_for_consumers(results, chunk[:3], chunk[3], stats)
+
+    chunks, workers = get_workers(
+        list(get_chunks(requests, kwargs['start'], kwargs['end'], checkpoint)),
+        kwargs.get('workers', 1))
+    saved = time.time()
+    # chunks come back in order, so each series is output in timestamp order
+    for chunk, formatted in pipeline(chunks, fetch, format_chunk, workers,
+                                     kwargs.get('queue_size', PIPELINE_QUEUE_SIZE), stats):
+        for metric, options, results, lines in formatted:
+            write_lines(lines, out, stats)
+            if state is not None:
+                state.update(metric, options, results)
+        if checkpoint is not None:
+            checkpoint.done[request_key(chunk[0], chunk[1])] = chunk[4]
+            if time.time() - saved > CHECKPOINT_INTERVAL:
+                # only checkpoint what's definitely been sent
+                (out or sys.stdout).flush()
+                checkpoint.save()
+                saved = time.time()
+    (out or sys.stdout).flush()
+    if checkpoint is not None:
+        checkpoint.save()
+    report_rate(regions)
+    output_stats(**kwargs)
+
+
+def next_run_time(period, now, delay):
+    """
+    Get when to next fetch a metric with a `period` in seconds.
+
+    Runs line up with the end of each period, plus `delay` seconds for
+    CloudWatch to publish the datapoint for the period that just ended.
+    """
+    return (int(now - delay) // period + 1) * period + delay
+
+
+def daemon(config_file, cli_options, verbose=False, **kwargs):
+    """
+    Keep running, fetching each metric once per `Period`.
+
+    The config is only loaded once, and the connection is kept open. Send
+    SIGHUP to reload the config; metrics that didn't change keep their
+    schedule. SIGTERM and SIGINT stop after the current round of requests.
+    """
+    delay = kwargs.get('delay', DEFAULT_DELAY)
+    out = kwargs.get('out')
+    state = kwargs.get('state')
+    stats = kwargs.get('stats')
+    signals = {'reload': True, 'stop': False}
+
+    def on_hup(signum, frame):
+        signals['reload'] = True
+
+    def on_stop(signum, frame):
+        signals['stop'] = True
+
+    signal.signal(signal.SIGHUP, on_hup)
+    signal.signal(signal.SIGTERM, on_stop)
+    signal.signal(signal.SIGINT, on_stop)
+
+    # keep the index between rounds, so wildcards are only listed again when it's stale
+    kwargs['index'] = kwargs.get('index') or MetricIndex()
+    auth = regions = requests = planned = None
+    schedule = {}
+    replan_at = 0
+    while not signals['stop']:
+        if signals['reload'] or time.time() >= replan_at:
+            reload_config, signals['reload'] = signals['reload'], False
+            started = time.time()
+            try:
+                if reload_config:
+                    config, requests = get_plan(
+                        config_file, cli_options, kwargs.get('plan_cache'))
+                    if config.get('Auth') != auth or regions is None:
+                        new_regions = RegionPool(config, verbose, **kwargs)
+                        auth, regions = config.get('Auth'), new_regions
+                selected = select_requests(requests, regions, **kwargs)
+            except (SystemExit, Exception) as e:
+                # the first load has nothing to fall back on
+                if planned is None:
+                    raise
+                # keep running with the requests we already had
+                sys.stderr.write('ERROR: Could not reload config: {0!r}\n'.format(e))
+            else:
+                planned = OrderedDict(
+                    (request_key(metric, options), (metric, options, consumers))
+                    for metric, options, consumers in selected)
+                # new metrics are due now, removed ones are forgotten
+                schedule = dict((key, schedule.get(key, 0)) for key in planned)
+            if stats is not None:
+                stats.add_time('config', time.time() - started)
+            # fill in wildcards again once what ListMetrics said is stale
+            if any(get_wildcards(request[0]) for request in requests or []):
+                replan_at = time.time() + kwargs['index'].ttl
+            else:
+                replan_at = float('inf')
+
+        now = time.time()
+        due = [key for key in planned if schedule[key] <= now]
+        if due:
+            try:
+                fetch_requests(regions, [planned[key] for key in due], cli_options, **kwargs)
+            except Exception as e:
+                # one bad round shouldn't take the daemon down; try again next period
+                sys.stderr.write('ERROR: {0!r}\n'.format(e))
+            if stats is not None:
+                output_stats(**kwargs)
+                # every round is its own run
+                stats.reset()
+            (out or sys.stdout).flush()
+            if state is not None:
+                state.save()
+            for key in due:
+                schedule[key] = next_run_time(planned[key][1]['Period'] * 60, now, delay)
+            continue
+
+        # sleep in short naps so signals get handled promptly
+        time.sleep(max(0, min(1, min(schedule.values() or [now + 1]) - now)))
+    if regions is not None:
+        report_rate(regions)
+
+
+def shard_kwargs(kwargs, shard):
+    """Get the keyword arguments to run one `shard` with, giving it its own files and stats."""
+    kwargs = dict(kwargs, shard=shard)
+    if kwargs.get('state') is not None:
+        kwargs['state'] = State(shard_path(kwargs['state'].path, shard))
+    if kwargs.get('checkpoint') is not None:
+        checkpoint = kwargs['checkpoint']
+        kwargs['checkpoint'] = Checkpoint(shard_path(checkpoint.path, shard), checkpoint.start)
+    if kwargs.get('stats_prefix'):
+        kwargs['stats_prefix'] = '{0}.shard{1}'.format(kwargs['stats_prefix'], shard[0])
+    return kwargs
+
+
+def relay_lines(fd, out, lock):
+    """
+    Copy whole lines from the file descriptor `fd` to `out` as they come in.
+
+    `out` is flushed whenever there's nothing more to read for now, so a
+    daemon's output is passed on every round rather than when a buffer fills.
+    """
+    partial = b''
+    try:
+        while True:
+            data = os.read(fd, OUTPUT_BUFFER_SIZE)
+            if not data:
+                break
+            lines = (partial + data).split(b'\n')
+            partial = lines.pop()
+            with lock:
+                for line in lines:
+                    out.write(line.decode('utf-8') + '\n')
+                if len(data) < OUTPUT_BUFFER_SIZE:
+                    out.flush()
+    finally:
+        os.close(fd)
+    if partial:
+        with lock:
+            out.write(partial.decode('utf-8'))
+            out.flush()
+
+
+def run_shard(run, write_fd, config_file, cli_options, verbose, kwargs):
+    """Run one shard in a child process, writing its output to `write_fd`."""
+    out = io.open(write_fd, 'w', encoding='utf-8', buffering=OUTPUT_BUFFER_SIZE)
+    try:
+        run(config_file, cli_options, verbose, **dict(kwargs, out=out))
+    finally:
+        out.close()
+    if kwargs.get('state') is not None:
+        kwargs['state'].save()
+
+
+def run_processes(run, processes, config_file, cli_options, verbose=False, **kwargs):
+    """
+    Split the config between `processes` child processes that each `run` one shard.
+
+    Every child's output is passed on to `out` whole lines at a time, so lines
+    from different children never get mixed together. Signals are passed on
+    to the children, so a daemon can still be reloaded and stopped.
+    """
+    import multiprocessing
+
+    out = kwargs.get('out') or sys.stdout
+    lock = threading.Lock()
+    # fork, so the children get the options without having to pickle them
+    if hasattr(multiprocessing, 'get_context'):
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing
+    children = []
+    read_fds = []
+    for shard in range(1, processes + 1):
+        read_fd, write_fd = os.pipe()
+        child = context.Process(target=run_shard, args=(
+            run, write_fd, config_file, cli_options, verbose,
+            shard_kwargs(kwargs, (shard, processes))))
+        child.start()
+        os.close(write_fd)
+        children.append(child)
+        read_fds.append(read_fd)
+    # only start threads once every child is forked, since forking with threads running is unsafe
+    relays = []
+    for read_fd in read_fds:
+        relay = threading.Thread(target=relay_lines, args=(read_fd, out, lock))
+        relay.daemon = True
+        relay.start()
+        relays.append(relay)
+
+    def forward(signum, frame):
+        for child in children:
+            if child.is_alive():
+                os.kill(child.pid, signum)
+
+    for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, forward)
+    for child in children:
+        child.join()
+    for relay in relays:
+        relay.join()
+    failed = [child for child in children if child.exitcode]
+    if failed:
+        sys.stderr.write('ERROR: {0} of {1} processes failed\n'.format(len(failed), processes))
+        sys.exit(1)
 
 
 def main(*args, **kwargs):
     options = docopt(__doc__, version=__version__)
     # help: http://boto.readthedocs.org/en/latest/ref/cloudwatch.html#boto.ec2.cloudwatch.CloudWatchConnection.get_metric_statistics
     config_file = options.pop('--config-file')
-    period = int(options.pop('--period'))
-    count = int(options.pop('-n'))
+    period = options.pop('--period')
+    period = int(period) if period is not None else None
+    count = options.pop('-n')
+    count = int(count) if count is not None else None
     verbose = options.pop('-v')
     cli_options = {}
     if period is not None:
         cli_options['Period'] = period
     if count is not None:
         cli_options['Count'] = count
-    leadbutt(config_file, cli_options, verbose,
-             interval=float(options.pop('-i')),
-             max_interval=float(options.pop('-m'))
-             )
+    run = daemon if options.pop('--daemon') else leadbutt
+    start = options.pop('--from')
+    end = options.pop('--to')
+    checkpoint_file = options.pop('--checkpoint')
+    checkpoint = None
+    if start and run is daemon:
+        sys.stderr.write('ERROR: --from can not be used with --daemon\n')
+        sys.exit(2)
+    if (end or checkpoint_file) and not start:
+        sys.stderr.write('ERROR: --to and --checkpoint only work with --from\n')
+        sys.exit(2)
+    metric_index = options.pop('--metric-index')
+    index = MetricIndex(metric_index, int(options.pop('--metric-index-ttl')))
+    shard = options.pop('--shard')
+    shard = parse_shard(shard) if shard else None
+    processes = int(options.pop('--processes'))
+    if shard is not None and processes > 1:
+        sys.stderr.write('ERROR: --shard can not be used with --processes\n')
+        sys.exit(2)
+    engine = options.pop('--engine')
+    if engine not in ENGINES:
+        sys.stderr.write('ERROR: --engine must be one of {0}, not {1!r}\n'.format(
+            ', '.join(ENGINES), engine))
+        sys.exit(2)
+    if engine == 'asyncio' and sys.version_info < (3, 5):
+        sys.stderr.write('ERROR: --engine asyncio needs Python 3.5 or newer\n')
+        sys.exit(2)
+    if start:
+        run = backfill
+        start = parse_date(start)
+        end = parse_date(end) if end else int(time.time())
+        checkpoint = Checkpoint(checkpoint_file, start) if checkpoint_file else None
+    rate = options.pop('--rate')
+    max_rate = options.pop('--max-rate')
+    graphite = options.pop('--graphite')
+    spool_dir = options.pop('--spool')
+    spool = Spool(spool_dir, int(options.pop('--spool-size')) * 1024 * 1024) if spool_dir else None
+    if graphite:
+        out = get_graphite_sink(graphite, options.pop('--pickle'), spool)
+    else:
+        out = get_stdout()
+    stats_prefix = options.pop('--stats-prefix')
+    state_file = options.pop('--state')
+    run_kwargs = dict(
+        interval=float(options.pop('-i')),
+        max_interval=float(options.pop('-m')),
+        workers=int(options.pop('--workers')),
+        rate=float(rate) if rate is not None else None,
+        adaptive=options.pop('--adaptive'),
+        max_rate=float(max_rate) if max_rate is not None else None,
+        delay=int(options.pop('--delay')),
+        plan_cache=options.pop('--plan-cache'),
+        stats=Stats() if stats_prefix else None,
+        stats_prefix=stats_prefix,
+        out=out,
+        state=State(state_file) if state_file else None,
+        start=start,
+        end=end,
+        checkpoint=checkpoint,
+        index=index,
+        engine=engine,
+    )
+    if shard is not None:
+        run_kwargs = shard_kwargs(run_kwargs, shard)
+    try:
+        if processes > 1:
+            run_processes(run, processes, config_file, cli_options, verbose, **run_kwargs)
+        else:
+            run(config_file, cli_options, verbose, **run_kwargs)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    # only remember what we sent once it's definitely been sent; with
+    # --processes, each process saves its own
+    if run_kwargs['state'] is not None and processes == 1:
+        run_kwargs['state'].save()
 
 
 if __name__ == '__main__':
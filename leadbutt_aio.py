@@ -0,0 +1,276 @@
+# -*- coding: UTF-8 -*-
+"""
+An asyncio engine for leadbutt, for `--engine asyncio`. Python 3.5+ only.
+
+boto 2 connections make one blocking request at a time, so `--workers` needs a
+thread (and a connection) for every request in flight. This sends the same
+GetMetricStatistics requests from one event loop thread instead, over a pool of
+keep-alive connections, so thousands can be in flight at once.
+
+boto is still used to build and sign each request, and responses are parsed
+with `leadbutt.parse_statistics` like the default engine's, so the results are
+formatted exactly the same. Proxies aren't supported.
+"""
+import asyncio
+from collections import deque
+import socket
+import ssl
+import threading
+import time
+
+from leadbutt import (
+    DEFAULT_OPTIONS, PIPELINE_QUEUE_SIZE, get_statistics, get_statistics_params, is_throttle,
+    parse_statistics,
+)
+
+# the default retry wait multiplier and maximum from retrying, in ms
+DEFAULT_WAIT_MULTIPLIER = 1
+DEFAULT_WAIT_MAX = 1073741823
+
+
+class ConnectionPool(object):
+    """
+    Keep-alive HTTP/1.1 connections to one host, reused between requests.
+
+    Connecting, and each request, give up with `socket.timeout` after
+    `timeout` seconds, like boto's connections do.
+    """
+    def __init__(self, host, port, is_secure, timeout=None):
+        self.host = host
+        self.port = port
+        self.ssl = ssl.create_default_context() if is_secure else None
+        self.timeout = timeout
+        self.idle = []
+
+    async def with_timeout(self, coroutine):
+        try:
+            return await asyncio.wait_for(coroutine, self.timeout)
+        except asyncio.TimeoutError:
+            raise socket.timeout('Timed out talking to {0}'.format(self.host))
+
+    async def connect(self):
+        return await self.with_timeout(asyncio.open_connection(
+            self.host, self.port, ssl=self.ssl,
+            server_hostname=self.host if self.ssl else None))
+
+    async def request(self, method, path, headers, body):
+        """Make a request and get the (status, reason, body) of the response."""
+        if self.idle:
+            reader, writer = self.idle.pop()
+            try:
+                response = await self.with_timeout(
+                    self.send(reader, writer, method, path, headers, body))
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # the server closed it while it was idle
+                writer.close()
+                reader, writer, response = await self.request_new(method, path, headers, body)
+            except BaseException:
+                writer.close()
+                raise
+        else:
+            reader, writer, response = await self.request_new(method, path, headers, body)
+        status, reason, data, keep_alive = response
+        if keep_alive:
+            self.idle.append((reader, writer))
+        else:
+            writer.close()
+        return status, reason, data
+
+    async def request_new(self, method, path, headers, body):
+        """Make a request on a new connection, closing it if that fails."""
+        reader, writer = await self.connect()
+        try:
+            response = await self.with_timeout(
+                self.send(reader, writer, method, path, headers, body))
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer, response
+
+    async def send(self, reader, writer, method, path, headers, body):
+        lines = ['{0} {1} HTTP/1.1'.format(method, path)]
+        lines.extend('{0}: {1}'.format(name, value) for name, value in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Connection closed by {0}'.format(self.host))
+        version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) +
+                                   [''])[:3]
+        response_headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+            if not line:
+                break
+            name, __, value = line.partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+        keep_alive = (version == 'HTTP/1.1' and
+                      response_headers.get('connection', '').lower() != 'close')
+        if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                chunk = await reader.readexactly(size + 2)
+                if not size:
+                    break
+                chunks.append(chunk[:-2])
+            data = b''.join(chunks)
+        elif 'content-length' in response_headers:
+            data = await reader.readexactly(int(response_headers['content-length']))
+        else:
+            data = await reader.read()
+            keep_alive = False
+        return int(status), reason, data, keep_alive
+
+    def close(self):
+        while self.idle:
+            self.idle.pop()[1].close()
+
+
+def get_host_header(connection):
+    """Get the Host header httplib would send, since it's part of the signature."""
+    default_port = 443 if connection.is_secure else 80
+    if connection.port == default_port:
+        return connection.host
+    return '{0}:{1}'.format(connection.host, connection.port)
+
+
+class Fetcher(object):
+    """
+    Fetches metrics on an event loop, with retries, rate limiting and stats.
+
+    Takes the same `regions` and options as `leadbutt.get_fetcher`, and up to
+    `workers` requests are in flight at once. Every region's rate limiter is
+    shared with the rest of leadbutt, but waited on without blocking the loop.
+    """
+    def __init__(self, regions, cli_options, **kwargs):
+        self.regions = regions
+        self.interval = kwargs.get('interval', 0)
+        self.wait_multiplier = kwargs.get('interval') or DEFAULT_WAIT_MULTIPLIER
+        self.wait_max = kwargs.get('max_interval') or DEFAULT_WAIT_MAX
+        # give up at the point the next cron of this script probably runs, like the other engines
+        self.stop_max_delay = (cli_options.get('Count', DEFAULT_OPTIONS['Count']) *
+                               cli_options.get('Period', DEFAULT_OPTIONS['Period']) * 60 * 1000)
+        self.workers = kwargs.get('workers', 1)
+        self.stats = kwargs.get('stats')
+        self.pools = {}
+        # made on the loop, which older Pythons bind to when it's made
+        self.slots = None
+
+    def get_pool(self, connection):
+        key = (connection.host, connection.port, connection.is_secure)
+        if key not in self.pools:
+            # boto's http_socket_timeout, 70 seconds unless it's configured
+            self.pools[key] = ConnectionPool(
+                *key, timeout=connection.http_connection_kwargs.get('timeout'))
+        return self.pools[key]
+
+    async def request(self, connection, action, params):
+        """Sign and send one request, and get the body of a successful response."""
+        http_request = connection.build_base_http_request(
+            'POST', '/', None, params, {'Host': get_host_header(connection)}, '',
+            connection.host)
+        http_request.params['Action'] = action
+        http_request.params['Version'] = connection.APIVersion
+        http_request.authorize(connection=connection)
+        body = http_request.body
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        status, reason, data = await self.get_pool(connection).request(
+            'POST', http_request.path, http_request.headers, body)
+        if status != 200:
+            raise connection.ResponseError(status, reason, data)
+        return data
+
+    async def call(self, connection, limiter, action, params):
+        """Make one API call, retrying with exponential backoff like `retrying` does."""
+        started = time.time()
+        attempt = 0
+        while True:
+            attempt += 1
+            if limiter is not None:
+                await asyncio.sleep(max(0, limiter.reserve()))
+            if self.stats is not None:
+                self.stats.incr('api_calls')
+            call_started = time.time()
+            try:
+                data = await self.request(connection, action, params)
+            except Exception as e:
+                if is_throttle(e):
+                    if limiter is not None:
+                        limiter.throttled()
+                    if self.stats is not None:
+                        self.stats.incr('throttles')
+                if (time.time() - started) * 1000 >= self.stop_max_delay:
+                    raise
+                await asyncio.sleep(
+                    min(self.wait_multiplier * 2 ** attempt, self.wait_max) / 1000.0)
+                continue
+            latency = time.time() - call_started
+            if limiter is not None:
+                limiter.success(latency)
+            if self.stats is not None:
+                self.stats.record_call(latency)
+            return data
+
+    async def fetch(self, metric, options, start_time, end_time):
+        """Fetch one metric, like the function from `leadbutt.get_fetcher`."""
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.workers)
+        connection, limiter = self.regions.get(options.get('Region'))
+        params = get_statistics_params(
+            connection,
+            period=options['Period'] * 60,
+            start_time=start_time,
+            end_time=end_time,
+            metric_name=metric['MetricName'],
+            namespace=metric['Namespace'],
+            statistics=get_statistics(metric),
+            dimensions=metric['Dimensions'],
+            # if 'Unit 'is in the config, request only that; else get all units
+            unit=metric.get('Unit'),
+        )
+        async with self.slots:
+            if self.stats is not None:
+                self.stats.incr('requests')
+            data = await self.call(connection, limiter, 'GetMetricStatistics', params)
+            if limiter is None:
+                await asyncio.sleep(self.interval / 1000.0)
+        results = parse_statistics(data)
+        if self.stats is not None and not results:
+            self.stats.incr('empty_results')
+        return results
+
+    async def close(self):
+        for pool in self.pools.values():
+            pool.close()
+
+
+def fetch_all(regions, cli_options, jobs, **kwargs):
+    """
+    Fetch every (metric, options, start_time, end_time) in `jobs`, yielding the results in order.
+
+    The requests are made from an event loop on its own thread, so they keep
+    going while the caller deals with the results, but only so many results
+    are fetched ahead of the caller.
+    """
+    fetcher = Fetcher(regions, cli_options, **kwargs)
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever)
+    thread.daemon = True
+    thread.start()
+    ahead = max(kwargs.get('queue_size', PIPELINE_QUEUE_SIZE), 2 * fetcher.workers)
+    pending = deque()
+    try:
+        for job in jobs:
+            pending.append(asyncio.run_coroutine_threadsafe(fetcher.fetch(*job), loop))
+            if len(pending) >= ahead:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        asyncio.run_coroutine_threadsafe(fetcher.close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
@@ -15,6 +15,7 @@ Examples:
   plumbum elb.yaml.j2 elb us-west-2
   plumbum ec2.yaml.j2 ec2 environment=production
   plumbum ec2.yaml.j2 ec2 us-west-2 environment=production
+  plumbum -r us-east-1,us-west-2 ec2.yaml.j2 ec2,ebs
 
 Outputs to stdout.
 
@@ -23,34 +24,54 @@ About Templates:
 Templates are used to generate config.yml files based on running resources.
 They're written in jinja2, and have these variables available:
 
-  filters    A dictionary of the filters that were passed in
-  region     The region the resource is located in
-  resources  A list of the resources as boto objects
+  filters     A dictionary of the filters that were passed in
+  region      The region the resource is located in
+  resources   The resources as boto objects, which can be looped over once
+  discovered  A list with a dictionary of the namespace, region and resources
+              for each namespace and region
+
+Several namespaces and regions can be separated with commas. They're all listed
+at once, and `resources` has all of them, while `region` is just the first, so
+the template has to use `discovered` to put each resource in the right region.
+
+With --cache, what each namespace and region had is saved, and reused for
+--cache-ttl seconds instead of listing it again. With --output, the config is
+only written when it changed.
+
+The config is written out as it's rendered, instead of all at once, and
+compiled templates are cached in --cache (or a temporary directory).
 """
 from __future__ import unicode_literals
 
 import argparse
+import hashlib
+import io
+from itertools import chain
+import json
+import pickle
 import sys
+import time
 
-import boto
-import boto.dynamodb
-import boto.ec2
-import boto.emr
-import boto.ec2.elb
-import boto.ec2.cloudwatch
-import boto.rds
-import boto.elasticache
-import boto.ec2.autoscale
-import boto.kinesis
-import boto.sqs
-import jinja2
 import os.path
 
+# boto and jinja2 are imported where they're used, so a run only pays to import
+# the one AWS service it lists
+
 from leadbutt import __version__
 
 # DEFAULT_NAMESPACE = 'ec2'  # TODO
 DEFAULT_REGION = 'us-east-1'
 
+# how many requests to make at once, for namespaces and regions, and for
+# sub-requests like each Kinesis stream's shards
+WORKERS = 10
+
+# how long, in seconds, to use cached resources before listing them again
+DEFAULT_CACHE_TTL = 5 * 60
+
+# how much of a file to read at a time when comparing it
+READ_SIZE = 1024 * 1024
+
 
 class CliArgsException(Exception):
     pass
@@ -78,31 +99,79 @@ def filter_key(filter_args):
     return filter_instance
 
 
+def paginate(get_page, token_name):
+    """
+    Yield everything from a paginated boto call, a page at a time.
+
+    `get_page` takes the token for a page (None for the first one), and the
+    token for the next page is the `token_name` attribute of each page.
+    """
+    token = None
+    while True:
+        page = get_page(token)
+        for item in page:
+            yield item
+        token = getattr(page, token_name, None)
+        if not token:
+            return
+
+
+def bounded_map(func, items, workers=WORKERS):
+    """Like `map`, but with up to `workers` calls running at once in threads."""
+    items = list(items)
+    if len(items) < 2:
+        return [func(item) for item in items]
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.terminate()
+
+
 def lookup(instances, filter_by=None):
     if filter_by is not None:
         return list(filter(filter_key(filter_by), instances))
     return instances
 
 
-def interpret_options(args=sys.argv[1:]):
-
+def parse_args(args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--version', action='version', version=__version__)
-    parser.add_argument("-r", "--region", help="AWS region", default=DEFAULT_REGION)
+    parser.add_argument("-r", "--region", help="AWS region, or several separated with commas",
+                        default=DEFAULT_REGION)
     parser.add_argument("-f", "--filter", action='append', default=[],
                         help="filter to apply to AWS objects in key=value form, can be used multiple times")
     parser.add_argument('--token', action='append', help='a key=value pair to use when populating templates')
+    parser.add_argument('-o', '--output', help="write the config to OUTPUT instead of stdout, "
+                        "and leave it alone if it didn't change")
+    parser.add_argument('--cache', metavar='DIR',
+                        help='save what was listed in DIR, and reuse it for --cache-ttl seconds')
+    parser.add_argument('--cache-ttl', metavar='SECONDS', type=int, default=DEFAULT_CACHE_TTL,
+                        help='how long to reuse --cache for (default: %(default)s)')
     parser.add_argument("template", type=str, help="the template to interpret")
-    parser.add_argument("namespace", type=str, help="AWS namespace")
+    parser.add_argument("namespace", type=str,
+                        help="AWS namespace, or several separated with commas")
+    return parser.parse_args(args=args)
+
 
-    args = parser.parse_args(args=args)
+def interpret_options(args=None):
+    """
+    Get (template, namespace, region, filters, tokens) from the command line.
+
+    `args` is either a list of command line arguments, or what `parse_args` got
+    from them.
+    """
+    if not isinstance(args, argparse.Namespace):
+        args = parse_args(args)
 
     # filters are passed in as list of key=values pairs, we need a dictionary to pass to lookup()
     filters = dict([x.split('=', 1) for x in args.filter])
 
     # Support 'ec2' (human friendly) and 'AWS/EC2' (how CloudWatch natively calls these things)
     if args.namespace is not None:  # Just making test pass, argparse will catch this missing.
-        namespace = args.namespace.rsplit('/', 2)[-1].lower()
+        namespace = ','.join(x.rsplit('/', 2)[-1].lower() for x in args.namespace.split(','))
     else:
         namespace = None
     return args.template, namespace, args.region, filters, args.token
@@ -110,8 +179,12 @@ def interpret_options(args=sys.argv[1:]):
 
 def list_billing(region, filter_by_kwargs):
     """List available billing metrics"""
+    import boto.ec2.cloudwatch
+
     conn = boto.ec2.cloudwatch.connect_to_region(region)
-    metrics = conn.list_metrics(metric_name='EstimatedCharges')
+    metrics = list(paginate(
+        lambda token: conn.list_metrics(next_token=token, metric_name='EstimatedCharges'),
+        'next_token'))
     # Filtering is based on metric Dimensions.  Only really valuable one is
     # ServiceName.
     if filter_by_kwargs:
@@ -129,6 +202,8 @@ def list_billing(region, filter_by_kwargs):
 
 def list_cloudfront(region, filter_by_kwargs):
     """List running ec2 instances."""
+    import boto
+
     conn = boto.connect_cloudfront()
     instances = conn.get_all_distributions()
     return lookup(instances, filter_by=filter_by_kwargs)
@@ -136,12 +211,19 @@ def list_cloudfront(region, filter_by_kwargs):
 
 def list_ec2(region, filter_by_kwargs):
     """List running ec2 instances."""
+    import boto.ec2
+
     conn = boto.ec2.connect_to_region(region)
-    instances = conn.get_only_instances()
+    reservations = paginate(
+        lambda token: conn.get_all_reservations(max_results=1000, next_token=token),
+        'next_token')
+    instances = (instance for reservation in reservations for instance in reservation.instances)
     return lookup(instances, filter_by=filter_by_kwargs)
 
 def list_ebs(region, filter_by_kwargs):
     """List running ebs volumes."""
+    import boto.ec2
+
     conn = boto.ec2.connect_to_region(region)
     instances = conn.get_all_volumes()
     return lookup(instances, filter_by=filter_by_kwargs)
@@ -149,20 +231,27 @@ def list_ebs(region, filter_by_kwargs):
 
 def list_elb(region, filter_by_kwargs):
     """List all load balancers."""
+    import boto.ec2.elb
+
     conn = boto.ec2.elb.connect_to_region(region)
-    instances = conn.get_all_load_balancers()
+    instances = paginate(lambda token: conn.get_all_load_balancers(marker=token), 'next_marker')
     return lookup(instances, filter_by=filter_by_kwargs)
 
 
 def list_rds(region, filter_by_kwargs):
     """List all RDS thingys."""
+    import boto.rds
+
     conn = boto.rds.connect_to_region(region)
-    instances = conn.get_all_dbinstances()
+    instances = paginate(
+        lambda token: conn.get_all_dbinstances(max_records=100, marker=token), 'marker')
     return lookup(instances, filter_by=filter_by_kwargs)
 
 
 def list_elasticache(region, filter_by_kwargs):
     """List all ElastiCache Clusters."""
+    import boto.elasticache
+
     conn = boto.elasticache.connect_to_region(region)
     req = conn.describe_cache_clusters()
     data = req["DescribeCacheClustersResponse"]["DescribeCacheClustersResult"]["CacheClusters"]
@@ -175,13 +264,18 @@ def list_elasticache(region, filter_by_kwargs):
 
 def list_autoscaling_group(region, filter_by_kwargs):
     """List all Auto Scaling Groups."""
+    import boto.ec2.autoscale
+
     conn = boto.ec2.autoscale.connect_to_region(region)
-    groups = conn.get_all_groups()
+    groups = paginate(
+        lambda token: conn.get_all_groups(max_records=100, next_token=token), 'next_token')
     return lookup(groups, filter_by=filter_by_kwargs)
 
 
 def list_sqs(region, filter_by_kwargs):
     """List all SQS Queues."""
+    import boto.sqs
+
     conn = boto.sqs.connect_to_region(region)
     queues = conn.get_all_queues()
     return lookup(queues, filter_by=filter_by_kwargs)
@@ -189,29 +283,51 @@ def list_sqs(region, filter_by_kwargs):
 
 def list_kinesis_applications(region, filter_by_kwargs):
     """List all the kinesis applications along with the shards for each stream"""
+    import boto.kinesis
+
     conn = boto.kinesis.connect_to_region(region)
-    streams = conn.list_streams()['StreamNames']
-    kinesis_streams = {}
-    for stream_name in streams:
+    streams = []
+    while True:
+        response = conn.list_streams(
+            exclusive_start_stream_name=streams[-1] if streams else None)
+        streams.extend(response['StreamNames'])
+        if not response.get('HasMoreStreams') or not response['StreamNames']:
+            break
+
+    def list_shards(stream_name):
         shard_ids = []
-        shards = conn.describe_stream(stream_name)['StreamDescription']['Shards']
-        for shard in shards:
-            shard_ids.append(shard['ShardId'])
-        kinesis_streams[stream_name] = shard_ids
-    return kinesis_streams
+        while True:
+            description = conn.describe_stream(
+                stream_name, exclusive_start_shard_id=shard_ids[-1] if shard_ids else None,
+            )['StreamDescription']
+            shard_ids.extend(shard['ShardId'] for shard in description['Shards'])
+            if not description.get('HasMoreShards') or not description['Shards']:
+                return shard_ids
+
+    return dict(zip(streams, bounded_map(list_shards, streams)))
 
 
 def list_dynamodb(region, filter_by_kwargs):
     """List all DynamoDB tables."""
+    import boto.dynamodb
+
     conn = boto.dynamodb.connect_to_region(region)
     tables = conn.list_tables()
     return lookup(tables, filter_by=filter_by_kwargs)
 
 
 def list_emr(region, filter_by_kwargs):
+    import boto.emr
+
     conn = boto.emr.connect_to_region(region)
-    q_list = conn.list_clusters(cluster_states=['WAITING', 'RUNNING'])
-    queues = q_list.clusters
+    queues = []
+    marker = None
+    while True:
+        q_list = conn.list_clusters(cluster_states=['WAITING', 'RUNNING'], marker=marker)
+        queues.extend(q_list.clusters)
+        marker = getattr(q_list, 'marker', None)
+        if not marker:
+            break
     return lookup(queues, filter_by=filter_by_kwargs)
 
 list_resources = {
@@ -230,33 +346,188 @@ list_resources = {
 }
 
 
+class InventoryPickler(pickle.Pickler):
+    """Pickles boto objects without the connections they came from."""
+    def persistent_id(self, obj):
+        from boto.connection import AWSAuthConnection
+
+        if isinstance(obj, AWSAuthConnection):
+            return 'connection'
+        return None
+
+
+class InventoryUnpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        return None
+
+
+def resource_ids(resources):
+    """Get something that identifies each resource, to tell what was added and removed."""
+    if isinstance(resources, dict):
+        return set(resources)
+    return set(
+        getattr(resource, 'id', None) or getattr(resource, 'name', None) or
+        getattr(resource, 'url', None) or repr(resource)
+        for resource in resources)
+
+
+class Inventory(object):
+    """
+    What each namespace and region had, saved in `path` for `ttl` seconds.
+
+    There's one file for each namespace, region and set of filters. Without a
+    `path`, everything is listed every time.
+    """
+    def __init__(self, path=None, ttl=DEFAULT_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+
+    def get_path(self, namespace, region, filters):
+        key = json.dumps([namespace, region, filters], sort_keys=True).encode('utf-8')
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest() + '.inventory')
+
+    def load(self, namespace, region, filters):
+        """Get the last (listed_at, resources, digest), or Nones if there isn't one."""
+        try:
+            with open(self.get_path(namespace, region, filters), 'rb') as fp:
+                data = fp.read()
+            listed_at, resources = InventoryUnpickler(io.BytesIO(data)).load()
+        except Exception:
+            # missing, corrupt, or from another version of Python or boto
+            return None, None, None
+        return listed_at, resources, hashlib.sha1(data).hexdigest()
+
+    def save(self, namespace, region, filters, resources):
+        buf = io.BytesIO()
+        InventoryPickler(buf, pickle.HIGHEST_PROTOCOL).dump((time.time(), resources))
+        data = buf.getvalue()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        path = self.get_path(namespace, region, filters)
+        # other processes may be writing the same file
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as fp:
+            fp.write(data)
+        os.rename(tmp_path, path)
+        return hashlib.sha1(data).hexdigest()
+
+    def get(self, namespace, region, filters):
+        """
+        Get (resources, digest) for a namespace and region, listing them if needed.
+
+        `digest` changes whenever the resources do, and is None without a `path`.
+        When they're listed again, what was added and removed since last time
+        is reported on stderr.
+        """
+        if self.path is None:
+            return list_resources[namespace](region, filters), None
+        listed_at, cached, digest = self.load(namespace, region, filters)
+        if cached is not None and time.time() - listed_at < self.ttl:
+            return cached, digest
+        resources = list_resources[namespace](region, filters)
+        if cached is not None:
+            report_changes(namespace, region, cached, resources)
+        return resources, self.save(namespace, region, filters, resources)
+
+
+def report_changes(namespace, region, old, new):
+    """Tell the user what resources were added and removed."""
+    old_ids, new_ids = resource_ids(old), resource_ids(new)
+    added, removed = sorted(new_ids - old_ids), sorted(old_ids - new_ids)
+    if added or removed:
+        sys.stderr.write('{0} {1}: {2} added{3}, {4} removed{5}\n'.format(
+            namespace, region,
+            len(added), ' ({0})'.format(', '.join(added)) if added else '',
+            len(removed), ' ({0})'.format(', '.join(removed)) if removed else ''))
+
+
+def file_digest(path):
+    """Get the sha1 of the file at `path`, or None if there isn't one."""
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(READ_SIZE), b''):
+                digest.update(block)
+    except IOError:
+        return None
+    return digest.hexdigest()
+
+
+def write_output(path, chunks):
+    """
+    Replace the file at `path` with the text in `chunks`, unless it already has exactly that.
+
+    The chunks are written as they come, so the whole text is never in memory.
+    Returns whether the file changed.
+    """
+    # write then rename, so whatever's reading the config never sees half of it
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    digest = hashlib.sha1()
+    try:
+        with open(tmp_path, 'wb') as fp:
+            for chunk in chunks:
+                data = chunk.encode('utf-8')
+                digest.update(data)
+                fp.write(data)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    if file_digest(path) == digest.hexdigest():
+        os.remove(tmp_path)
+        return False
+    os.rename(tmp_path, path)
+    return True
+
+
 def main():
+    args = parse_args()
+    template, namespace, region, filters, tokens = interpret_options(args)
 
-    template, namespace, region, filters, tokens = interpret_options()
+    import boto.regioninfo
+    import jinja2
+    import jinja2.meta
 
     # get the template first so this can fail before making a network request
     fs_path = os.path.abspath(os.path.dirname(template))
     loader = jinja2.FileSystemLoader(fs_path)
-    jinja2_env = jinja2.Environment(loader=loader)
+    # compiling a big template takes longer than loading it compiled
+    if args.cache:
+        bytecode_dir = os.path.join(args.cache, 'templates')
+        if not os.path.isdir(bytecode_dir):
+            os.makedirs(bytecode_dir)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_dir)
+    else:
+        bytecode_cache = jinja2.FileSystemBytecodeCache()
+    jinja2_env = jinja2.Environment(loader=loader, bytecode_cache=bytecode_cache)
+    template_source = loader.get_source(jinja2_env, os.path.basename(template))[0]
     template = jinja2_env.get_template(os.path.basename(template))
 
     # insure a valid region is set
-    if region not in [r.name for r in boto.ec2.regions()]:
-        raise ValueError("Invalid region:{0}".format(region))
-
-    # should I be using ARNs?
-    try:
-        resources = list_resources[namespace](region, filters)
-    except KeyError:
-        print('ERROR: AWS namespace "{}" not supported or does not exist'
-              .format(namespace))
-        sys.exit(1)
+    regions = region.split(',')
+    valid_regions = [r.name for r in boto.regioninfo.get_regions('ec2')]
+    for name in regions:
+        if name not in valid_regions:
+            raise ValueError("Invalid region:{0}".format(name))
+
+    namespaces = namespace.split(',')
+    for name in namespaces:
+        if name not in list_resources:
+            print('ERROR: AWS namespace "{}" not supported or does not exist'
+                  .format(name))
+            sys.exit(1)
+
+    # only `discovered` says which namespace and region each resource came from
+    if len(namespaces) * len(regions) > 1:
+        variables = jinja2.meta.find_undeclared_variables(jinja2_env.parse(template_source))
+        if 'discovered' not in variables:
+            print('ERROR: templates for several namespaces or regions must use "discovered" '
+                  'to tell them apart')
+            sys.exit(1)
 
     # base tokens
     template_tokens = {
         'filters': filters,
-        'region': region,  # Use for Auth config section if needed
-        'resources': resources,
+        'region': regions[0],  # Use for Auth config section if needed
     }
     # add tokens passed as cli args:
     if tokens is not None:
@@ -266,7 +537,50 @@ def main():
             (key, value) = token_pair.split('=')
             template_tokens[key] = value
 
-    print(template.render(template_tokens))
+    # should I be using ARNs?
+    inventory = Inventory(args.cache, args.cache_ttl)
+    pairs = [(ns, r) for ns in namespaces for r in regions]
+    listed = bounded_map(lambda pair: inventory.get(pair[0], pair[1], filters), pairs)
+    discovered = [
+        {'namespace': ns, 'region': r, 'resources': resources}
+        for (ns, r), (resources, __) in zip(pairs, listed)]
+    resources = discovered[0]['resources']
+    if isinstance(resources, dict):
+        resources = dict(resources)
+        for found in discovered[1:]:
+            resources.update(found['resources'])
+    elif len(discovered) > 1:
+        # no need to copy everything into one big list
+        resources = chain.from_iterable(found['resources'] for found in discovered)
+
+    # skip rendering if nothing that goes into the config changed since it was written
+    fingerprint_path = fingerprint = None
+    digests = [digest for __, digest in listed]
+    if args.output and args.cache and None not in digests:
+        fingerprint = hashlib.sha1(json.dumps(
+            [digests, template_source, template_tokens, __version__], sort_keys=True,
+        ).encode('utf-8')).hexdigest()
+        fingerprint_path = os.path.join(args.cache, hashlib.sha1(
+            os.path.abspath(args.output).encode('utf-8')).hexdigest() + '.output')
+        try:
+            with open(fingerprint_path) as fp:
+                if fp.read() == fingerprint and os.path.exists(args.output):
+                    return
+        except IOError:
+            pass
+
+    template_tokens['resources'] = resources
+    template_tokens['discovered'] = discovered
+    # end with a newline, like print()
+    chunks = chain(template.generate(template_tokens), ['\n'])
+    if not args.output:
+        for chunk in chunks:
+            sys.stdout.write(chunk)
+        return
+    write_output(args.output, chunks)
+    if fingerprint_path is not None:
+        with open(fingerprint_path, 'w') as fp:
+            fp.write(fingerprint)
 
 
 if __name__ == '__main__':
@@ -8,7 +8,7 @@ setup(
     author='Chris Chang',
     author_email='c@crccheck.com',
     url='https://github.com/crccheck/cloudwatch-to-graphite',
-    py_modules=['leadbutt', 'plumbum'],
+    py_modules=['leadbutt', 'leadbutt_aio', 'plumbum'],
     entry_points={
         'console_scripts': [
             'leadbutt = leadbutt:main',
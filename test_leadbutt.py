@@ -6,16 +6,44 @@ WISHLIST: supress chatty stderr and stdout in tests
 """
 from __future__ import unicode_literals
 
+from calendar import timegm
 from subprocess import call
+import subprocess
 import datetime
+import io
 import os
+import pickle
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
+from boto.exception import BotoServerError
 import mock
 
+import fake_aws
 import leadbutt
 
 
+class startupTest(unittest.TestCase):
+    def test_version_does_not_import_heavy_modules(self):
+        # boto alone more than doubles how long it takes to start up
+        output = subprocess.check_output([sys.executable, '-c', (
+            'import sys; sys.argv = ["leadbutt", "--version"]; import leadbutt\n'
+            'try:\n'
+            '    leadbutt.main()\n'
+            'except SystemExit:\n'
+            '    pass\n'
+            'print(sorted(x for x in ("boto", "yaml", "retrying", "multiprocessing")\n'
+            '             if x in sys.modules))\n'
+        )], cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.decode('utf-8').splitlines()[-1], '[]')
+
+
 class get_configTest(unittest.TestCase):
     def test_example_config_loads(self):
         config = leadbutt.get_config('config.yaml.example')
@@ -47,6 +75,48 @@ class get_configTest(unittest.TestCase):
         self.assertTrue(mock_stderr.write.called)
 
 
+class get_planTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+        self.config_file = os.path.join(self.tmpdir, 'config.yaml')
+        shutil.copy('config.yaml.example', self.config_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_plan_matches_uncached(self):
+        cli_options = {'Period': 1, 'Count': 5}
+        expected = leadbutt.get_plan(self.config_file, cli_options)
+        self.assertNotIn('Metrics', expected[0])
+        self.assertEqual(leadbutt.get_plan(self.config_file, cli_options, self.cache_dir), expected)
+        with mock.patch('leadbutt.parse_config') as mock_parse:
+            self.assertEqual(
+                leadbutt.get_plan(self.config_file, cli_options, self.cache_dir), expected)
+        self.assertFalse(mock_parse.called)
+
+    def test_cache_is_replaced_when_config_changes(self):
+        cli_options = {'Period': 1, 'Count': 5}
+        leadbutt.get_plan(self.config_file, cli_options, self.cache_dir)
+        with open(self.config_file, 'a') as fp:
+            fp.write('  Period: 3\n')
+        config, requests = leadbutt.get_plan(self.config_file, {'Count': 5}, self.cache_dir)
+        self.assertEqual(requests[0][1]['Period'], 3)
+        # cli options are part of the key too
+        config, requests = leadbutt.get_plan(self.config_file, cli_options, self.cache_dir)
+        self.assertEqual(requests[0][1]['Period'], 1)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+
+class check_metricTest(unittest.TestCase):
+    @mock.patch('sys.stderr')
+    def test_missing_keys_exit(self, mock_stderr):
+        with self.assertRaises(SystemExit) as e:
+            leadbutt.check_metric({'Namespace': 'AWS/Foo', 'Statistics': 'Sum'})
+        self.assertEqual(e.exception.code, 1)
+        self.assertIn('MetricName, Dimensions', mock_stderr.write.call_args[0][0])
+
+
 class get_optionsTest(unittest.TestCase):
     def test_get_options_returns_right_option(self):
         # only have the defaults
@@ -149,6 +219,80 @@ class output_resultsTest(unittest.TestCase):
         self.assertEqual(
             mock_sysout.write.call_count, len(metric['Statistics']))
 
+    def test_names_follow_the_unit_of_each_result(self):
+        mock_results = [{
+            'Timestamp': datetime.datetime(2015, 1, 1),
+            'Unit': 'Count',
+            'Sum': 1337.0,
+        }, {
+            'Timestamp': datetime.datetime(2015, 1, 1, 0, 1),
+            'Unit': 'Percent',
+            'Sum': 42.0,
+        }]
+        metric = {
+            'Namespace': 'AWS/Foo',
+            'MetricName': 'RequestCount',
+            'Statistics': 'Sum',
+            'Dimensions': {'Krang': 'X'},
+        }
+        out = mock.Mock()
+        options = leadbutt.get_options(None, metric.get('Options'), None)
+        emit = leadbutt.compile_output(metric, options)
+        emit(mock_results, out)
+        emit(mock_results[:1], out)
+        self.assertEqual([x[0][0] for x in out.write.call_args_list], [
+            'cloudwatch.aws.foo.x.requestcount.sum.count 1337.0 1420070400\n',
+            'cloudwatch.aws.foo.x.requestcount.sum.percent 42.0 1420070460\n',
+            'cloudwatch.aws.foo.x.requestcount.sum.count 1337.0 1420070400\n',
+        ])
+
+
+class to_epochTest(unittest.TestCase):
+    def test_matches_timegm(self):
+        for dt in (datetime.datetime(1970, 1, 1), datetime.datetime(2015, 6, 30, 23, 59, 59, 999),
+                   datetime.datetime.utcnow()):
+            self.assertEqual(leadbutt.to_epoch(dt), timegm(dt.timetuple()))
+
+    def test_epoch_seconds_pass_through(self):
+        self.assertEqual(leadbutt.to_epoch(1422705540), 1422705540)
+
+
+class parse_statisticsTest(unittest.TestCase):
+    def test_parse_timestamp(self):
+        for value in ('1970-01-01T00:00:00Z', '2015-01-31T12:34:56Z', '2016-02-29T23:59:59.000Z'):
+            dt = datetime.datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+            self.assertEqual(leadbutt.parse_timestamp(value), timegm(dt.timetuple()))
+            self.assertEqual(leadbutt.parse_timestamp(value.encode('ascii')),
+                             timegm(dt.timetuple()))
+
+    def test_matches_boto(self):
+        import xml.sax
+        from boto.ec2.cloudwatch.datapoint import Datapoint
+        from boto.handler import XmlHandler
+        from boto.resultset import ResultSet
+
+        body = fake_aws.FakeAWS(datapoints=3).action_GetMetricStatistics({
+            'Period': '60',
+            'EndTime': '2015-01-31T12:00:30',
+            'Statistics.member.1': 'Sum',
+            'Statistics.member.2': 'Maximum',
+            'Unit': 'Count/Second',
+        }).encode('utf-8')
+        expected = ResultSet([('member', Datapoint)])
+        xml.sax.parseString(body, XmlHandler(expected, None))
+
+        results = leadbutt.parse_statistics(body)
+        self.assertEqual(len(results), 3)
+        for result, datapoint in zip(results, expected):
+            self.assertEqual(result['Timestamp'], leadbutt.to_epoch(datapoint['Timestamp']))
+            self.assertEqual(dict(result, Timestamp=None), dict(datapoint, Timestamp=None))
+
+    def test_no_datapoints(self):
+        self.assertEqual(leadbutt.parse_statistics(
+            b'<GetMetricStatisticsResponse><GetMetricStatisticsResult><Datapoints/>'
+            b'<Label>CPUUtilization</Label></GetMetricStatisticsResult>'
+            b'</GetMetricStatisticsResponse>'), [])
+
 
 class leadbuttTest(unittest.TestCase):
     @mock.patch('boto.ec2.cloudwatch.connect_to_region')
@@ -167,6 +311,1403 @@ class leadbuttTest(unittest.TestCase):
         self.assertEqual(kwargs['aws_access_key_id'], 'foo')
         self.assertEqual(kwargs['aws_secret_access_key'], 'bar')
 
+    @mock.patch('sys.stdout')
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_workers_output_matches_serial(self, mock_get_config, mock_connect, mock_sysout):
+        mock_get_config.return_value = {
+            'Metrics': [{
+                'Namespace': 'AWS/Foo',
+                'MetricName': ['Metric{0}'.format(i) for i in range(20)],
+                'Statistics': 'Sum',
+                'Dimensions': {'Krang': 'X'},
+            }],
+        }
+
+        def get_metric_statistics(**kwargs):
+            return [{
+                'Timestamp': datetime.datetime(2015, 1, 1),
+                'Unit': 'Count',
+                'Sum': float(kwargs['metric_name'][len('Metric'):]),
+            }]
+        mock_connect.return_value.get_metric_statistics.side_effect = get_metric_statistics
+
+        leadbutt.leadbutt('dummy_config_file', {'Count': 1, 'Period': 5})
+        serial = [x[0][0] for x in mock_sysout.write.call_args_list]
+        mock_sysout.reset_mock()
+        leadbutt.leadbutt('dummy_config_file', {'Count': 1, 'Period': 5},
+                          workers=4, rate=1000)
+        concurrent = [x[0][0] for x in mock_sysout.write.call_args_list]
+        self.assertEqual(len(serial), 20)
+        self.assertEqual(serial, concurrent)
+
+    @mock.patch('sys.stderr')
+    @mock.patch('sys.stdout')
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_adaptive_retries_throttles_and_reports_rate(
+            self, mock_get_config, mock_connect, mock_sysout, mock_stderr):
+        mock_get_config.return_value = {
+            'Metrics': [{
+                'Namespace': 'AWS/Foo',
+                'MetricName': 'RequestCount',
+                'Statistics': 'Sum',
+                'Dimensions': {'Krang': 'X'},
+            }],
+        }
+        throttle = BotoServerError(400, 'Bad Request')
+        throttle.error_code = 'Throttling'
+        mock_connect.return_value.get_metric_statistics.side_effect = [throttle, []]
+
+        leadbutt.leadbutt('dummy_config_file', {'Count': 1, 'Period': 5},
+                          adaptive=True, rate=1000, interval=1)
+        self.assertEqual(mock_connect.return_value.get_metric_statistics.call_count, 2)
+        report = mock_stderr.write.call_args[0][0]
+        self.assertIn('500.0 requests/sec', report)
+        self.assertIn('1 throttled', report)
+
+    @mock.patch('sys.stdout')
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_duplicate_entries_share_one_call(self, mock_get_config, mock_connect, mock_sysout):
+        mock_get_config.return_value = {
+            'Metrics': [{
+                'Namespace': 'AWS/Foo',
+                'MetricName': 'RequestCount',
+                'Statistics': 'Sum',
+                'Dimensions': {'Krang': 'X'},
+            }, {
+                'Namespace': 'AWS/Foo',
+                'MetricName': 'RequestCount',
+                'Statistics': 'Maximum',
+                'Dimensions': {'Krang': 'X'},
+                'Options': {'Formatter': 'tmnt.%(statistic)s'},
+            }],
+        }
+        mock_get_statistics = mock_connect.return_value.get_metric_statistics
+        mock_get_statistics.return_value = [{
+            'Timestamp': datetime.datetime(2015, 1, 1),
+            'Unit': 'Count',
+            'Sum': 1337.0,
+            'Maximum': 9001.0,
+        }]
+
+        leadbutt.leadbutt('dummy_config_file', {'Count': 1, 'Period': 5})
+        self.assertEqual(mock_get_statistics.call_count, 1)
+        self.assertEqual(mock_get_statistics.call_args[1]['statistics'], ['Sum', 'Maximum'])
+        self.assertEqual([x[0][0] for x in mock_sysout.write.call_args_list], [
+            'cloudwatch.aws.foo.x.requestcount.sum.count 1337.0 1420070400\n',
+            'tmnt.maximum 9001.0 1420070400\n',
+        ])
+
+    @mock.patch('sys.stdout')
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_state_narrows_window_and_skips_sent_points(
+            self, mock_get_config, mock_connect, mock_sysout):
+        mock_get_config.return_value = {
+            'Metrics': [{
+                'Namespace': 'AWS/Foo',
+                'MetricName': 'RequestCount',
+                'Statistics': 'Sum',
+                'Dimensions': {'Krang': 'X'},
+            }],
+        }
+        now = datetime.datetime.utcnow().replace(second=0, microsecond=0)
+        points = [{
+            'Timestamp': now - datetime.timedelta(minutes=i),
+            'Unit': 'Count',
+            'Sum': float(i),
+        } for i in range(3)]
+        mock_get_statistics = mock_connect.return_value.get_metric_statistics
+        mock_get_statistics.return_value = points
+        state = mock.Mock(spec=leadbutt.State)
+        state.should_skip.return_value = False
+        state.get_watermark.return_value = leadbutt.to_epoch(points[1]['Timestamp'])
+
+        leadbutt.leadbutt('dummy_config_file', {'Count': 5, 'Period': 1}, state=state)
+        kwargs = mock_get_statistics.call_args[1]
+        self.assertEqual(kwargs['start_time'], points[1]['Timestamp'])
+        # the newest point already sent gets sent again, in case it was still filling in,
+        # along with the point newer than the watermark
+        self.assertEqual(mock_sysout.write.call_count, 2)
+        self.assertIn(' 0.0 ', mock_sysout.write.call_args_list[0][0][0])
+        self.assertIn(' 1.0 ', mock_sysout.write.call_args_list[1][0][0])
+        self.assertEqual(state.update.call_args[0][2], points[:2])
+
+    @mock.patch('sys.stdout')
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_state_skips_metrics_that_keep_coming_back_empty(
+            self, mock_get_config, mock_connect, mock_sysout):
+        mock_get_config.return_value = {
+            'Metrics': [{
+                'Namespace': 'AWS/Foo',
+                'MetricName': ['Empty', 'Full'],
+                'Statistics': 'Sum',
+                'Dimensions': {'Krang': 'X'},
+            }],
+        }
+        mock_get_statistics = mock_connect.return_value.get_metric_statistics
+        mock_get_statistics.return_value = []
+        state = mock.Mock(spec=leadbutt.State)
+        state.get_watermark.return_value = None
+        state.should_skip.side_effect = lambda metric, options: metric['MetricName'] == 'Empty'
+        stats = leadbutt.Stats()
+
+        leadbutt.leadbutt('dummy_config_file', {'Count': 5, 'Period': 1}, state=state,
+                          stats=stats, stats_prefix='leadbutt')
+        self.assertEqual(mock_get_statistics.call_count, 1)
+        self.assertEqual(mock_get_statistics.call_args[1]['metric_name'], 'Full')
+        state.record_fetch.assert_called_once_with(mock.ANY, mock.ANY, [])
+        self.assertIn('leadbutt.skipped 1 ', ''.join(
+            x[0][0] for x in mock_sysout.write.call_args_list))
+
+    @mock.patch('sys.stdout')
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_state_falls_back_to_full_window_after_gap(
+            self, mock_get_config, mock_connect, mock_sysout):
+        mock_get_config.return_value = {
+            'Metrics': [{
+                'Namespace': 'AWS/Foo',
+                'MetricName': 'RequestCount',
+                'Statistics': 'Sum',
+                'Dimensions': {'Krang': 'X'},
+            }],
+        }
+        mock_get_statistics = mock_connect.return_value.get_metric_statistics
+        mock_get_statistics.return_value = []
+        state = mock.Mock(spec=leadbutt.State)
+        state.should_skip.return_value = False
+        state.get_watermark.return_value = leadbutt.to_epoch(datetime.datetime(2015, 1, 1))
+
+        leadbutt.leadbutt('dummy_config_file', {'Count': 5, 'Period': 1}, state=state)
+        kwargs = mock_get_statistics.call_args[1]
+        self.assertEqual(kwargs['end_time'] - kwargs['start_time'], datetime.timedelta(minutes=5))
+
+    @mock.patch('sys.stdout')
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_metrics_can_come_from_several_regions(
+            self, mock_get_config, mock_connect, mock_sysout):
+        mock_get_config.return_value = {
+            'Auth': {'region': 'us-west-2'},
+            'Metrics': [{
+                'Namespace': 'AWS/Foo',
+                'MetricName': 'RequestCount',
+                'Statistics': 'Sum',
+                'Dimensions': {'Krang': 'X'},
+                'Options': {'Region': region},
+            } for region in ('us-east-1', 'eu-west-1', 'us-east-1')] + [{
+                'Namespace': 'AWS/Foo',
+                'MetricName': 'RequestCount',
+                'Statistics': 'Sum',
+                'Dimensions': {'Krang': 'X'},
+            }],
+        }
+        connections = {}
+
+        def connect_to_region(region, **kwargs):
+            connections[region] = mock.Mock()
+            connections[region].get_metric_statistics.return_value = [{
+                'Timestamp': datetime.datetime(2015, 1, 1),
+                'Unit': 'Count',
+                'Sum': 1337.0,
+            }]
+            return connections[region]
+        mock_connect.side_effect = connect_to_region
+
+        leadbutt.leadbutt('dummy_config_file', {'Count': 1, 'Period': 5}, rate=1000)
+        self.assertEqual(sorted(connections), ['eu-west-1', 'us-east-1', 'us-west-2'])
+        for region in connections:
+            # the duplicate us-east-1 entry is coalesced
+            self.assertEqual(connections[region].get_metric_statistics.call_count, 1)
+        self.assertEqual(mock_sysout.write.call_count, 4)
+
+    @mock.patch('sys.stderr')
+    @mock.patch('sys.stdout')
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_stats_are_output_at_the_end(
+            self, mock_get_config, mock_connect, mock_sysout, mock_stderr):
+        mock_get_config.return_value = {
+            'Metrics': [{
+                'Namespace': 'AWS/Foo',
+                'MetricName': ['RequestCount', 'Latency'],
+                'Statistics': 'Sum',
+                'Dimensions': {'Krang': 'X'},
+            }],
+        }
+        throttle = BotoServerError(400, 'Bad Request')
+        throttle.error_code = 'Throttling'
+        mock_connect.return_value.get_metric_statistics.side_effect = [throttle, [{
+            'Timestamp': datetime.datetime(2015, 1, 1),
+            'Unit': 'Count',
+            'Sum': 1337.0,
+        }], []]
+
+        leadbutt.leadbutt('dummy_config_file', {'Count': 1, 'Period': 5}, rate=1000, interval=1,
+                          stats=leadbutt.Stats(), stats_prefix='leadbutt.prod')
+        lines = [x[0][0] for x in mock_sysout.write.call_args_list]
+        self.assertEqual(lines[0],
+                         'cloudwatch.aws.foo.x.requestcount.sum.count 1337.0 1420070400\n')
+        stats = dict(line.split()[:2] for line in lines[1:])
+        self.assertEqual(stats['leadbutt.prod.api_calls'], '3')
+        self.assertEqual(stats['leadbutt.prod.retries'], '1')
+        self.assertEqual(stats['leadbutt.prod.throttles'], '1')
+        self.assertEqual(stats['leadbutt.prod.empty_results'], '1')
+        self.assertEqual(stats['leadbutt.prod.datapoints'], '1')
+        for name in ('duration', 'time.config', 'time.connect', 'time.fetch', 'time.format',
+                     'time.write', 'latency.p50', 'latency.p90', 'latency.p99', 'latency.max'):
+            self.assertIn('leadbutt.prod.' + name, stats)
+
+
+class StatsTest(unittest.TestCase):
+    def test_latency_percentiles(self):
+        stats = leadbutt.Stats()
+        for i in range(1, 101):
+            stats.record_call(i / 100.0)
+        out = mock.Mock()
+        stats.output('lb', out)
+        lines = dict(x[0][0].split()[:2] for x in out.write.call_args_list)
+        self.assertEqual(lines['lb.latency.p50'], '0.5')
+        self.assertEqual(lines['lb.latency.p90'], '0.9')
+        self.assertEqual(lines['lb.latency.p99'], '0.99')
+        self.assertEqual(lines['lb.latency.max'], '1.0')
+
+    def test_reset(self):
+        stats = leadbutt.Stats()
+        stats.incr('api_calls')
+        stats.record_call(1)
+        stats.reset()
+        out = mock.Mock()
+        stats.output('lb', out)
+        lines = dict(x[0][0].split()[:2] for x in out.write.call_args_list)
+        self.assertEqual(lines['lb.api_calls'], '0')
+        self.assertNotIn('lb.latency.max', lines)
+
+
+class pipelineTest(unittest.TestCase):
+    def test_results_come_back_in_order(self):
+        def fetch(x):
+            # later items finish first
+            time.sleep((10 - x) / 1000.0)
+            return x
+        results = list(leadbutt.pipeline(range(10), fetch, lambda x: x * 2, workers=5))
+        self.assertEqual(results, [x * 2 for x in range(10)])
+
+    def test_exceptions_are_raised(self):
+        def fetch(x):
+            if x == 3:
+                raise ValueError('nope')
+            return x
+        with self.assertRaises(ValueError):
+            list(leadbutt.pipeline(range(10), fetch, lambda x: x))
+        with self.assertRaises(KeyError):
+            list(leadbutt.pipeline(range(10), lambda x: x, lambda x: {}[x]))
+
+    def test_slow_consumer_holds_back_fetching(self):
+        fetched = []
+
+        def fetch(x):
+            fetched.append(x)
+            return x
+        stats = leadbutt.Stats()
+        results = leadbutt.pipeline(range(100), fetch, lambda x: x, workers=2, queue_size=2,
+                                    stats=stats)
+        self.assertEqual(next(results), 0)
+        time.sleep(0.1)
+        # a couple in each queue, and a few more in flight
+        self.assertLess(len(fetched), 20)
+        self.assertEqual(list(results), list(range(1, 100)))
+        self.assertEqual(stats.depths['fetched'][2], 2)
+
+
+class RegionPoolTest(unittest.TestCase):
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    def test_connections_are_made_once_per_region(self, mock_connect):
+        regions = leadbutt.RegionPool({'Auth': {'region': 'us-west-2'}}, rate=10)
+        mock_connect.assert_called_once_with('us-west-2', debug=0)
+        conn, limiter = regions.get('eu-west-1')
+        self.assertEqual(mock_connect.call_args[0][0], 'eu-west-1')
+        self.assertEqual(regions.get('eu-west-1'), (conn, limiter))
+        self.assertEqual(mock_connect.call_count, 2)
+        # each region gets its own rate limit
+        self.assertIsNot(regions.get()[1], limiter)
+
+
+class interleaveTest(unittest.TestCase):
+    def test_round_robin(self):
+        self.assertEqual(leadbutt.interleave([[1, 2, 3], ['a'], ['x', 'y']]),
+                         [1, 'a', 'x', 2, 'y', 3])
+        self.assertEqual(leadbutt.interleave([]), [])
+
+
+class next_run_timeTest(unittest.TestCase):
+    def test_runs_line_up_with_periods_plus_delay(self):
+        # 00:01:30 with a 1 minute period and 60 second delay is due at 00:02:00
+        self.assertEqual(leadbutt.next_run_time(60, 90, 60), 120)
+        self.assertEqual(leadbutt.next_run_time(60, 120, 60), 180)
+        self.assertEqual(leadbutt.next_run_time(300, 90, 60), 360)
+        self.assertEqual(leadbutt.next_run_time(300, 360, 60), 660)
+
+
+class match_dimensionsTest(unittest.TestCase):
+    def test_wildcards_match_any_value(self):
+        pattern = {'AutoScalingGroupName': 'web', 'InstanceId': '*'}
+        self.assertTrue(leadbutt.match_dimensions(
+            pattern, {'AutoScalingGroupName': 'web', 'InstanceId': 'i-1'}))
+        self.assertFalse(leadbutt.match_dimensions(
+            pattern, {'AutoScalingGroupName': 'db', 'InstanceId': 'i-1'}))
+        # the dimension names have to be the same too
+        self.assertFalse(leadbutt.match_dimensions(pattern, {'InstanceId': 'i-1'}))
+        self.assertTrue(leadbutt.match_dimensions(
+            {'AutoScalingGroupName': ['web', 'db'], 'InstanceId': '*'},
+            {'AutoScalingGroupName': 'db', 'InstanceId': 'i-1'}))
+
+
+class parse_dateTest(unittest.TestCase):
+    def test_parses_dates_and_times(self):
+        self.assertEqual(leadbutt.parse_date('1970-01-02'), 86400)
+        self.assertEqual(leadbutt.parse_date('1970-01-02T01:00'), 90000)
+        self.assertEqual(leadbutt.parse_date('1970-01-02T01:00:30'), 90030)
+
+    @mock.patch('sys.stderr')
+    def test_bad_date_exits(self, mock_stderr):
+        with self.assertRaises(SystemExit):
+            leadbutt.parse_date('yesterday')
+
+
+class get_chunksTest(unittest.TestCase):
+    metric = {
+        'Namespace': 'AWS/Foo',
+        'MetricName': 'RequestCount',
+        'Statistics': ['Sum'],
+        'Dimensions': {'Krang': 'X'},
+    }
+
+    def test_chunks_fit_in_one_request(self):
+        requests = [(self.metric, {'Period': 1, 'Count': 5}, [])]
+        # two and a half days of one minute periods, not lined up with a period
+        chunks = list(leadbutt.get_chunks(requests, 30, 30 + 60 * 60 * 60))
+        self.assertEqual([(x[3], x[4]) for x in chunks], [
+            (0, 86400),
+            (86400, 172800),
+            (172800, 216000),
+        ])
+
+    def test_chunks_dont_split_rolled_up_periods(self):
+        options = {'Period': 1, 'Count': 5}
+        consumers = [(self.metric, options), (self.metric, {'Period': 7, 'Count': 5})]
+        chunks = list(leadbutt.get_chunks([(self.metric, options, consumers)], 500, 90000))
+        self.assertEqual([(x[3], x[4]) for x in chunks], [
+            (420, 86520),
+            (86520, 90000),
+        ])
+
+    def test_chunks_skip_what_the_checkpoint_says_is_done(self):
+        options = {'Period': 1, 'Count': 5}
+        checkpoint = mock.Mock(done={leadbutt.request_key(self.metric, options): 86400})
+        chunks = list(leadbutt.get_chunks(
+            [(self.metric, options, [])], 0, 3 * 86400, checkpoint))
+        self.assertEqual([(x[3], x[4]) for x in chunks], [
+            (86400, 172800),
+            (172800, 259200),
+        ])
+
+
+class backfillTest(unittest.TestCase):
+    config = {
+        'Metrics': [{
+            'Namespace': 'AWS/Foo',
+            'MetricName': ['Metric0', 'Metric1'],
+            'Statistics': 'Sum',
+            'Dimensions': {'Krang': 'X'},
+        }],
+    }
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_metric_statistics(self, **kwargs):
+        """Every datapoint between the start and end time, newest first."""
+        self.calls.append((kwargs['metric_name'], kwargs['start_time'], kwargs['end_time']))
+        start = leadbutt.to_epoch(kwargs['start_time'])
+        end = leadbutt.to_epoch(kwargs['end_time'])
+        return [{
+            'Timestamp': datetime.datetime.utcfromtimestamp(timestamp),
+            'Unit': 'Count',
+            'Sum': 1.0,
+        } for timestamp in reversed(range(start, end, kwargs['period']))]
+
+    @mock.patch('sys.stdout')
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_backfill_outputs_each_series_in_order(self, mock_get_config, mock_connect,
+                                                   mock_sysout):
+        mock_get_config.return_value = self.config
+        self.calls = []
+        mock_connect.return_value.get_metric_statistics.side_effect = self.get_metric_statistics
+        leadbutt.backfill('dummy_config_file', {'Count': 5, 'Period': 1},
+                          workers=4, rate=1000, start=0, end=3 * 86400)
+
+        # three days of one minute periods is three requests for each metric
+        self.assertEqual(len(self.calls), 6)
+        lines = [x[0][0].split() for x in mock_sysout.write.call_args_list]
+        self.assertEqual(len(lines), 2 * 3 * 1440)
+        for name in ('Metric0', 'Metric1'):
+            timestamps = [int(x[2]) for x in lines if name.lower() in x[0]]
+            self.assertEqual(timestamps, list(range(0, 3 * 86400, 60)))
+
+    @mock.patch('sys.stdout')
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_backfill_resumes_from_checkpoint(self, mock_get_config, mock_connect, mock_sysout):
+        mock_get_config.return_value = self.config
+        path = os.path.join(self.tmpdir, 'checkpoint.json')
+        self.calls = []
+        mock_connect.return_value.get_metric_statistics.side_effect = self.get_metric_statistics
+        write_lines = leadbutt.write_lines
+
+        def interrupt_after_three_chunks(lines, out=None, stats=None):
+            if len(mock_sysout.write.call_args_list) == 3 * 1440:
+                raise KeyboardInterrupt
+            write_lines(lines, out, stats)
+
+        with mock.patch('leadbutt.CHECKPOINT_INTERVAL', -1), \
+                mock.patch('leadbutt.write_lines', side_effect=interrupt_after_three_chunks):
+            with self.assertRaises(KeyboardInterrupt):
+                leadbutt.backfill('dummy_config_file', {'Count': 5, 'Period': 1},
+                                  interval=0, start=0, end=3 * 86400,
+                                  checkpoint=leadbutt.Checkpoint(path, 0))
+
+        self.calls = []
+        leadbutt.backfill('dummy_config_file', {'Count': 5, 'Period': 1},
+                          interval=0, start=0, end=3 * 86400,
+                          checkpoint=leadbutt.Checkpoint(path, 0))
+        # only the chunks that weren't written get fetched again
+        self.assertEqual(self.calls, [
+            ('Metric1', datetime.datetime(1970, 1, 1), datetime.datetime(1970, 1, 2)),
+            ('Metric1', datetime.datetime(1970, 1, 2), datetime.datetime(1970, 1, 3)),
+            ('Metric1', datetime.datetime(1970, 1, 3), datetime.datetime(1970, 1, 4)),
+        ])
+
+        # a backfill from somewhere else starts over
+        self.assertEqual(leadbutt.Checkpoint(path, 86400).done, {})
+
+    @mock.patch('sys.stderr')
+    @mock.patch('leadbutt.leadbutt')
+    @mock.patch('leadbutt.daemon')
+    @mock.patch('leadbutt.backfill')
+    def test_main_backfill_options_need_from(self, mock_backfill, mock_daemon, mock_leadbutt,
+                                             mock_stderr):
+        for argv in (['--from', '2015-01-01', '--daemon'],
+                     ['--to', '2015-01-01'],
+                     ['--checkpoint', 'checkpoint.json']):
+            with mock.patch('sys.argv', ['leadbutt'] + argv):
+                with self.assertRaises(SystemExit) as cm:
+                    leadbutt.main()
+            self.assertEqual(cm.exception.code, 2)
+        self.assertFalse(mock_backfill.called)
+        self.assertFalse(mock_daemon.called)
+        self.assertFalse(mock_leadbutt.called)
+
+
+class shardTest(unittest.TestCase):
+    config = {
+        'Metrics': [{
+            'Namespace': 'AWS/Foo',
+            'MetricName': ['Metric{0}'.format(i) for i in range(30)],
+            'Statistics': 'Sum',
+            'Dimensions': {'Krang': 'X'},
+        }],
+    }
+
+    def get_metric_statistics(self, **kwargs):
+        return [{
+            'Timestamp': datetime.datetime(2015, 1, 1),
+            'Unit': 'Count',
+            'Sum': float(kwargs['metric_name'][len('Metric'):]),
+        }]
+
+    @mock.patch('sys.stderr')
+    def test_parse_shard(self, mock_stderr):
+        self.assertEqual(leadbutt.parse_shard('2/4'), (2, 4))
+        for value in ('0/4', '5/4', '4', 'a/b'):
+            with self.assertRaises(SystemExit):
+                leadbutt.parse_shard(value)
+
+    def test_shards_split_the_config(self):
+        requests = leadbutt.coalesce_requests(
+            leadbutt.get_metric_requests(self.config, {'Period': 1, 'Count': 5}))
+        shards = [leadbutt.get_shard(metric, options, 3) for metric, options, __ in requests]
+        self.assertEqual(set(shards), set([1, 2, 3]))
+        # the period doesn't matter, so the same series always goes to the same shard
+        self.assertEqual(shards, [
+            leadbutt.get_shard(metric, dict(options, Period=5), 3)
+            for metric, options, __ in requests])
+
+    @mock.patch('sys.stdout')
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_shards_add_up_to_a_single_run(self, mock_get_config, mock_connect, mock_sysout):
+        mock_get_config.return_value = self.config
+        mock_connect.return_value.get_metric_statistics.side_effect = self.get_metric_statistics
+        leadbutt.leadbutt('dummy_config_file', {'Count': 5, 'Period': 1})
+        single = [x[0][0] for x in mock_sysout.write.call_args_list]
+        sharded = []
+        for shard in (1, 2, 3):
+            mock_sysout.reset_mock()
+            leadbutt.leadbutt('dummy_config_file', {'Count': 5, 'Period': 1}, shard=(shard, 3))
+            lines = [x[0][0] for x in mock_sysout.write.call_args_list]
+            self.assertTrue(lines)
+            sharded.extend(lines)
+        self.assertEqual(len(single), 30)
+        self.assertEqual(sorted(sharded), sorted(single))
+
+    @mock.patch('leadbutt.signal.signal')
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_processes_add_up_to_a_single_run(self, mock_get_config, mock_connect, mock_signal):
+        mock_get_config.return_value = self.config
+        mock_connect.return_value.get_metric_statistics.side_effect = self.get_metric_statistics
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        state = leadbutt.State(os.path.join(tmpdir, 'state.json'))
+        out = mock.Mock()
+
+        leadbutt.run_processes(leadbutt.leadbutt, 3, 'dummy_config_file',
+                               {'Count': 5, 'Period': 1}, out=out, state=state,
+                               stats=leadbutt.Stats(), stats_prefix='leadbutt')
+        lines = [x[0][0] for x in out.write.call_args_list]
+        self.assertEqual(len([x for x in lines if not x.startswith('leadbutt.')]), 30)
+        # each process has its own stats and state file
+        self.assertEqual(len([x for x in lines if x.startswith('leadbutt.shard2.api_calls ')]), 1)
+        self.assertEqual(sorted(os.listdir(tmpdir)),
+                         ['state.json.1', 'state.json.2', 'state.json.3'])
+
+    def test_relay_lines_passes_lines_on_before_the_pipe_closes(self):
+        read_fd, write_fd = os.pipe()
+        out = mock.Mock()
+        relay = threading.Thread(target=leadbutt.relay_lines,
+                                 args=(read_fd, out, threading.Lock()))
+        relay.daemon = True
+        relay.start()
+        # a daemon's round, then a line split across writes
+        os.write(write_fd, b'a 1 1\nb 2 2\nc')
+        for __ in range(100):
+            if out.flush.called:
+                break
+            time.sleep(0.01)
+        self.assertEqual([x[0][0] for x in out.write.call_args_list], ['a 1 1\n', 'b 2 2\n'])
+        os.write(write_fd, b' 3 3\n')
+        os.close(write_fd)
+        relay.join(5)
+        self.assertEqual([x[0][0] for x in out.write.call_args_list],
+                         ['a 1 1\n', 'b 2 2\n', 'c 3 3\n'])
+
+
+class daemonTest(unittest.TestCase):
+    def metric(self, name, period):
+        return {
+            'Namespace': 'AWS/Foo',
+            'MetricName': name,
+            'Statistics': 'Sum',
+            'Dimensions': {'Krang': 'X'},
+            'Options': {'Period': period},
+        }
+
+    @mock.patch('sys.stdout')
+    @mock.patch('leadbutt.fetch_requests')
+    @mock.patch('leadbutt.connect')
+    @mock.patch('leadbutt.get_config')
+    @mock.patch('leadbutt.signal.signal')
+    @mock.patch('leadbutt.time')
+    def test_metrics_are_fetched_once_per_period(
+            self, mock_time, mock_signal, mock_get_config, mock_connect, mock_fetch, mock_sysout):
+        clock = [0]
+        handlers = {}
+        fetched = []
+        mock_time.time.side_effect = lambda: clock[0]
+        mock_signal.side_effect = lambda signum, handler: handlers.update({signum: handler})
+        mock_get_config.return_value = {
+            'Metrics': [self.metric('Fast', 1), self.metric('Slow', 5)],
+        }
+
+        def sleep(seconds):
+            clock[0] += seconds
+            if clock[0] == 360:
+                # swap out the fast metric, and keep the slow one
+                mock_get_config.return_value = {
+                    'Metrics': [self.metric('New', 1), self.metric('Slow', 5)],
+                }
+                handlers[leadbutt.signal.SIGHUP](leadbutt.signal.SIGHUP, None)
+            if clock[0] >= 600:
+                handlers[leadbutt.signal.SIGTERM](leadbutt.signal.SIGTERM, None)
+        mock_time.sleep.side_effect = sleep
+        mock_fetch.side_effect = lambda conn, requests, *args, **kwargs: fetched.extend(
+            (clock[0], x[0]['MetricName']) for x in requests)
+
+        leadbutt.daemon('dummy_config_file', {'Count': 1}, delay=30)
+        self.assertEqual(mock_get_config.call_count, 2)
+        self.assertEqual(mock_connect.call_count, 1)
+        # the first run is right away, then they line up with the end of each period
+        self.assertEqual([t for t, name in fetched if name == 'Slow'], [0, 30, 330])
+        self.assertEqual(
+            [t for t, name in fetched if name == 'Fast'], [0, 30, 90, 150, 210, 270, 330])
+        self.assertEqual([t for t, name in fetched if name == 'New'], [360, 390, 450, 510, 570])
+
+    @mock.patch('sys.stderr')
+    @mock.patch('sys.stdout')
+    @mock.patch('leadbutt.fetch_requests')
+    @mock.patch('leadbutt.connect')
+    @mock.patch('leadbutt.get_config')
+    @mock.patch('leadbutt.signal.signal')
+    @mock.patch('leadbutt.time')
+    def test_bad_reload_keeps_the_old_config(
+            self, mock_time, mock_signal, mock_get_config, mock_connect, mock_fetch, mock_sysout,
+            mock_stderr):
+        clock = [0]
+        handlers = {}
+        fetched = []
+        mock_time.time.side_effect = lambda: clock[0]
+        mock_signal.side_effect = lambda signum, handler: handlers.update({signum: handler})
+        mock_get_config.return_value = {'Metrics': [self.metric('Fast', 1)]}
+
+        def sleep(seconds):
+            clock[0] += seconds
+            if clock[0] == 120:
+                # like a typo in the YAML
+                mock_get_config.side_effect = SystemExit(1)
+                handlers[leadbutt.signal.SIGHUP](leadbutt.signal.SIGHUP, None)
+            if clock[0] >= 300:
+                handlers[leadbutt.signal.SIGTERM](leadbutt.signal.SIGTERM, None)
+        mock_time.sleep.side_effect = sleep
+        mock_fetch.side_effect = lambda conn, requests, *args, **kwargs: fetched.extend(
+            (clock[0], x[0]['MetricName']) for x in requests)
+
+        leadbutt.daemon('dummy_config_file', {'Count': 1}, delay=30)
+        self.assertEqual(mock_get_config.call_count, 2)
+        self.assertTrue(mock_stderr.write.called)
+        self.assertEqual([t for t, name in fetched], [0, 30, 90, 150, 210, 270])
+
+    @mock.patch('sys.stdout')
+    @mock.patch('leadbutt.fetch_requests')
+    @mock.patch('leadbutt.connect')
+    @mock.patch('leadbutt.get_config')
+    @mock.patch('leadbutt.signal.signal')
+    @mock.patch('leadbutt.time')
+    def test_wildcards_are_filled_in_again_when_stale(
+            self, mock_time, mock_signal, mock_get_config, mock_connect, mock_fetch, mock_sysout):
+        clock = [0]
+        handlers = {}
+        fetched = []
+        mock_time.time.side_effect = lambda: clock[0]
+        mock_signal.side_effect = lambda signum, handler: handlers.update({signum: handler})
+        mock_get_config.return_value = {
+            'Metrics': [dict(self.metric('Fast', 1), Dimensions={'Krang': '*'})],
+        }
+        listed = [['X']]
+        mock_connect.return_value.list_metrics.side_effect = lambda **kwargs: [
+            mock.Mock(dimensions={'Krang': [value]}) for value in listed[0]]
+
+        def sleep(seconds):
+            clock[0] += seconds
+            if clock[0] == 100:
+                listed[0] = ['X', 'Y']
+            if clock[0] >= 300:
+                handlers[leadbutt.signal.SIGTERM](leadbutt.signal.SIGTERM, None)
+        mock_time.sleep.side_effect = sleep
+        mock_fetch.side_effect = lambda conn, requests, *args, **kwargs: fetched.extend(
+            (clock[0], x[0]['Dimensions']['Krang']) for x in requests)
+
+        leadbutt.daemon('dummy_config_file', {'Count': 1}, delay=30,
+                        index=leadbutt.MetricIndex(ttl=120))
+        self.assertEqual(mock_get_config.call_count, 1)
+        self.assertEqual(mock_connect.return_value.list_metrics.call_count, 3)
+        self.assertEqual([t for t, name in fetched if name == 'X'], [0, 30, 90, 150, 210, 270])
+        # Y shows up the next time the index is stale
+        self.assertEqual([t for t, name in fetched if name == 'Y'], [120, 150, 210, 270])
+
+
+class RateLimiterTest(unittest.TestCase):
+    @mock.patch('leadbutt.time')
+    def test_acquire_paces_requests(self, mock_time):
+        mock_time.time.return_value = 100.0
+        limiter = leadbutt.RateLimiter(10)
+        # the first token is free
+        limiter.acquire()
+        self.assertFalse(mock_time.sleep.called)
+        # the next one has to wait a tenth of a second
+        limiter.acquire()
+        self.assertAlmostEqual(mock_time.sleep.call_args[0][0], 0.1)
+        # and the one after that waits behind it
+        limiter.acquire()
+        self.assertAlmostEqual(mock_time.sleep.call_args[0][0], 0.2)
+
+    @mock.patch('leadbutt.time')
+    def test_acquire_refills_over_time(self, mock_time):
+        mock_time.time.return_value = 100.0
+        limiter = leadbutt.RateLimiter(10)
+        limiter.acquire()
+        mock_time.time.return_value = 101.0
+        limiter.acquire()
+        self.assertFalse(mock_time.sleep.called)
+
+
+class AdaptiveRateLimiterTest(unittest.TestCase):
+    def test_throttle_halves_rate_once_per_cooldown(self):
+        limiter = leadbutt.AdaptiveRateLimiter(100)
+        limiter.throttled()
+        limiter.throttled()
+        limiter.throttled()
+        self.assertEqual(limiter.rate, 50)
+        self.assertEqual(limiter.throttle_count, 3)
+
+    def test_throttle_respects_min_rate(self):
+        limiter = leadbutt.AdaptiveRateLimiter(1.5, min_rate=1, cooldown=0)
+        limiter.throttled()
+        limiter.throttled()
+        self.assertEqual(limiter.rate, 1)
+
+    def test_success_ramps_up_to_max_rate(self):
+        limiter = leadbutt.AdaptiveRateLimiter(10, max_rate=11)
+        for __ in range(10):
+            limiter.success(0.1)
+        self.assertAlmostEqual(limiter.rate, 11)
+
+    def test_slow_success_does_not_ramp_up(self):
+        limiter = leadbutt.AdaptiveRateLimiter(10)
+        limiter.success(0.1)
+        rate = limiter.rate
+        limiter.success(0.5)
+        self.assertEqual(limiter.rate, rate)
+
+
+class coalesce_requestsTest(unittest.TestCase):
+    def test_entries_with_the_same_call_are_merged(self):
+        config = {
+            'Metrics': [{
+                'Namespace': 'AWS/ELB',
+                'MetricName': 'Latency',
+                'Statistics': 'Average',
+                'Dimensions': {'LoadBalancerName': 'foo'},
+            }, {
+                'Namespace': 'AWS/ELB',
+                'MetricName': ['Latency', 'RequestCount'],
+                'Statistics': ['Maximum', 'Average'],
+                'Dimensions': {'LoadBalancerName': 'foo'},
+                'Options': {'Formatter': 'elb.%(MetricName)s.%(statistic)s'},
+            }, {
+                # a different period is a different call
+                'Namespace': 'AWS/ELB',
+                'MetricName': 'Latency',
+                'Statistics': 'Average',
+                'Dimensions': {'LoadBalancerName': 'foo'},
+                'Options': {'Period': 5},
+            }],
+        }
+        requests = leadbutt.coalesce_requests(leadbutt.get_metric_requests(config, None))
+        self.assertEqual(len(requests), 3)
+
+        metric, options, consumers = requests[0]
+        self.assertEqual(metric['MetricName'], 'Latency')
+        self.assertEqual(metric['Statistics'], ['Average', 'Maximum'])
+        self.assertEqual(len(consumers), 2)
+        self.assertEqual(consumers[0][0]['Statistics'], 'Average')
+        self.assertEqual(consumers[1][1]['Formatter'], 'elb.%(MetricName)s.%(statistic)s')
+
+        metric, options, consumers = requests[1]
+        self.assertEqual(metric['MetricName'], 'RequestCount')
+        self.assertEqual(len(consumers), 1)
+
+        metric, options, consumers = requests[2]
+        self.assertEqual(options['Period'], 5)
+        self.assertEqual(len(consumers), 1)
+
+
+class rollupTest(unittest.TestCase):
+    metric = {
+        'Namespace': 'AWS/Foo',
+        'MetricName': 'RequestCount',
+        'Dimensions': {'Krang': 'X'},
+    }
+
+    def request(self, period, statistics, count=5):
+        metric = dict(self.metric, Statistics=statistics)
+        options = {'Period': period, 'Count': count}
+        return metric, options, [(metric, options)]
+
+    def test_requests_that_only_differ_by_period_are_merged(self):
+        requests = leadbutt.rollup_requests([
+            self.request(1, ['Maximum']),
+            self.request(5, ['Average']),
+            self.request(15, ['Sum'], count=2),
+        ])
+        self.assertEqual(len(requests), 1)
+        metric, options, consumers = requests[0]
+        self.assertEqual(metric['Statistics'], ['Maximum', 'Average', 'Sum', 'SampleCount'])
+        # enough for the longest window, plus one more of the longest period
+        self.assertEqual(options, {'Period': 1, 'Count': 45})
+        self.assertEqual([x[1]['Period'] for x in consumers], [1, 5, 15])
+
+    def test_requests_that_cant_be_rolled_up_are_left_alone(self):
+        for group in (
+                [self.request(2, ['Sum']), self.request(3, ['Sum'])],
+                [self.request(1, ['Sum']), self.request(5, ['p99'])],
+                [self.request(1, ['Sum']), self.request(60, ['Sum'], count=24)]):
+            self.assertEqual(leadbutt.rollup_requests(group), group)
+
+    def test_rollup(self):
+        start = datetime.datetime(2015, 1, 1)
+        results = [{
+            'Timestamp': start + datetime.timedelta(minutes=i),
+            'Unit': 'Count',
+            'Sum': float(i),
+            'SampleCount': 2.0,
+            'Minimum': float(i),
+            'Maximum': float(i * 2),
+        } for i in reversed(range(1, 10))]
+        rolled = leadbutt.rollup(
+            results, 300, ['Sum', 'SampleCount', 'Minimum', 'Maximum', 'Average'],
+            leadbutt.to_epoch(start))
+        self.assertEqual(rolled, [{
+            'Timestamp': start,
+            'Unit': 'Count',
+            'Sum': 10.0,
+            'SampleCount': 8.0,
+            'Minimum': 1.0,
+            'Maximum': 8.0,
+            'Average': 1.25,
+        }, {
+            'Timestamp': start + datetime.timedelta(minutes=5),
+            'Unit': 'Count',
+            'Sum': 35.0,
+            'SampleCount': 10.0,
+            'Minimum': 5.0,
+            'Maximum': 18.0,
+            'Average': 3.5,
+        }])
+        # periods that started before the window are left out
+        rolled = leadbutt.rollup(results, 300, ['Sum'], leadbutt.to_epoch(start) + 60)
+        self.assertEqual([x['Sum'] for x in rolled], [35.0])
+
+    @mock.patch('sys.stdout')
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_leadbutt_makes_one_call_for_several_periods(
+            self, mock_get_config, mock_connect, mock_sysout):
+        mock_get_config.return_value = {
+            'Metrics': [
+                dict(self.metric, Statistics='Sum', Options={'Period': 1, 'Count': 10}),
+                dict(self.metric, Statistics='Sum', Options={
+                    'Period': 5, 'Count': 2,
+                    'Formatter': 'five.%(MetricName)s.%(statistic)s'}),
+            ],
+        }
+        now = datetime.datetime.utcnow()
+        newest = now.replace(second=0, microsecond=0)
+        mock_get_statistics = mock_connect.return_value.get_metric_statistics
+        mock_get_statistics.return_value = [{
+            'Timestamp': newest - datetime.timedelta(minutes=i),
+            'Unit': 'Count',
+            'Sum': 1.0,
+        } for i in range(15)]
+
+        leadbutt.leadbutt('dummy_config_file', {})
+        self.assertEqual(mock_get_statistics.call_count, 1)
+        kwargs = mock_get_statistics.call_args[1]
+        self.assertEqual(kwargs['period'], 60)
+        self.assertEqual(kwargs['end_time'] - kwargs['start_time'], datetime.timedelta(minutes=15))
+        lines = [x[0][0].split() for x in mock_sysout.write.call_args_list]
+        # only its own 10 periods, even though 15 were fetched for the rollup
+        self.assertEqual(len([x for x in lines if not x[0].startswith('five.')]), 10)
+        five = [x for x in lines if x[0].startswith('five.')]
+        start = leadbutt.to_epoch(kwargs['start_time'])
+        # every five minute period that was completely inside the window
+        self.assertEqual([int(x[2]) for x in five], list(range(
+            start + 300 - start % 300, leadbutt.to_epoch(newest) + 1, 300)))
+        for name, value, timestamp in five[:-1]:
+            self.assertEqual(float(value), 5.0)
+
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_rolled_up_requests_only_send_new_periods_with_state(
+            self, mock_get_config, mock_connect):
+        mock_get_config.return_value = {
+            'Metrics': [
+                dict(self.metric, Statistics='Sum', Options={'Period': 1, 'Count': 5}),
+                dict(self.metric, Statistics='Sum', Options={
+                    'Period': 5, 'Count': 5,
+                    'Formatter': 'five.%(MetricName)s.%(statistic)s'}),
+            ],
+        }
+        newest = datetime.datetime.utcnow().replace(second=0, microsecond=0)
+        mock_connect.return_value.get_metric_statistics.return_value = [{
+            'Timestamp': newest - datetime.timedelta(minutes=i),
+            'Unit': 'Count',
+            'Sum': 1.0,
+        } for i in range(30)]
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        state = leadbutt.State(os.path.join(tmpdir, 'state.json'))
+
+        runs = []
+        for __ in range(2):
+            out = io.StringIO()
+            leadbutt.leadbutt('dummy_config_file', {}, out=out, state=state)
+            runs.append([x for x in out.getvalue().splitlines() if not x.startswith('five.')])
+        self.assertEqual(len(runs[0]), 5)
+        # just the newest period again, since it may have still been filling in
+        self.assertEqual(len(runs[1]), 1)
+
+
+class StateTest(unittest.TestCase):
+    metric = {
+        'Namespace': 'AWS/Foo',
+        'MetricName': 'RequestCount',
+        'Statistics': ['Sum', 'Maximum'],
+        'Dimensions': {'Krang': 'X'},
+    }
+    options = {'Period': 1}
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'state.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_watermark_round_trips(self):
+        now = datetime.datetime.utcnow().replace(second=0, microsecond=0)
+        state = leadbutt.State(self.path)
+        self.assertIsNone(state.get_watermark(self.metric, self.options))
+        state.update(self.metric, self.options, [
+            {'Timestamp': now - datetime.timedelta(minutes=1)},
+            {'Timestamp': now},
+        ])
+        state.save()
+
+        state = leadbutt.State(self.path)
+        self.assertEqual(state.get_watermark(self.metric, self.options), leadbutt.to_epoch(now))
+        # a new statistic has never been sent, so there's no watermark
+        metric = dict(self.metric, Statistics=['Sum', 'Minimum'])
+        self.assertIsNone(state.get_watermark(metric, self.options))
+        # each period is its own series
+        self.assertIsNone(state.get_watermark(self.metric, {'Period': 5}))
+
+    @mock.patch('leadbutt.time')
+    def test_metrics_that_keep_coming_back_empty_are_skipped(self, mock_time):
+        options = {'Period': 1, 'Count': 5}
+        clock = [1000]
+        mock_time.time.side_effect = lambda: clock[0]
+        state = leadbutt.State(self.path)
+
+        def run():
+            """Run once a minute, and say if the metric would get fetched."""
+            clock[0] += 60
+            if state.should_skip(self.metric, options):
+                return False
+            state.record_fetch(self.metric, options, [])
+            return True
+        fetched = [run() for __ in range(20)]
+        # three empty responses, then skip 1, then 3, then 7
+        self.assertEqual(fetched, [
+            True, True, True, False, True, False, False, False, True,
+            False, False, False, False, False, False, False, True, False, False, False])
+
+        state.save()
+        state = leadbutt.State(self.path)
+        self.assertTrue(state.should_skip(self.metric, options))
+        # it gets capped
+        state.empty[leadbutt.request_key(self.metric, options)][0] = 100
+        state.record_fetch(self.metric, options, [])
+        self.assertEqual(
+            state.empty[leadbutt.request_key(self.metric, options)][1] - clock[0],
+            leadbutt.MAX_EMPTY_BACKOFF - 30)
+        # and data coming back resets it
+        state.record_fetch(self.metric, options, [{'Timestamp': datetime.datetime(2015, 1, 1)}])
+        self.assertFalse(state.should_skip(self.metric, options))
+
+    def test_save_forgets_stale_series(self):
+        state = leadbutt.State(self.path)
+        state.update(self.metric, self.options, [{'Timestamp': datetime.datetime(2015, 1, 1)}])
+        state.save()
+        state = leadbutt.State(self.path)
+        self.assertIsNone(state.get_watermark(self.metric, self.options))
+
+
+class GraphiteSinkTest(unittest.TestCase):
+    lines = [
+        'cloudwatch.aws.foo.x.requestcount.sum.count 1337.0 1420070400\n',
+        'cloudwatch.aws.foo.x.requestcount.sum.count 9001.0 1420070460\n',
+    ]
+
+    @mock.patch('socket.create_connection')
+    def test_lines_are_batched(self, mock_connect):
+        sink = leadbutt.GraphiteSink('graphite.local', 2003, batch_size=2, flush_interval=60)
+        sink.write(self.lines[0])
+        self.assertFalse(mock_connect.called)
+        sink.write(self.lines[1])
+        mock_connect.assert_called_once_with(('graphite.local', 2003), 10)
+        mock_sock = mock_connect.return_value
+        mock_sock.sendall.assert_called_once_with(''.join(self.lines).encode('utf-8'))
+        # the connection is reused for the next batch
+        sink.write(self.lines[0])
+        sink.close()
+        self.assertEqual(mock_connect.call_count, 1)
+        self.assertEqual(mock_sock.sendall.call_count, 2)
+        self.assertTrue(mock_sock.close.called)
+
+    def test_pickle_encoding(self):
+        sink = leadbutt.GraphiteSink('graphite.local', 2004, use_pickle=True)
+        payload = sink.encode(self.lines)
+        length, = struct.unpack('!L', payload[:4])
+        self.assertEqual(length, len(payload) - 4)
+        self.assertEqual(pickle.loads(payload[4:]), [
+            ('cloudwatch.aws.foo.x.requestcount.sum.count', (1420070400, 1337.0)),
+            ('cloudwatch.aws.foo.x.requestcount.sum.count', (1420070460, 9001.0)),
+        ])
+
+    @mock.patch('sys.stderr')
+    def test_pickle_encoding_keeps_spaces_and_skips_bad_lines(self, mock_stderr):
+        sink = leadbutt.GraphiteSink('graphite.local', 2004, use_pickle=True)
+        payload = sink.encode(['cloudwatch.my elb.latency 0.5 1420070400\n', 'garbage\n'])
+        self.assertEqual(pickle.loads(payload[4:]), [
+            ('cloudwatch.my elb.latency', (1420070400, 0.5)),
+        ])
+        self.assertTrue(mock_stderr.write.called)
+
+    @mock.patch('time.sleep')
+    @mock.patch('socket.create_connection')
+    def test_reconnects_and_resends(self, mock_connect, mock_sleep):
+        broken_sock = mock.Mock()
+        broken_sock.sendall.side_effect = socket.error('Connection reset by peer')
+        good_sock = mock.Mock()
+        mock_connect.side_effect = [broken_sock, socket.error('Connection refused'), good_sock]
+        sink = leadbutt.GraphiteSink('graphite.local', 2003)
+        sink.write(self.lines[0])
+        sink.close()
+        self.assertTrue(broken_sock.close.called)
+        good_sock.sendall.assert_called_once_with(self.lines[0].encode('utf-8'))
+        self.assertEqual([x[0][0] for x in mock_sleep.call_args_list], [0.5, 1.0])
+
+    @mock.patch('time.sleep')
+    @mock.patch('socket.create_connection')
+    def test_gives_up_after_retries(self, mock_connect, mock_sleep):
+        mock_connect.side_effect = socket.error('Connection refused')
+        sink = leadbutt.GraphiteSink('graphite.local', 2003, retries=2)
+        sink.write(self.lines[0])
+        with self.assertRaises(socket.error):
+            sink.close()
+        self.assertEqual(mock_connect.call_count, 3)
+
+    @mock.patch('time.sleep')
+    @mock.patch('socket.create_connection')
+    def test_spools_while_down_and_replays_when_back(self, mock_connect, mock_sleep):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        spool = leadbutt.Spool(tmpdir)
+        mock_connect.side_effect = socket.error('Connection refused')
+        sink = leadbutt.GraphiteSink('graphite.local', 2003, retries=1, spool=spool)
+        sink.write(self.lines[0])
+        sink.close()
+        self.assertEqual(mock_connect.call_count, 2)
+        # while it's down, don't bother trying to connect
+        sink.write(self.lines[1])
+        sink.close()
+        self.assertEqual(mock_connect.call_count, 2)
+        self.assertEqual(len(spool.segments()), 1)
+
+        # the next run gets a connection, and sends the old lines first
+        mock_connect.side_effect = None
+        sink = leadbutt.GraphiteSink('graphite.local', 2003, spool=spool)
+        sink.write(self.lines[0])
+        sink.close()
+        mock_sock = mock_connect.return_value
+        self.assertEqual([x[0][0] for x in mock_sock.sendall.call_args_list], [
+            ''.join(self.lines).encode('utf-8'),
+            self.lines[0].encode('utf-8'),
+        ])
+        self.assertEqual(spool.segments(), [])
+
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_replay_in_batches_oldest_first(self):
+        spool = leadbutt.Spool(self.tmpdir, segment_bytes=10)
+        lines = ['line.{0} 1.0 1420070400\n'.format(i) for i in range(5)]
+        spool.append(lines[:2])
+        spool.append(lines[2:])
+        self.assertEqual(len(spool.segments()), 2)
+        send = mock.Mock()
+        spool.replay(send, 2)
+        self.assertEqual([x[0][0] for x in send.call_args_list],
+                         [lines[:2], lines[2:4], lines[4:]])
+        self.assertEqual(spool.segments(), [])
+
+    def test_oldest_segments_are_dropped(self):
+        line = 'line 1.0 1420070400\n'
+        spool = leadbutt.Spool(self.tmpdir, max_bytes=len(line) * 3, segment_bytes=len(line))
+        for i in range(5):
+            spool.append(['line {0}.0 1420070400\n'.format(i)])
+        send = mock.Mock()
+        spool.replay(send, 100)
+        self.assertEqual([x[0][0][0].split()[1] for x in send.call_args_list],
+                         ['2.0', '3.0', '4.0'])
+
+    def test_failed_replay_keeps_lines(self):
+        spool = leadbutt.Spool(self.tmpdir)
+        spool.append(['line 1.0 1420070400\n'])
+        with self.assertRaises(socket.error):
+            spool.replay(mock.Mock(side_effect=socket.error), 100)
+        self.assertEqual(len(spool.segments()), 1)
+
+
+class get_graphite_sinkTest(unittest.TestCase):
+    def test_port_defaults_by_protocol(self):
+        sink = leadbutt.get_graphite_sink('graphite.local')
+        self.assertEqual(sink.address, ('graphite.local', 2003))
+        sink = leadbutt.get_graphite_sink('graphite.local', use_pickle=True)
+        self.assertEqual(sink.address, ('graphite.local', 2004))
+        sink = leadbutt.get_graphite_sink('graphite.local:2103')
+        self.assertEqual(sink.address, ('graphite.local', 2103))
+
+
+class is_throttleTest(unittest.TestCase):
+    def test_throttling_error_code(self):
+        e = BotoServerError(400, 'Bad Request')
+        self.assertFalse(leadbutt.is_throttle(e))
+        e.error_code = 'Throttling'
+        self.assertTrue(leadbutt.is_throttle(e))
+        self.assertFalse(leadbutt.is_throttle(ValueError('Throttling')))
+
+
+class get_batchesTest(unittest.TestCase):
+    def request(self, statistics, period=1, count=5, region=None):
+        metric = {'Namespace': 'AWS/EC2', 'MetricName': 'CPUUtilization',
+                  'Statistics': statistics, 'Dimensions': {'InstanceId': 'i-1'},
+                  'Unit': 'Percent'}
+        options = {'Period': period, 'Count': count, 'Region': region}
+        return metric, options, [(metric, options)]
+
+    def test_splits_at_the_query_limit(self):
+        requests = [self.request(['Sum', 'Maximum']) for __ in range(5)]
+        batches = leadbutt.get_batches(requests, size=4)
+        self.assertEqual([len(batch) for batch, __ in batches], [2, 2, 1])
+        self.assertEqual(batches[0][1], requests[0][1])
+
+    def test_groups_by_region_and_window(self):
+        requests = [
+            self.request('Sum'),
+            self.request('Sum', region='us-west-2'),
+            self.request('Sum', period=5, count=1),
+            self.request('Sum', period=1, count=5),
+        ]
+        batches = leadbutt.get_batches(requests)
+        self.assertEqual([batch for batch, __ in batches],
+                         [[requests[0], requests[2], requests[3]], [requests[1]]])
+
+    def test_can_batch(self):
+        metric = self.request('Sum')[0]
+        self.assertTrue(leadbutt.can_batch(metric))
+        self.assertFalse(leadbutt.can_batch(dict(metric, Unit=None)))
+        self.assertFalse(leadbutt.can_batch(dict(metric, Dimensions={'InstanceId': ['a', 'b']})))
+
+
+class FakeAWSTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = fake_aws.FakeAWS(datapoints=3).start()
+        self.tmpdir = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.tmpdir, 'config.yaml')
+        with open(self.config_file, 'w') as fp:
+            fp.write('''
+Metrics:
+- Namespace: "AWS/ELB"
+  MetricName: ["RequestCount", "Latency"]
+  Statistics: ["Sum", "Maximum"]
+  Unit: "Count"
+  Dimensions:
+    LoadBalancerName: "my-load-balancer"
+''')
+
+    def tearDown(self):
+        self.fake.stop()
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch('sys.stdout')
+    def test_leadbutt_end_to_end(self, mock_sysout):
+        with fake_aws.patch_boto(self.fake.port):
+            leadbutt.leadbutt(self.config_file, {'Period': 1, 'Count': 5}, workers=2)
+        self.assertEqual(self.fake.calls, {'GetMetricStatistics': 2})
+        lines = [x[0][0] for x in mock_sysout.write.call_args_list]
+        self.assertEqual(len(lines), 2 * 3 * 2)
+        name, value, timestamp = lines[0].split()
+        self.assertEqual(name, 'cloudwatch.aws.elb.my-load-balancer.requestcount.sum.count')
+        self.assertEqual(int(timestamp) % 60, 0)
+
+    @mock.patch('sys.stdout')
+    def test_metric_data_engine_end_to_end(self, mock_sysout):
+        with fake_aws.patch_boto(self.fake.port):
+            leadbutt.leadbutt(self.config_file, {'Period': 1, 'Count': 5})
+            statistics_lines = [x[0][0] for x in mock_sysout.write.call_args_list]
+            mock_sysout.reset_mock()
+            self.fake.reset()
+            leadbutt.leadbutt(self.config_file, {'Period': 1, 'Count': 5}, engine='metric-data')
+        # 2 metrics with 2 statistics each, in one call
+        self.assertEqual(self.fake.calls, {'GetMetricData': 1})
+        lines = [x[0][0] for x in mock_sysout.write.call_args_list]
+        # the same series and times, the fake just makes up different values
+        self.assertEqual(sorted((x.split()[0], x.split()[2]) for x in lines),
+                         sorted((x.split()[0], x.split()[2]) for x in statistics_lines))
+
+    @mock.patch('sys.stdout')
+    def test_metric_data_engine_pages(self, mock_sysout):
+        self.fake.page_size = 3
+        with fake_aws.patch_boto(self.fake.port):
+            leadbutt.leadbutt(self.config_file, {'Period': 1, 'Count': 5}, engine='metric-data')
+        self.assertEqual(self.fake.calls, {'GetMetricData': 2})
+        self.assertEqual(mock_sysout.write.call_count, 2 * 3 * 2)
+
+    def test_metric_data_engine_counts_no_retries(self):
+        self.fake.page_size = 3
+        out = io.StringIO()
+        with fake_aws.patch_boto(self.fake.port):
+            leadbutt.leadbutt(self.config_file, {'Period': 1, 'Count': 5}, engine='metric-data',
+                              out=out, stats=leadbutt.Stats(), stats_prefix='lb')
+        lines = dict(x.split()[:2] for x in out.getvalue().splitlines() if x.startswith('lb.'))
+        self.assertEqual(lines['lb.api_calls'], '2')
+        self.assertEqual(lines['lb.retries'], '0')
+
+    @mock.patch('sys.stdout')
+    def test_metric_data_engine_without_unit(self, mock_sysout):
+        with open(self.config_file, 'w') as fp:
+            fp.write('''
+Metrics:
+- Namespace: "AWS/ELB"
+  MetricName: ["RequestCount", "Latency"]
+  Statistics: "Sum"
+  Unit: "Count"
+  Dimensions:
+    LoadBalancerName: "my-load-balancer"
+- Namespace: "AWS/ELB"
+  MetricName: "HealthyHostCount"
+  Statistics: "Sum"
+  Dimensions:
+    LoadBalancerName: "my-load-balancer"
+''')
+        with fake_aws.patch_boto(self.fake.port):
+            leadbutt.leadbutt(self.config_file, {'Period': 1, 'Count': 5}, engine='metric-data')
+        # GetMetricData doesn't say what the unit is
+        self.assertEqual(self.fake.calls, {'GetMetricData': 1, 'GetMetricStatistics': 1})
+        self.assertEqual(mock_sysout.write.call_count, 3 * 3)
+
+    @unittest.skipIf(sys.version_info < (3, 5), 'asyncio engine needs Python 3.5+')
+    @mock.patch('sys.stdout')
+    def test_asyncio_engine_end_to_end(self, mock_sysout):
+        with fake_aws.patch_boto(self.fake.port):
+            leadbutt.leadbutt(self.config_file, {'Period': 1, 'Count': 5})
+            statistics_lines = [x[0][0] for x in mock_sysout.write.call_args_list]
+            mock_sysout.reset_mock()
+            self.fake.reset()
+            leadbutt.leadbutt(self.config_file, {'Period': 1, 'Count': 5},
+                              engine='asyncio', workers=2)
+        self.assertEqual(self.fake.calls, {'GetMetricStatistics': 2})
+        lines = [x[0][0] for x in mock_sysout.write.call_args_list]
+        self.assertEqual(lines, statistics_lines)
+
+    @unittest.skipIf(sys.version_info < (3, 5), 'asyncio engine needs Python 3.5+')
+    def test_asyncio_engine_reuses_connections_and_retries(self):
+        self.fake.throttle_rate = 0.3
+        self.fake.random.seed(0)
+        self.fake.latency = 0.01
+        with open(self.config_file, 'w') as fp:
+            fp.write('''
+Metrics:
+- Namespace: "AWS/EC2"
+  MetricName: [{0}]
+  Statistics: "Average"
+  Unit: "Percent"
+  Dimensions:
+    InstanceId: "i-1"
+'''.format(', '.join('"Metric{0}"'.format(i) for i in range(40))))
+        out = io.StringIO()
+        stats = leadbutt.Stats()
+        with fake_aws.patch_boto(self.fake.port):
+            leadbutt.leadbutt(self.config_file, {'Period': 1, 'Count': 5},
+                              engine='asyncio', workers=8, interval=1, out=out, stats=stats)
+        self.assertEqual(len(out.getvalue().splitlines()), 40 * 3)
+        self.assertGreater(stats.counters['throttles'], 0)
+        self.assertEqual(self.fake.calls['GetMetricStatistics'], stats.counters['api_calls'])
+        # throttled responses keep the connection open too
+        self.assertLessEqual(self.fake.connections, 8)
+
+    @unittest.skipIf(sys.version_info < (3, 5), 'asyncio engine needs Python 3.5+')
+    def test_asyncio_engine_times_out_on_a_silent_server(self):
+        import asyncio
+        import leadbutt_aio
+
+        # accepts connections, but never answers
+        server = socket.socket()
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.listen(5)
+        pool = leadbutt_aio.ConnectionPool('127.0.0.1', server.getsockname()[1], False,
+                                           timeout=0.2)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        started = time.time()
+        with self.assertRaises(socket.timeout):
+            loop.run_until_complete(pool.request('POST', '/', {}, b''))
+        self.assertLess(time.time() - started, 5)
+        self.assertEqual(pool.idle, [])
+
+    @mock.patch('sys.stdout')
+    def test_wildcard_dimensions_end_to_end(self, mock_sysout):
+        self.fake.instances = 7
+        self.fake.page_size = 3
+        with open(self.config_file, 'w') as fp:
+            fp.write('''
+Metrics:
+- Namespace: "AWS/EC2"
+  MetricName: "CPUUtilization"
+  Statistics: "Average"
+  Unit: "Percent"
+  Dimensions:
+    InstanceId: "*"
+''')
+        index_file = os.path.join(self.tmpdir, 'index.json')
+        with fake_aws.patch_boto(self.fake.port):
+            leadbutt.leadbutt(self.config_file, {'Period': 1, 'Count': 5},
+                              index=leadbutt.MetricIndex(index_file))
+            # every page of instances gets listed
+            self.assertEqual(self.fake.calls, {'ListMetrics': 3, 'GetMetricStatistics': 7})
+            lines = [x[0][0] for x in mock_sysout.write.call_args_list]
+            self.assertEqual(len(lines), 7 * 3)
+            self.assertTrue(lines[0].startswith(
+                'cloudwatch.aws.ec2.i-00000000.cpuutilization.average.percent '))
+
+            # the next run uses the index from last time
+            self.fake.reset()
+            leadbutt.leadbutt(self.config_file, {'Period': 1, 'Count': 5},
+                              index=leadbutt.MetricIndex(index_file))
+            self.assertEqual(self.fake.calls, {'GetMetricStatistics': 7})
+
+            # until it's stale
+            self.fake.reset()
+            leadbutt.leadbutt(self.config_file, {'Period': 1, 'Count': 5},
+                              index=leadbutt.MetricIndex(index_file, ttl=-1))
+            self.assertEqual(self.fake.calls, {'ListMetrics': 3, 'GetMetricStatistics': 7})
+
 
 @unittest.skipUnless('TOX_TEST_ENTRYPOINT' in os.environ,
     'This is only applicable if leadbutt is installed')
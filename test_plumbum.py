@@ -6,12 +6,30 @@ My class names are funny because I name them after the function they cover.
 """
 from __future__ import unicode_literals
 
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
 import mock
 
+import fake_aws
 import plumbum
 
 
+class StartupTests(unittest.TestCase):
+
+    def test_import_does_not_import_boto_or_jinja2(self):
+        # each run only needs the one AWS service it lists
+        output = subprocess.check_output([sys.executable, '-c', (
+            'import sys; import plumbum\n'
+            'print(sorted(x for x in ("boto", "jinja2") if x in sys.modules))\n'
+        )], cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.decode('utf-8').splitlines()[-1], '[]')
+
+
 class GetCLIOptionsTests(unittest.TestCase):  # flake8: noqa
 
     def test_all_args(self):
@@ -98,6 +116,208 @@ class ListXXXTests(unittest.TestCase):
         tables = plumbum.list_dynamodb('moo', {})
         self.assertEqual(tables, [])
 
+    @mock.patch('boto.ec2.elb.connect_to_region')
+    def test_list_elb_reads_every_page(self, mock_boto):
+        class Page(list):
+            next_marker = None
+
+        first, second = Page([mock.Mock(name='a')]), Page([mock.Mock(name='b')])
+        first.next_marker = 'page2'
+        mock_boto.return_value.get_all_load_balancers.side_effect = [first, second]
+
+        elbs = plumbum.list_elb('moo', {})
+
+        self.assertEqual(elbs, first + second)
+        mock_boto.return_value.get_all_load_balancers.assert_called_with(marker='page2')
+
+    @mock.patch('boto.kinesis.connect_to_region')
+    def test_list_kinesis_applications_reads_every_page(self, mock_boto):
+        conn = mock_boto.return_value
+        conn.list_streams.side_effect = [
+            {'StreamNames': ['a'], 'HasMoreStreams': True},
+            {'StreamNames': ['b'], 'HasMoreStreams': False},
+        ]
+        shards = {
+            ('a', None): (['a1', 'a2'], True),
+            ('a', 'a2'): (['a3'], False),
+            ('b', None): (['b1'], False),
+        }
+
+        def describe_stream(name, exclusive_start_shard_id=None):
+            ids, more = shards[(name, exclusive_start_shard_id)]
+            return {'StreamDescription': {
+                'Shards': [{'ShardId': x} for x in ids], 'HasMoreShards': more}}
+        conn.describe_stream.side_effect = describe_stream
+
+        streams = plumbum.list_kinesis_applications('moo', {})
+
+        self.assertEqual(streams, {'a': ['a1', 'a2', 'a3'], 'b': ['b1']})
+        conn.list_streams.assert_called_with(exclusive_start_stream_name='a')
+
+
+class MainTests(unittest.TestCase):
+    @mock.patch('sys.stdout', new_callable=io.StringIO)
+    def test_several_namespaces_and_regions(self, mock_stdout):
+        listed = []
+
+        def fake_list(namespace):
+            def list_namespace(region, filters):
+                listed.append((namespace, region))
+                return ['{0}-{1}'.format(namespace, region)]
+            return list_namespace
+
+        with tempfile.NamedTemporaryFile('w', suffix='.j2') as template:
+            template.write('{{ region }} {{ resources|join(",") }} {{ discovered|length }}')
+            template.flush()
+            argv = ['plumbum', '-r', 'us-east-1,us-west-2', template.name, 'ec2,AWS/ELB']
+            with mock.patch.object(sys, 'argv', argv), \
+                    mock.patch.dict(plumbum.list_resources,
+                                    {'ec2': fake_list('ec2'), 'elb': fake_list('elb')}):
+                plumbum.main()
+
+        self.assertEqual(sorted(listed), [
+            ('ec2', 'us-east-1'), ('ec2', 'us-west-2'),
+            ('elb', 'us-east-1'), ('elb', 'us-west-2'),
+        ])
+        self.assertEqual(
+            mock_stdout.getvalue(),
+            'us-east-1 ec2-us-east-1,ec2-us-west-2,elb-us-east-1,elb-us-west-2 4\n')
+
+    @mock.patch('sys.stdout', new_callable=io.StringIO)
+    def test_several_regions_need_a_template_that_uses_discovered(self, mock_stdout):
+        template = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'sample_templates', 'elb.yml.j2')
+        argv = ['plumbum', '-r', 'us-east-1,us-west-2', template, 'elb']
+        list_elb = mock.Mock()
+        with mock.patch.object(sys, 'argv', argv), \
+                mock.patch.dict(plumbum.list_resources, {'elb': list_elb}):
+            with self.assertRaises(SystemExit):
+                plumbum.main()
+        self.assertIn('discovered', mock_stdout.getvalue())
+        self.assertFalse(list_elb.called)
+
+    @mock.patch('sys.stdout', new_callable=io.StringIO)
+    def test_sample_template_sets_each_region(self, mock_stdout):
+        template = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'sample_templates', 'ec2.yml.j2')
+        argv = ['plumbum', '-r', 'us-east-1,us-west-2', template, 'ec2']
+        fake = fake_aws.FakeAWS(instances=2).start()
+        self.addCleanup(fake.stop)
+        with mock.patch.object(sys, 'argv', argv), fake_aws.patch_boto(fake.port):
+            plumbum.main()
+        config = mock_stdout.getvalue()
+        self.assertEqual(config.count('InstanceId'), 4)
+        self.assertEqual(config.count('Region: "us-east-1"'), 2)
+        self.assertEqual(config.count('Region: "us-west-2"'), 2)
+
+
+class InventoryTests(unittest.TestCase):
+    def setUp(self):
+        self.fake = fake_aws.FakeAWS(instances=3).start()
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = os.path.join(self.tmpdir, 'cache')
+        self.output = os.path.join(self.tmpdir, 'config.yaml')
+
+    def tearDown(self):
+        self.fake.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def run_plumbum(self, *args):
+        template = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'sample_templates', 'ec2.yml.j2')
+        argv = ['plumbum', '--cache', self.cache, '-o', self.output] + list(args) + [
+            template, 'ec2']
+        with mock.patch.object(sys, 'argv', argv), fake_aws.patch_boto(self.fake.port):
+            plumbum.main()
+        with open(self.output) as fp:
+            return fp.read()
+
+    def test_reuses_what_was_listed(self):
+        inventory = plumbum.Inventory(self.cache)
+        with fake_aws.patch_boto(self.fake.port):
+            instances, digest = inventory.get('ec2', 'us-east-1', {})
+            cached, cached_digest = inventory.get('ec2', 'us-east-1', {})
+            # each set of filters is listed separately
+            inventory.get('ec2', 'us-east-1', {'instance_type': 'm3.medium'})
+        self.assertEqual(self.fake.calls, {'DescribeInstances': 2})
+        self.assertEqual([x.id for x in cached], [x.id for x in instances])
+        self.assertEqual(cached_digest, digest)
+        self.assertEqual(cached[0].tags['Name'], 'fake-0')
+
+    @mock.patch('sys.stderr')
+    def test_lists_again_once_stale(self, mock_stderr):
+        with fake_aws.patch_boto(self.fake.port):
+            plumbum.Inventory(self.cache).get('ec2', 'us-east-1', {})
+            self.fake.instances = 4
+            resources, __ = plumbum.Inventory(self.cache, ttl=0).get('ec2', 'us-east-1', {})
+        self.assertEqual(len(resources), 4)
+        self.assertEqual(self.fake.calls, {'DescribeInstances': 2})
+        # boto's sockets may also warn on stderr
+        mock_stderr.write.assert_any_call('ec2 us-east-1: 1 added (i-00000003), 0 removed\n')
+
+    def test_without_a_path(self):
+        with fake_aws.patch_boto(self.fake.port):
+            plumbum.Inventory().get('ec2', 'us-east-1', {})
+            plumbum.Inventory().get('ec2', 'us-east-1', {})
+        self.assertEqual(self.fake.calls, {'DescribeInstances': 2})
+
+    @mock.patch('sys.stderr')
+    def test_output_only_changes_with_the_resources(self, mock_stderr):
+        config = self.run_plumbum()
+        self.assertEqual(config.count('InstanceId'), 3)
+        os.utime(self.output, (0, 0))
+
+        # nothing to list or write
+        self.fake.reset()
+        self.assertEqual(self.run_plumbum(), config)
+        self.assertEqual(self.fake.calls, {})
+        self.assertEqual(os.path.getmtime(self.output), 0)
+
+        # listed again, but nothing changed
+        self.run_plumbum('--cache-ttl', '0')
+        self.assertEqual(self.fake.calls, {'DescribeInstances': 1})
+        self.assertEqual(os.path.getmtime(self.output), 0)
+
+        self.fake.instances = 4
+        config = self.run_plumbum('--cache-ttl', '0')
+        self.assertEqual(config.count('InstanceId'), 4)
+        self.assertNotEqual(os.path.getmtime(self.output), 0)
+
+    @mock.patch('sys.stderr')
+    def test_compiled_templates_are_cached(self, mock_stderr):
+        self.run_plumbum()
+        self.assertEqual(len(os.listdir(os.path.join(self.cache, 'templates'))), 1)
+
+    def test_write_output(self):
+        self.assertTrue(plumbum.write_output(self.output, ['Metrics: ', '[]\n']))
+        self.assertFalse(plumbum.write_output(self.output, iter(['Metrics: []', '\n'])))
+        self.assertTrue(plumbum.write_output(self.output, ['Metrics:\n']))
+        self.assertEqual(os.listdir(self.tmpdir), ['config.yaml'])
+        with open(self.output) as fp:
+            self.assertEqual(fp.read(), 'Metrics:\n')
+
+    def test_write_output_keeps_the_old_file_on_errors(self):
+        plumbum.write_output(self.output, ['Metrics: []\n'])
+
+        def chunks():
+            yield 'Metrics:\n'
+            raise ValueError('undefined')
+
+        with self.assertRaises(ValueError):
+            plumbum.write_output(self.output, chunks())
+        self.assertEqual(os.listdir(self.tmpdir), ['config.yaml'])
+        with open(self.output) as fp:
+            self.assertEqual(fp.read(), 'Metrics: []\n')
+
+
+class BoundedMapTests(unittest.TestCase):
+    def test_keeps_order(self):
+        self.assertEqual(plumbum.bounded_map(lambda x: x * 2, range(20), workers=3),
+                         [x * 2 for x in range(20)])
+
+    def test_one_item_is_not_threaded(self):
+        self.assertEqual(plumbum.bounded_map(lambda x: x, [1]), [1])
+
 
 if __name__ == '__main__':
     unittest.main()